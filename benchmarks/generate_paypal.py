@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Generate synthetic PayPal CSV exports for benchmarking, laid out exactly
+like a real "All transactions" export (see tests/paypal_example.csv):
+
+generate_rows
+write_paypal_csv
+
+The mix of transactions is seeded, so the same num_rows and seed always
+give the same file.  Usage, from the root of the repository:
+
+    python benchmarks/generate_paypal.py 100000 paypal_100k.csv [seed]
+
+"""
+
+import sys, csv, io, random, datetime
+
+
+# The header row of a PayPal export, with its odd spacing and trailing comma
+PAYPAL_HEADER = [
+    'Date', ' Time', ' Time Zone', ' Name', ' Type', ' Status', ' Currency',
+    ' Gross', ' Fee', ' Net', ' From Email Address', ' To Email Address',
+    ' Transaction ID', ' Counterparty Status', ' Address Status',
+    ' Item Title', ' Item ID', ' Shipping and Handling Amount',
+    ' Insurance Amount', ' Sales Tax', ' Option 1 Name', ' Option 1 Value',
+    ' Option 2 Name', ' Option 2 Value', ' Auction Site', ' Buyer ID',
+    ' Item URL', ' Closing Date', ' Escrow Id', ' Invoice Id',
+    ' Reference Txn ID', ' Invoice Number', ' Custom Number', ' Quantity',
+    ' Receipt ID', ' Balance', ' Address Line 1',
+    ' Address Line 2/District/Neighborhood', ' Town/City',
+    ' State/Province/Region/County/Territory/Prefecture/Republic',
+    ' Zip/Postal Code', ' Country', ' Contact Phone Number', ' ']
+
+FIELDS = [field.strip() for field in PAYPAL_HEADER]
+
+OUR_EMAIL = 'accountscgy@dancesportalberta.org'
+
+# (item title, price in cents) of the TicketLeap tickets on sale
+TICKETS = [
+    ('59th CCC - Friday Evening - Vendredi Soir (Tier 1)', 17540),
+    ('59th CCC - Saturday Full Day - Samedi Journée Complète (Tier 1)',
+     17540),
+    ('59th CCC - Spectator-only Saturday Daytime - Samedi Jour (04-04-2015)',
+     690),
+    ("59th CCC - Competitor Entry Fees - Frais d'inscription "
+     "(Youth/Adult Competitor)", 5300),
+    ('Northern Lights Classic - Competitor Entry Fees '
+     '(Youth/Adult Competitor)', 5300),
+    ('Northern Lights Classic - Afternoon and Evening '
+     '(First or Second Row)', 12440)]
+
+# What the TicketLeap fees are charged on
+TICKETLEAP_TICKETS = [
+    ('59th CCC - Friday Evening - Vendredi Soir (04-03-2015)', 4300),
+    ('59th CCC - Saturday Full Day - Samedi Journée Complète (04-04-2015)',
+     5150),
+    ('59th CCC - Spectator-only Saturday Daytime - Samedi Jour (04-04-2015)',
+     690),
+    ("59th CCC - Competitor Entry Fees - Frais d'inscription (04-03-2015)",
+     1750)]
+
+FIRST_NAMES = ['Mary Ann', 'Michael', 'John', 'Jane', 'Ann', 'Bob', 'Chen',
+               'Priya', 'Olga', 'Luis', 'Fatima', 'Pierre', 'Aiko', 'Sven']
+LAST_NAMES = ['Currie', 'Smith', 'Doe', 'Lee', "O'Neil", 'Tremblay', 'Wong',
+              'Singh', 'Ivanova', 'Garcia', 'Haddad', 'Roy', 'Sato', 'Berg']
+TOWNS = [('calgary', 'Alberta', 't2t 6j9'), ('edmonton', 'AB', 't5k 2j1'),
+         ('Red Deer', 'Alberta', 't4n 1a1'), ('vancouver', 'BC', 'v6b 1a1')]
+
+# The share of each kind of transaction in the export
+MIX = [('cart', 0.70), ('ticketleap_fee', 0.10), ('cancelled_payment', 0.05),
+       ('withdrawal', 0.05), ('invoice', 0.05), ('donation', 0.05)]
+
+
+def generate_rows(num_rows, seed=0):
+    """
+    Generate about num_rows rows (never fewer; a transaction is never cut
+    short) of a PayPal export, newest first as PayPal lists them.
+
+    Each row is a dict of field -> value, as it would appear in the CSV.
+
+    The mix: completed TicketLeap sales (a Shopping Cart Payment Received
+    plus its Shopping Cart Items), some of them refunded (with their Refund
+    and Cancelled Fee rows), TicketLeap fees (a Preapproved Payment Sent
+    plus the items it is charged on), cancelled payments, withdrawals to
+    the bank, invoices (some cancelled) and donations.
+
+    """
+    rnd = random.Random(seed)
+    kinds = [kind for kind, share in MIX]
+    shares = [share for kind, share in MIX]
+
+    # About one customer for every 20 rows, so names repeat realistically
+    num_customers = max(len(FIRST_NAMES), num_rows // 20)
+    customers = [make_customer(rnd, customer_num)
+                 for customer_num in range(num_customers)]
+
+    rows = []
+    now = datetime.datetime(2016, 12, 31, 23, 59, 59)
+    tranID_num = [0]
+
+    def next_tranID():
+        tranID_num[0] += 1
+        return '%017X' % (tranID_num[0] * 2654435761 % 16**17)
+
+    while len(rows) < num_rows:
+        now -= datetime.timedelta(seconds=rnd.randint(60, 4 * 3600))
+        base = {'Date': '%d/%d/%d' % (now.month, now.day, now.year),
+                'Time': now.strftime('%H:%M:%S'),
+                'Time Zone': 'GMT-07:00', 'Currency': 'CAD'}
+        customer = rnd.choice(customers)
+        kind = weighted_choice(rnd, kinds, shares)
+
+        if kind == 'cart':
+            rows.extend(cart_rows(rnd, base, customer, next_tranID))
+        elif kind == 'ticketleap_fee':
+            rows.extend(ticketleap_fee_rows(rnd, base, next_tranID))
+        elif kind == 'cancelled_payment':
+            amount = rnd.randint(100, 900000)
+            rows.append(row_of(base, customer, Type='Payment Sent',
+                               Status='Canceled', Gross=money(-amount),
+                               Fee='0', **{'Transaction ID': next_tranID()}))
+            rows.append(row_of(base, customer, Type='Cancelled Payment',
+                               Status='Completed', Gross=money(amount),
+                               Fee='0', **{'Transaction ID': next_tranID()}))
+        elif kind == 'withdrawal':
+            rows.append(row_of(base, None, Name='Bank Account',
+                               Type='Withdraw Funds to Bank Account',
+                               Status='Completed', Fee='0',
+                               Gross=money(-rnd.randint(1000, 900000)),
+                               **{'Transaction ID': next_tranID()}))
+        elif kind == 'invoice':
+            rows.extend(invoice_rows(rnd, base, customer, next_tranID))
+        else:
+            gross = rnd.choice([1000, 2500, 10000])
+            rows.append(row_of(base, customer, Type='Donation Received',
+                               Status='Completed', Gross=money(gross),
+                               Fee=money(-(30 + gross * 29 // 1000)),
+                               **{'From Email Address': customer['Email'],
+                                  'To Email Address': OUR_EMAIL,
+                                  'Transaction ID': next_tranID()}))
+
+    return rows
+
+
+def cart_rows(rnd, base, customer, next_tranID):
+    """
+    The rows of one TicketLeap sale, and of its refund if it was refunded
+
+    """
+    tranID = next_tranID()
+    tickets = [rnd.choice(TICKETS) for _ in range(rnd.randint(1, 5))]
+    items_total = sum(price for title, price in tickets)
+    # Some carts got the early bird discount
+    gross = items_total - rnd.choice([0, 0, 0, 500])
+    fee = -(30 + gross * 29 // 1000)
+    status = 'Refunded' if rnd.random() < 0.05 else 'Completed'
+    emails = {'From Email Address': customer['Email'],
+              'To Email Address': OUR_EMAIL}
+
+    rows = [row_of(base, customer, Type='Shopping Cart Payment Received',
+                   Status=status, Gross=money(gross), Fee=money(fee),
+                   Net=money(gross + fee), Quantity=str(len(tickets)),
+                   **dict(emails, **{'Transaction ID': tranID,
+                                     'Item Title': 'Shopping Cart'}))]
+    for title, price in tickets:
+        rows.append(row_of(base, customer, Type='Shopping Cart Item',
+                           Status=status, Gross=money(price), Quantity='1',
+                           **dict(emails, **{'Transaction ID': tranID,
+                                             'Item Title': title})))
+
+    if status == 'Refunded':
+        # PayPal keeps $0.30 of the fee, which shows up as a Cancelled Fee
+        rows.insert(0, row_of(base, customer, Type='Refund',
+                              Status='Completed', Gross=money(-gross),
+                              Fee=money(-fee - 30),
+                              **{'Transaction ID': next_tranID(),
+                                 'Reference Txn ID': tranID}))
+        rows.insert(0, row_of(base, None, Name='PayPal',
+                              Type='Cancelled Fee', Status='Completed',
+                              Gross='0', Fee='0.30',
+                              **{'Transaction ID': next_tranID(),
+                                 'Reference Txn ID': tranID}))
+    return rows
+
+
+def ticketleap_fee_rows(rnd, base, next_tranID):
+    """
+    The rows of one TicketLeap fee: the payment, and the items it is for
+
+    """
+    tranID = next_tranID()
+    tickets = [rnd.choice(TICKETLEAP_TICKETS)
+               for _ in range(rnd.randint(1, 4))]
+    emails = {'From Email Address': OUR_EMAIL,
+              'To Email Address': 'finance@ticketleap.com',
+              'Transaction ID': tranID}
+    rows = [row_of(base, None, Name='TicketLeap',
+                   Type='Preapproved Payment Sent', Status='Completed',
+                   Gross=money(-sum(price for title, price in tickets)),
+                   Fee='0', Quantity=str(len(tickets)), **emails)]
+    for title, price in tickets:
+        rows.append(row_of(base, None, Name='TicketLeap',
+                           Type='Shopping Cart Item', Status='Completed',
+                           Gross=money(price), Quantity='1',
+                           **dict(emails, **{'Item Title': title})))
+    return rows
+
+
+def invoice_rows(rnd, base, customer, next_tranID):
+    """
+    The rows of one invoice sent to a customer, and its items
+
+    """
+    tranID = next_tranID()
+    status = rnd.choice(['Paid', 'Paid', 'Canceled'])
+    amounts = [rnd.choice([2500, 5000, 12000])
+               for _ in range(rnd.randint(1, 3))]
+    fields = {'From Email Address': OUR_EMAIL,
+              'To Email Address': customer['Email'],
+              'Transaction ID': tranID,
+              'Invoice Number': str(rnd.randint(1000, 9999))}
+    rows = [row_of(base, customer, Type='Invoice Sent', Status=status,
+                   Gross=money(sum(amounts)), Fee='0', **fields)]
+    for amount in amounts:
+        rows.append(row_of(base, customer, Type='Invoice item',
+                           Status=status, Gross=money(amount), Quantity='1',
+                           **dict(fields, **{'Item Title': 'Membership'})))
+    return rows
+
+
+def make_customer(rnd, customer_num):
+    """
+    The name, email and address fields of one made-up customer
+
+    """
+    first_name = rnd.choice(FIRST_NAMES)
+    last_name = rnd.choice(LAST_NAMES)
+    town, province, postal_code = rnd.choice(TOWNS)
+    return {'Name': first_name + ' ' + last_name,
+            'Email': '%s.%s%d@example.com' % (first_name.split()[0].lower(),
+                                              last_name.lower(), customer_num),
+            'Address Line 1': '%d %s Street' % (rnd.randint(1, 9999),
+                                                rnd.choice(LAST_NAMES)),
+            'Address Line 2': rnd.choice(['', '', 'Unit 5']),
+            'Town/City': town,
+            'Province': province,
+            'Zip/Postal Code': postal_code,
+            'Country': 'Canada',
+            'Contact Phone Number': '403-555-%04d' % rnd.randint(0, 9999)}
+
+
+def row_of(base, customer, **fields):
+    """
+    One CSV row, as a dict of field -> value: the date and time fields of
+    base, the name and address of customer (if any), then fields
+
+    """
+    row = dict.fromkeys(FIELDS, '')
+    row.update(base)
+    if customer is not None:
+        row['Name'] = customer['Name']
+        for field in ['Address Line 1', 'Town/City', 'Zip/Postal Code',
+                      'Country', 'Contact Phone Number']:
+            row[field] = customer[field]
+        row['Address Line 2/District/Neighborhood'] = \
+            customer['Address Line 2']
+        row['State/Province/Region/County/Territory/Prefecture/Republic'] = \
+            customer['Province']
+    row.update(fields)
+    return row
+
+
+def money(cents):
+    """
+    Format an amount of cents the way PayPal does, e.g. -500000 as
+    '-5,000.00' and 4300 as '43'
+
+    """
+    dollars = '{:,.2f}'.format(cents / 100)
+    if dollars.endswith('.00') and abs(cents) < 100000:
+        dollars = dollars[:-3]
+    return dollars
+
+
+def weighted_choice(rnd, choices, weights):
+    """
+    Pick one of choices at random, in proportion to weights
+
+    """
+    threshold = rnd.random() * sum(weights)
+    for choice, weight in zip(choices, weights):
+        threshold -= weight
+        if threshold < 0:
+            return choice
+    return choices[-1]
+
+
+def write_paypal_csv(paypal_path, num_rows, seed=0, encoding='utf-8'):
+    """
+    Write a synthetic PayPal export of about num_rows rows to paypal_path
+
+    Returns the number of rows written (not counting the header row)
+
+    """
+    rows = generate_rows(num_rows, seed)
+    with io.open(paypal_path, 'w', encoding=encoding, newline='') as f:
+        f.write(','.join(PAYPAL_HEADER) + '\n')
+        writer = csv.writer(f, lineterminator='\n')
+        for row in rows:
+            writer.writerow([row[field] for field in FIELDS[:-1]])
+    return len(rows)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    num_rows = write_paypal_csv(sys.argv[2], int(sys.argv[1]), seed)
+    print("Wrote " + str(num_rows) + " rows to " + sys.argv[2])
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Time each stage of paypal_to_quickbooks on synthetic PayPal exports of
+several sizes, and record the results to a JSON baseline, so that later
+changes can be checked for performance regressions:
+
+run_benchmarks
+time_stages
+compare_to_baseline
+
+Usage, from the root of the repository:
+
+    python benchmarks/run_benchmarks.py [--sizes 1000,10000,100000]
+                                        [--output benchmarks/baseline.json]
+                                        [--compare benchmarks/baseline.json]
+                                        [--tolerance 1.5] [--repeat 3]
+
+With --compare, the run fails (exit status 1) if any stage of any size is
+slower than tolerance times its time in the baseline.
+
+"""
+
+import sys, os, io, gc, json, shutil, tempfile, argparse
+import platform, datetime, tracemalloc
+
+# We must add .. to the path so that we can import the package while
+# running this as a top-level script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+                                                               __file__))))
+import petl as etl
+import pp2qb
+from generate_paypal import write_paypal_csv
+
+
+# The stages of paypal_to_quickbooks, in the order they run
+STAGES = ['cleanup_paypal', 'eliminate_cancellations', 'get_customer_names',
+          'append_TicketLeap_fees', 'append_sales_as_deposits', 
+          'append_invoices', 'write_unprocessed']
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def time_stages(paypal_path, output_folder):
+    """
+    Convert paypal_path into output_folder, recording each stage with a 
+    RunMetrics.
+
+    Returns a dict of stage name -> seconds taken
+
+    """
+    metrics = pp2qb.RunMetrics()
+    pp2qb.paypal_to_quickbooks(paypal_path, 
+                               os.path.join(output_folder, 'output.iif'),
+                               os.path.join(output_folder, 'unprocessed.csv'),
+                               start_date=datetime.date(2015, 1, 1),
+                               metrics=metrics)
+    return dict((record['stage'], record['seconds']) 
+                for record in metrics.stages)
+
+
+def peak_memory(paypal_path, output_folder):
+    """
+    Run the whole of paypal_to_quickbooks on paypal_path under tracemalloc.
+
+    Returns the peak memory allocated, in bytes
+
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run_quietly(pp2qb.paypal_to_quickbooks, paypal_path,
+                    os.path.join(output_folder, 'output.iif'),
+                    os.path.join(output_folder, 'unprocessed.csv'),
+                    start_date=datetime.date(2015, 1, 1))
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_quietly(function, *args, **kwargs):
+    """
+    Call function, throwing away whatever it prints
+
+    """
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=3, seed=0):
+    """
+    Benchmark every stage on a synthetic PayPal export of each size.
+
+    The time recorded for each stage is the best of repeat runs, which is
+    the least noisy.  Peak memory is measured in a separate run, since
+    tracing every allocation slows everything down.
+
+    Returns the results, as a dict ready to be saved as JSON
+
+    """
+    results = {'python': platform.python_version(),
+               'petl': etl.__version__,
+               'machine': platform.machine(),
+               'seed': seed,
+               'repeat': repeat,
+               'sizes': {}}
+
+    work_folder = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            paypal_path = os.path.join(work_folder, 'paypal.csv')
+            num_rows = write_paypal_csv(paypal_path, size, seed)
+
+            best = dict((stage, float('inf')) for stage in STAGES)
+            for _ in range(repeat):
+                gc.collect()
+                timings = run_quietly(time_stages, paypal_path, work_folder)
+                for stage in STAGES:
+                    best[stage] = min(best[stage], timings[stage])
+
+            total = sum(best.values())
+            results['sizes'][str(size)] = {
+                'rows': num_rows,
+                'seconds': dict((stage, round(best[stage], 6))
+                                for stage in STAGES),
+                'total_seconds': round(total, 6),
+                'rows_per_second': int(num_rows / total),
+                'peak_memory_bytes': peak_memory(paypal_path, work_folder)}
+    finally:
+        shutil.rmtree(work_folder)
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=1.5):
+    """
+    Compare results to an earlier baseline, stage by stage, for each size
+    they both have.
+
+    Returns a list of messages describing each regression, i.e. each stage
+    that took more than tolerance times as long as in the baseline
+
+    """
+    regressions = []
+    for size, result in sorted(results['sizes'].items(),
+                               key=lambda item: int(item[0])):
+        if size not in baseline['sizes']:
+            continue
+        baseline_seconds = baseline['sizes'][size]['seconds']
+        for stage in STAGES:
+            if stage not in baseline_seconds:
+                continue
+            before = baseline_seconds[stage]
+            after = result['seconds'][stage]
+            # Stages that take next to no time are too noisy to compare
+            if after > tolerance * before and after - before > 0.005:
+                regressions.append(
+                    '%s rows: %s took %.4fs, against %.4fs in the baseline' %
+                    (size, stage, after, before))
+    return regressions
+
+
+def print_results(results):
+    """
+    Print the results as a table, one row per size
+
+    """
+    print('%10s %10s ' % ('rows', 'rows/sec') +
+          ' '.join('%12s' % stage.split('_')[-1][:12] for stage in STAGES) +
+          ' %10s' % 'peak MB')
+    for size, result in sorted(results['sizes'].items(),
+                               key=lambda item: int(item[0])):
+        print('%10d %10d ' % (result['rows'], result['rows_per_second']) +
+              ' '.join('%12.4f' % result['seconds'][stage]
+                       for stage in STAGES) +
+              ' %10.1f' % (result['peak_memory_bytes'] / 1024.0**2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the stages of paypal_to_quickbooks')
+    parser.add_argument('--sizes', default=','.join(str(size) for size
+                                                    in DEFAULT_SIZES),
+                        help='comma-separated numbers of rows, e.g. '
+                             '1000,10000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='a JSON baseline to compare to')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks([int(size) for size in args.sizes.split(',')],
+                             args.repeat, args.seed)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+            output_file.write('\n')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(
+                                              baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Time how long the pp2qb command line takes to start up and to convert a
+small daily file, each in a fresh interpreter, as when it's run from cron
+or a hook script:
+
+time_commands
+startup_commands
+
+Usage, from the root of the repository:
+
+    python benchmarks/startup_time.py [--repeat 10] [--rows 200]
+                                      [--output startup.json]
+
+The time of bare 'python -c pass' is included, as the floor the others
+can't go below.
+
+"""
+
+import sys, os, json, time, shutil, tempfile, argparse, subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generate_paypal import write_paypal_csv
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def startup_commands(paypal_path, output_folder):
+    """
+    The commands to time, as a list of (name, argument list) pairs
+
+    """
+    python = sys.executable
+    return [('python -c pass', [python, '-c', 'pass']),
+            ('import pp2qb', [python, '-c', 'import pp2qb']),
+            ('pp2qb --version', [python, '-m', 'pp2qb', '--version']),
+            ('pp2qb --help', [python, '-m', 'pp2qb', '--help']),
+            ('pp2qb convert', [python, '-m', 'pp2qb', 'convert', paypal_path,
+                               '--iif', os.path.join(output_folder,
+                                                     'output.iif'),
+                               '--unprocessed', os.path.join(
+                                   output_folder, 'unprocessed.csv'),
+                               '--start-date', '2015-01-01'])]
+
+
+def time_commands(commands, repeat=10):
+    """
+    Run each command repeat times, in a fresh interpreter each time.
+
+    Returns a dict of name -> the best wall time taken, in seconds
+
+    """
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = REPO_ROOT + os.pathsep + \
+                                environment.get('PYTHONPATH', '')
+    best = {}
+    for name, command in commands:
+        best[name] = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.check_call(command, env=environment,
+                                  stdout=subprocess.DEVNULL)
+            best[name] = min(best[name], time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the start-up of the pp2qb command line')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=200,
+                        help='the size of the file to convert')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    work_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = os.path.join(work_folder, 'paypal.csv')
+        write_paypal_csv(paypal_path, args.rows)
+        commands = startup_commands(paypal_path, work_folder)
+        results = time_commands(commands, args.repeat)
+    finally:
+        shutil.rmtree(work_folder)
+
+    for name, command in commands:
+        print('%-20s %8.1f ms' % (name, results[name] * 1000))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+            output_file.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,42 @@
-from .pptl2qb import paypal_to_quickbooks
+"""
+Convert PayPal transaction exports into QuickBooks .IIF files.
 
-__all__ = ['paypal_to_quickbooks']
+The public names are only imported when first used (as are the pp_*
+modules), so that e.g. python -m pp2qb --help doesn't have to wait for
+petl and the whole conversion pipeline to import.
+
+"""
+
+import importlib
+
+__version__ = '0.1.0'
+
+__all__ = ['paypal_to_quickbooks', 'RunMetrics', 'convert_batch']
+
+# The module each public name lives in
+lazy_names = {'paypal_to_quickbooks': 'pptl2qb',
+              'RunMetrics': 'pp_metrics',
+              'convert_batch': 'pp_batch'}
+
+
+def __getattr__(name):
+    if name in lazy_names:
+        value = getattr(importlib.import_module('.' + lazy_names[name],
+                                                __name__), name)
+    elif name.startswith('pp'):
+        # A submodule, e.g. pp2qb.pp_helper
+        try:
+            value = importlib.import_module('.' + name, __name__)
+        except ModuleNotFoundError as error:
+            if error.name != __name__ + '.' + name:
+                # The submodule exists, but something it imports doesn't
+                raise
+            raise AttributeError("module 'pp2qb' has no attribute " + name)
+    else:
+        raise AttributeError("module 'pp2qb' has no attribute " + name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(lazy_names))
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+The pp2qb command line:
+
+    python -m pp2qb convert paypal.csv [--iif output.iif]
+                            [--unprocessed unprocessed.csv]
+                            [--start-date 2015-01-01] [--end-date 2015-01-31]
+                            [--ledger ledger.sqlite] [--accounts rules.csv]
+                            [--cache-dir cache] [--workers 4] [--streaming]
+                            [--report run_report.json]
+                            [--invoice-report invoice_payments.csv]
+                            [--cart-report cart_validation.csv]
+                            [--validate-only] [--skip-invalid-carts]
+    python -m pp2qb fetch --start-date 2015-01-01 --end-date 2015-01-31
+                          [--base-url https://api-m.paypal.com]
+                          [--output-dir .] [--state-dir pages]
+                          [--workers 4] [--rate 10] [--ledger ...]
+                          [--accounts ...] [--streaming] [--report ...]
+                          [--skip-invalid-carts]
+    python -m pp2qb batch FOLDER_OR_MANIFEST ...   (see pp_batch)
+    python -m pp2qb watch FOLDER ...               (see pp_watch)
+    python -m pp2qb --version
+
+fetch pulls the transactions from the PayPal API instead of a CSV export
+(see pp_api), authenticating with the client credentials in the
+PAYPAL_CLIENT_ID and PAYPAL_CLIENT_SECRET environment variables, or else
+the token in PAYPAL_ACCESS_TOKEN.
+
+With --profile, the whole command (imports included) runs under cProfile,
+and the slowest calls are printed afterwards.
+
+Only argparse is imported up front; the conversion pipeline, and petl with
+it, is imported by the subcommand that needs it, so --help and --version
+return at once:
+
+main
+
++ some "private" helpers:
+
+build_parser
+convert
+fetch
+batch
+watch
+parse_date
+
+"""
+
+import os, sys, argparse
+
+
+def main(argv=None):
+    parser = build_parser()
+    # (Whatever follows batch or watch is left for their own parsers)
+    args, other_args = parser.parse_known_args(argv)
+    if other_args and args.command not in ('batch', 'watch'):
+        parser.error('unrecognized arguments: ' + ' '.join(other_args))
+    args.other_args = other_args
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    if not args.profile:
+        return args.run(args)
+
+    import cProfile, pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(args.run, args)
+    finally:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+            'cumulative').print_stats(25)
+
+
+def build_parser():
+    """
+    The argparse parser for every subcommand
+
+    """
+    from . import __version__
+
+    parser = argparse.ArgumentParser(
+        prog='pp2qb',
+        description='Convert PayPal transaction exports to QuickBooks')
+    parser.add_argument('--version', action='version',
+                        version='pp2qb ' + __version__)
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the command, and print the slowest '
+                             'calls to stderr')
+    subparsers = parser.add_subparsers(dest='command')
+
+    convert_parser = subparsers.add_parser(
+        'convert', help='convert one PayPal CSV export')
+    convert_parser.add_argument('paypal_path')
+    convert_parser.add_argument('--iif', dest='iif_path',
+                                help='by default, output.iif next to the '
+                                     'PayPal file')
+    convert_parser.add_argument('--unprocessed', dest='unprocessed_path',
+                                help='by default, unprocessed.csv next to '
+                                     'the PayPal file')
+    convert_parser.add_argument('--start-date', type=parse_date)
+    convert_parser.add_argument('--end-date', type=parse_date)
+    convert_parser.add_argument('--ledger', dest='ledger_path')
+    convert_parser.add_argument('--accounts', dest='accounts_path')
+    convert_parser.add_argument('--cache-dir')
+    convert_parser.add_argument('--workers', type=int, default=1)
+    convert_parser.add_argument('--streaming', action='store_true')
+    convert_parser.add_argument('--report', dest='report_path',
+                                help='write a JSON run report here')
+    convert_parser.add_argument('--invoice-report', 
+                                dest='invoice_report_path',
+                                help='by default, invoice_payments.csv next '
+                                     'to the PayPal file')
+    convert_parser.add_argument('--cart-report', dest='cart_report_path',
+                                help='by default, cart_validation.csv next '
+                                     'to the PayPal file')
+    convert_parser.add_argument('--validate-only', action='store_true',
+                                help='just check the carts, and write the '
+                                     'cart report')
+    convert_parser.add_argument('--skip-invalid-carts', action='store_true',
+                                help='leave the carts that fail validation '
+                                     'unprocessed, instead of converting '
+                                     'them')
+    convert_parser.set_defaults(run=convert)
+
+    fetch_parser = subparsers.add_parser(
+        'fetch', help='fetch the transactions from the PayPal API and '
+                      'convert them')
+    fetch_parser.add_argument('--start-date', type=parse_date, required=True)
+    fetch_parser.add_argument('--end-date', type=parse_date, required=True)
+    fetch_parser.add_argument('--base-url', 
+                              default='https://api-m.paypal.com')
+    fetch_parser.add_argument('--output-dir', default='.',
+                              help='where to write output.iif and the '
+                                   'rest')
+    fetch_parser.add_argument('--state-dir',
+                              help='save the pages fetched here, so an '
+                                   'interrupted fetch can be resumed')
+    fetch_parser.add_argument('--workers', type=int, default=4,
+                              help='the pages fetched at once')
+    fetch_parser.add_argument('--rate', type=float, default=10.0,
+                              help='the most requests per second')
+    fetch_parser.add_argument('--ledger', dest='ledger_path')
+    fetch_parser.add_argument('--accounts', dest='accounts_path')
+    fetch_parser.add_argument('--streaming', action='store_true')
+    fetch_parser.add_argument('--skip-invalid-carts', action='store_true')
+    fetch_parser.add_argument('--report', dest='report_path',
+                              help='write a JSON run report here')
+    fetch_parser.set_defaults(run=fetch)
+
+    batch_parser = subparsers.add_parser(
+        'batch', add_help=False,
+        help='convert a folder or manifest of PayPal CSV exports (see '
+             'python -m pp2qb batch --help)')
+    batch_parser.set_defaults(run=batch)
+
+    watch_parser = subparsers.add_parser(
+        'watch', add_help=False,
+        help='convert the PayPal CSV exports dropped into a folder as they '
+             'land (see python -m pp2qb watch --help)')
+    watch_parser.set_defaults(run=watch)
+
+    return parser
+
+
+def convert(args):
+    """
+    The convert subcommand
+
+    """
+    from .pptl2qb import paypal_to_quickbooks
+    from .pp_metrics import RunMetrics
+
+    metrics = RunMetrics()
+    # (With --validate-only, this returns the CartValidator)
+    validator = paypal_to_quickbooks(
+        args.paypal_path, args.iif_path, args.unprocessed_path, 
+        args.start_date, args.end_date, workers=args.workers, 
+        ledger_path=args.ledger_path, streaming=args.streaming, 
+        metrics=metrics, accounts_path=args.accounts_path, 
+        cache_dir=args.cache_dir, 
+        invoice_report_path=args.invoice_report_path, 
+        cart_report_path=args.cart_report_path, 
+        validate_only=args.validate_only, 
+        exclude_failed_carts=args.skip_invalid_carts)
+    if args.report_path:
+        metrics.write_report(args.report_path)
+    if args.validate_only and validator.failed_tranIDs:
+        return 1
+    return 0
+
+
+def fetch(args):
+    """
+    The fetch subcommand
+
+    """
+    from .pp_api import TransactionSearchClient, api_to_quickbooks
+    from .pp_metrics import RunMetrics
+
+    client = TransactionSearchClient(
+        args.base_url, os.environ.get('PAYPAL_CLIENT_ID'),
+        os.environ.get('PAYPAL_CLIENT_SECRET'),
+        os.environ.get('PAYPAL_ACCESS_TOKEN'), 
+        max_connections=args.workers, rate=args.rate)
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    metrics = RunMetrics()
+    with client:
+        api_to_quickbooks(client, args.start_date, args.end_date, 
+                          args.output_dir, args.workers, args.state_dir, 
+                          ledger_path=args.ledger_path, 
+                          streaming=args.streaming, metrics=metrics, 
+                          accounts_path=args.accounts_path,
+                          exclude_failed_carts=args.skip_invalid_carts)
+    if args.report_path:
+        metrics.write_report(args.report_path)
+    return 0
+
+
+def batch(args):
+    """
+    The batch subcommand, i.e. pp_batch's own command line
+
+    """
+    from .pp_batch import main as batch_main
+    return batch_main(args.other_args, prog='pp2qb batch')
+
+
+def watch(args):
+    """
+    The watch subcommand, i.e. pp_watch's own command line
+
+    """
+    from .pp_watch import main as watch_main
+    return watch_main(args.other_args, prog='pp2qb watch')
+
+
+def parse_date(text):
+    """
+    A date written as YYYY-MM-DD, read by pp_batch.parse_date (imported 
+    only once there's a date to read, as pp_batch imports petl)
+
+    """
+    from .pp_batch import parse_date
+    return parse_date(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,610 @@
+# -*- coding: utf-8 -*-
+"""
+Pulling the transactions straight from a PayPal Transaction Search style
+REST API (GET /v1/reporting/transactions), instead of exporting a CSV file
+by hand, and converting them with the usual pipeline:
+
+api_to_quickbooks
+fetch_transactions
+
++ the HTTP client it fetches the pages with:
+
+TransactionSearchClient
+APIError
+
++ some "private" helpers:
+
+ConnectionPool
+RateLimiter
+date_windows
+page_file_path
+initiation_time
+refunded_payments
+transaction_rows
+export_type
+format_amount
+
+The transactions come back as rows laid out just like PayPal's CSV export
+(with export_header), so from there on they are cleaned up and converted
+exactly as a CSV file would be.
+
+"""
+
+import io, os, json, time, base64, datetime, threading, http.client
+import queue as queue_module
+from decimal import Decimal
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import petl as etl
+from .pptl2qb import paypal_to_quickbooks
+
+
+# The fields of PayPal's CSV export, in order
+export_header = [
+    'Date', 'Time', 'Time Zone', 'Name', 'Type', 'Status', 'Currency',
+    'Gross', 'Fee', 'Net', 'From Email Address', 'To Email Address',
+    'Transaction ID', 'Counterparty Status', 'Address Status', 'Item Title',
+    'Item ID', 'Shipping and Handling Amount', 'Insurance Amount',
+    'Sales Tax', 'Option 1 Name', 'Option 1 Value', 'Option 2 Name',
+    'Option 2 Value', 'Auction Site', 'Buyer ID', 'Item URL',
+    'Closing Date', 'Escrow Id', 'Invoice Id', 'Reference Txn ID',
+    'Invoice Number', 'Custom Number', 'Quantity', 'Receipt ID', 'Balance',
+    'Address Line 1', 'Address Line 2/District/Neighborhood', 'Town/City',
+    'State/Province/Region/County/Territory/Prefecture/Republic',
+    'Zip/Postal Code', 'Country', 'Contact Phone Number']
+
+# The Type in the CSV export of each transaction event code, as (the Type
+# of money received, of money sent); any other event code becomes the Type
+# 'PayPal event T....', which ends up in unprocessed.csv
+event_types = {
+    'T0000': ('Payment Received', 'Payment Sent'),
+    'T0003': ('Preapproved Payment Received', 'Preapproved Payment Sent'),
+    'T0006': ('Express Checkout Payment Received',
+              'Express Checkout Payment Sent'),
+    'T0007': ('Shopping Cart Payment Received', 'Shopping Cart Payment Sent'),
+    'T0013': ('Donation Received', 'Donation Sent'),
+    'T0300': ('Add Funds from a Bank Account',
+              'Add Funds from a Bank Account'),
+    'T0400': ('Withdraw Funds to Bank Account',
+              'Withdraw Funds to Bank Account'),
+    'T1106': ('Reversal', 'Reversal'),
+    'T1107': ('Refund', 'Refund'),
+    'T1201': ('Chargeback', 'Chargeback')}
+
+# The Status in the CSV export of each transaction status code
+event_statuses = {'S': 'Completed', 'P': 'Pending', 'V': 'Reversed',
+                  'D': 'Denied', 'F': 'Partially Refunded'}
+
+# The most days the API searches at once
+MAX_WINDOW_DAYS = 31
+
+
+def api_to_quickbooks(client, start_date, end_date, output_dir='.',
+                      workers=4, state_dir=None, page_size=500, **kwargs):
+    """
+    Fetch the transactions from start_date to end_date (inclusive) with
+    client, a TransactionSearchClient, and convert them with
+    paypal_to_quickbooks, writing output.iif, unprocessed.csv and its
+    reports to output_dir.  No CSV file is written in between.
+
+    workers, state_dir, page_size: as for fetch_transactions
+    kwargs: passed on to paypal_to_quickbooks (e.g. ledger_path, metrics,
+            accounts_path, streaming)
+
+    """
+    source = fetch_transactions(client, start_date, end_date, workers,
+                                state_dir, page_size)
+    for setting, file_name in [('iif_path', 'output.iif'),
+                               ('unprocessed_path', 'unprocessed.csv'),
+                               ('invoice_report_path',
+                                'invoice_payments.csv'),
+                               ('cart_report_path', 'cart_validation.csv')]:
+        if kwargs.get(setting) is None:
+            kwargs[setting] = os.path.join(output_dir, file_name)
+    return paypal_to_quickbooks(None, start_date=start_date,
+                                end_date=end_date, source=source, **kwargs)
+
+
+def fetch_transactions(client, start_date, end_date, workers=4,
+                       state_dir=None, page_size=500):
+    """
+    Fetch every transaction from start_date to end_date (inclusive) with
+    client, a TransactionSearchClient.
+
+    The API searches at most MAX_WINDOW_DAYS at a time, and returns the
+    transactions a page at a time, so the dates are split into windows and
+    the pages of every window fetched workers at a time: the first page of
+    each window (which says how many pages it has), then the rest.
+
+    state_dir: if given, each page is saved to this folder as it arrives,
+               and the pages already there aren't fetched again, so a
+               pull that was interrupted (or failed) picks up where it
+               left off
+
+    The API searches by UTC dates, but the rows are dated in each 
+    transaction's own time zone, as in the export, so a day more is
+    searched on either side, and then only the transactions dated from
+    start_date to end_date there are kept.
+
+    Returns a petl table of the transactions, laid out like the CSV export
+    (newest first, as in the export)
+
+    """
+    windows = date_windows(start_date - datetime.timedelta(1), 
+                           end_date + datetime.timedelta(1))
+    if state_dir is not None and not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+
+    def fetch_page(window, page):
+        data = client.search(window[0], window[1], page, page_size)
+        if state_dir is not None:
+            page_path = page_file_path(state_dir, window, page, page_size)
+            temp_path = page_path + '.tmp'
+            with io.open(temp_path, 'w', encoding='utf-8') as page_file:
+                json.dump(data, page_file)
+            os.replace(temp_path, page_path)
+        return data
+
+    def saved_page(window, page):
+        if state_dir is None:
+            return None
+        page_path = page_file_path(state_dir, window, page, page_size)
+        if not os.path.exists(page_path):
+            return None
+        with io.open(page_path, encoding='utf-8') as page_file:
+            return json.load(page_file)
+
+    # (window index, page) -> the transaction details on that page
+    pages = {}
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {}
+
+        def take(window_num, page, data):
+            pages[(window_num, page)] = data.get('transaction_details', [])
+            if page == 1:
+                # Now the rest of the window's pages are known
+                for next_page in range(2, data.get('total_pages', 1) + 1):
+                    get(window_num, next_page)
+
+        def get(window_num, page):
+            data = saved_page(windows[window_num], page)
+            if data is not None:
+                take(window_num, page, data)
+            else:
+                future = executor.submit(fetch_page, windows[window_num],
+                                         page)
+                pending[future] = (window_num, page)
+
+        for window_num in range(len(windows)):
+            get(window_num, 1)
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window_num, page = pending.pop(future)
+                    take(window_num, page, future.result())
+        except BaseException:
+            # Don't start on the pages not yet fetched
+            for future in pending:
+                future.cancel()
+            raise
+
+    details = [detail for key in sorted(pages) for detail in pages[key]
+               if start_date <= initiation_time(detail).date() <= end_date]
+    # Newest first, like the export (the sort is stable, so transactions
+    # at the same moment stay in the API's order)
+    details.sort(key=lambda detail: detail['transaction_info'].get(
+                 'transaction_initiation_date', ''), reverse=True)
+    refunded = refunded_payments(details)
+    rows = [row for detail in details 
+            for row in transaction_rows(detail, refunded)]
+    return etl.wrap([list(export_header)] + rows)
+
+
+def date_windows(start_date, end_date, window_days=MAX_WINDOW_DAYS):
+    """
+    Split the dates from start_date to end_date (inclusive) into windows
+    of at most window_days, as a list of (first date, last date) pairs
+
+    """
+    windows = []
+    while start_date <= end_date:
+        last_date = min(end_date,
+                        start_date + datetime.timedelta(window_days - 1))
+        windows.append((start_date, last_date))
+        start_date = last_date + datetime.timedelta(1)
+    return windows
+
+
+def page_file_path(state_dir, window, page, page_size):
+    """
+    The file in state_dir that fetch_transactions saves a page to
+
+    """
+    return os.path.join(state_dir, '%s-%s-%d-%05d.json' % (
+        window[0].strftime('%Y%m%d'), window[1].strftime('%Y%m%d'),
+        page_size, page))
+
+
+def initiation_time(detail):
+    """
+    When a transaction from the API (an item of transaction_details) was
+    initiated, as a datetime in its own time zone
+
+    """
+    return datetime.datetime.strptime(
+        detail['transaction_info']['transaction_initiation_date'], 
+        '%Y-%m-%dT%H:%M:%S%z')
+
+
+def refunded_payments(details):
+    """
+    The payments among details (the transaction_details from the API) 
+    refunded by a Refund among them, i.e. whose Transaction ID is its 
+    paypal_reference_id: their Transaction ID -> their fee, as a string
+
+    """
+    fees = dict((detail['transaction_info'].get('transaction_id'),
+                 detail['transaction_info'].get('fee_amount', {}).get(
+                     'value', '0'))
+                for detail in details)
+    refunded = {}
+    for detail in details:
+        info = detail['transaction_info']
+        reference = info.get('paypal_reference_id')
+        if info.get('transaction_event_code') == 'T1107' and reference in fees:
+            refunded[reference] = fees[reference]
+    return refunded
+
+
+def transaction_rows(detail, refunded=None):
+    """
+    The rows of the CSV export for one transaction from the API (an item
+    of transaction_details): the transaction, then a Shopping Cart Item
+    for each item in its cart
+
+    refunded: the payments refunded, as returned by refunded_payments.
+              The API reports them by their status (Reversed, for one 
+              thing), but the export as Refunded, with a Cancelled Fee for
+              the part of the fee PayPal keeps after its Refund, so that
+              the refunds net out in eliminate_cancellations.
+
+    """
+    if refunded is None:
+        refunded = {}
+    info = detail.get('transaction_info', {})
+    payer = detail.get('payer_info', {})
+    shipping = detail.get('shipping_info', {})
+    address = shipping.get('address', payer.get('address', {}))
+    items = detail.get('cart_info', {}).get('item_details', [])
+
+    initiated = initiation_time(detail)
+    offset = int(initiated.utcoffset().total_seconds() // 60)
+    payer_name = payer.get('payer_name', {})
+    name = payer_name.get('alternate_full_name') or ' '.join(
+        part for part in [payer_name.get('given_name'),
+                          payer_name.get('surname')] if part)
+    gross = info.get('transaction_amount', {}).get('value', '')
+    fee = info.get('fee_amount', {}).get('value', '0')
+    net = ''
+    if gross:
+        net = format_amount(Decimal(gross) + Decimal(fee or '0'))
+    phone = payer.get('phone_number', {}).get('national_number', '')
+
+    row = dict.fromkeys(export_header, '')
+    row.update({
+        'Date': '%d/%d/%d' % (initiated.month, initiated.day,
+                              initiated.year),
+        'Time': initiated.strftime('%H:%M:%S'),
+        'Time Zone': 'GMT%s%02d:%02d' % ('-' if offset < 0 else '+',
+                                         abs(offset) // 60,
+                                         abs(offset) % 60),
+        'Name': name or shipping.get('name', ''),
+        'Type': export_type(info.get('transaction_event_code', ''), gross),
+        'Status': event_statuses.get(info.get('transaction_status'),
+                                     info.get('transaction_status', '')),
+        'Currency': info.get('transaction_amount', {}).get(
+            'currency_code', ''),
+        'Gross': gross, 'Fee': fee, 'Net': net,
+        'From Email Address': payer.get('email_address', ''),
+        'Transaction ID': info.get('transaction_id', ''),
+        'Reference Txn ID': info.get('paypal_reference_id', ''),
+        'Invoice Number': info.get('invoice_id', ''),
+        'Custom Number': info.get('custom_field', ''),
+        'Balance': info.get('ending_balance', {}).get('value', ''),
+        'Address Line 1': address.get('line1', ''),
+        'Address Line 2/District/Neighborhood': address.get('line2', ''),
+        'Town/City': address.get('city', ''),
+        'State/Province/Region/County/Territory/Prefecture/Republic':
+            address.get('state', ''),
+        'Zip/Postal Code': address.get('postal_code', ''),
+        'Country': address.get('country_code', ''),
+        'Contact Phone Number': phone})
+    if items:
+        row['Item Title'] = 'Shopping Cart'
+        row['Quantity'] = str(len(items))
+    if row['Transaction ID'] in refunded:
+        # (And so are its items)
+        row['Status'] = 'Refunded'
+    rows = [row]
+
+    reference = row['Reference Txn ID']
+    if row['Type'] == 'Refund' and reference in refunded:
+        kept_fee = -(Decimal(refunded[reference] or '0') + 
+                     Decimal(fee or '0'))
+        if kept_fee:
+            fee_row = dict.fromkeys(export_header, '')
+            for field in ['Date', 'Time', 'Time Zone', 'Currency', 
+                          'Transaction ID', 'Reference Txn ID']:
+                fee_row[field] = row[field]
+            fee_row.update({'Name': 'PayPal', 'Type': 'Cancelled Fee', 
+                            'Status': 'Completed', 'Gross': '0.00', 
+                            'Fee': format_amount(kept_fee), 
+                            'Net': format_amount(kept_fee)})
+            rows.append(fee_row)
+
+    for item in items:
+        item_row = dict(row)
+        amount = item.get('total_item_amount', item.get('item_amount', {}))
+        item_row.update({'Type': 'Shopping Cart Item',
+                         'Gross': amount.get('value', ''), 'Fee': '',
+                         'Net': '', 'Balance': '',
+                         'Item Title': item.get('item_name', ''),
+                         'Item ID': item.get('item_code', ''),
+                         'Quantity': item.get('item_quantity', '1')})
+        rows.append(item_row)
+
+    return [[row[field] for field in export_header] for row in rows]
+
+
+def export_type(event_code, gross):
+    """
+    The Type in the CSV export of a transaction with event_code, for which
+    the amount gross (a string) was received, or sent if it's negative
+
+    """
+    if event_code not in event_types:
+        return 'PayPal event ' + event_code
+    received_type, sent_type = event_types[event_code]
+    return sent_type if gross.startswith('-') else received_type
+
+
+def format_amount(amount):
+    """
+    An amount (a Decimal) written as the API and the export write money
+
+    """
+    return '%.2f' % amount
+
+
+class APIError(Exception):
+    """
+    The API refused a request, or kept failing it
+
+    """
+    def __init__(self, status, message):
+        Exception.__init__(self, 'HTTP ' + str(status) + ': ' + message)
+        self.status = status
+
+
+class TransactionSearchClient(object):
+    """
+    A client for a PayPal Transaction Search style REST API at base_url,
+    e.g. https://api-m.paypal.com or a local stub server.
+
+    It authenticates with the OAuth client credentials client_id and
+    client_secret (fetching a new access token whenever the old one
+    expires), or else with a given access_token.
+
+    Requests go over a pool of up to max_connections keep-alive
+    connections, and are held to at most rate per second (in bursts of
+    up to burst).  A request that is throttled (429) or fails on the
+    server's side (5xx), or whose connection drops, is retried up to
+    retries times, waiting as long as the server's Retry-After asks, or
+    else backing off from backoff seconds.
+
+    """
+    search_path = '/v1/reporting/transactions'
+    token_path = '/v1/oauth2/token'
+
+    def __init__(self, base_url, client_id=None, client_secret=None,
+                 access_token=None, max_connections=4, rate=10.0, burst=5,
+                 timeout=60.0, retries=5, backoff=1.0):
+        self.pool = ConnectionPool(base_url, max_connections, timeout)
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.access_token = access_token
+        self.token_lock = threading.Lock()
+        self.retries = retries
+        self.backoff = backoff
+
+    def search(self, start_date, end_date, page=1, page_size=500):
+        """
+        One page of the transactions from start_date to end_date
+        (inclusive, in UTC), as the decoded JSON
+
+        """
+        params = {'start_date': start_date.strftime('%Y-%m-%dT00:00:00-0000'),
+                  'end_date': end_date.strftime('%Y-%m-%dT23:59:59-0000'),
+                  'fields': 'all', 'page_size': page_size, 'page': page}
+        return self.get_json(self.search_path + '?' + urlencode(params))
+
+    def get_json(self, path):
+        """
+        GET path, and return the decoded JSON
+
+        """
+        token = self.token()
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                status, headers, body = self.pool.request(
+                    'GET', path, headers={
+                        'Authorization': 'Bearer ' + token,
+                        'Accept': 'application/json'})
+            except (http.client.HTTPException, OSError) as error:
+                if attempt == self.retries:
+                    raise APIError(0, 'connection failed: ' + str(error))
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            if status == 200:
+                return json.loads(body.decode('utf-8'))
+            if status == 401 and attempt < self.retries and \
+               self.client_id is not None:
+                # The token has expired
+                token = self.token(expired=token)
+                continue
+            if (status == 429 or status >= 500) and attempt < self.retries:
+                retry_after = headers.get('Retry-After')
+                time.sleep(float(retry_after) if retry_after is not None
+                           else self.backoff * 2 ** attempt)
+                continue
+            raise APIError(status, body.decode('utf-8', 'replace')[:500])
+
+    def token(self, expired=None):
+        """
+        The access token, fetching a new one first if there's none yet, or
+        if it's still expired (so that threads finding it expired at the
+        same time only fetch one)
+
+        """
+        with self.token_lock:
+            if self.access_token is not None and \
+               self.access_token != expired:
+                return self.access_token
+            if self.client_id is None:
+                raise APIError(401, 'no access token or client credentials')
+            credentials = base64.b64encode(
+                (self.client_id + ':' +
+                 (self.client_secret or '')).encode('utf-8'))
+            self.rate_limiter.acquire()
+            status, headers, body = self.pool.request(
+                'POST', self.token_path,
+                body=b'grant_type=client_credentials',
+                headers={'Authorization': 'Basic ' +
+                                          credentials.decode('ascii'),
+                         'Content-Type':
+                             'application/x-www-form-urlencoded',
+                         'Accept': 'application/json'})
+            if status != 200:
+                raise APIError(status, body.decode('utf-8', 'replace')[:500])
+            self.access_token = json.loads(body.decode('utf-8'))[
+                'access_token']
+            return self.access_token
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ConnectionPool(object):
+    """
+    Up to max_connections keep-alive HTTP(S) connections to the host of
+    base_url, each used by one request at a time
+
+    """
+    def __init__(self, base_url, max_connections=4, timeout=60.0):
+        url = urlsplit(base_url)
+        self.connection_class = (http.client.HTTPSConnection
+                                 if url.scheme == 'https' else
+                                 http.client.HTTPConnection)
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.idle = queue_module.LifoQueue()
+        # (Only so many connections exist at once)
+        self.slots = threading.BoundedSemaphore(max_connections)
+        # (Counted across the threads sharing the pool)
+        self.num_opened = 0
+        self.count_lock = threading.Lock()
+
+    def request(self, method, path, body=None, headers={}):
+        """
+        Send a request over a pooled connection, and read the whole
+        response
+
+        Returns status, headers (an http.client.HTTPMessage), body
+
+        """
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+                reused = True
+            except queue_module.Empty:
+                connection = self.open()
+                reused = False
+            try:
+                try:
+                    return self.send(connection, method, path, body,
+                                     headers)
+                except (http.client.RemoteDisconnected,
+                        ConnectionResetError, BrokenPipeError):
+                    if not reused:
+                        raise
+                    # The server closed the idle connection; start afresh
+                    connection.close()
+                    connection = self.open()
+                    return self.send(connection, method, path, body,
+                                     headers)
+            except BaseException:
+                connection.close()
+                raise
+            finally:
+                if connection.sock is not None:
+                    self.idle.put(connection)
+
+    def open(self):
+        with self.count_lock:
+            self.num_opened += 1
+        return self.connection_class(self.host, self.port,
+                                     timeout=self.timeout)
+
+    def send(self, connection, method, path, body, headers):
+        connection.request(method, self.prefix + path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        if response.will_close:
+            connection.close()
+        return response.status, response.msg, data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue_module.Empty:
+                return
+
+
+class RateLimiter(object):
+    """
+    A token bucket, shared by threads: acquire blocks as needed to keep to
+    rate calls per second on average, in bursts of at most burst
+
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
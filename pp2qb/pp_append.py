@@ -10,20 +10,106 @@ append_sales_as_deposits
 append_invoices
 append_TicketLeap_fees
 
-+ one "private" method:
++ what append_invoices matches the payments for the invoices with:
 
-get_tables_from_mapping
+InvoiceMatcher
+print_unconverted_invoices
+
++ some "private" helpers:
+
+DepositConverter
+FeeConverter
+InvoiceConverter
+invoice_quantity
+invoice_price
+format_deposits
+get_carts
+cart_order
+TypeRanks
+compile_mapping
+MappedRecord
 
 """
 
-import petl as etl
-import csv
+import io, os, csv, operator
+from concurrent.futures import ProcessPoolExecutor
+from petl.compat import numeric_types
+from .pp_iif import format_iif_rows
+from .pp_classify import AccountClassifier, load_account_rules
+from .pp_helper import cents_to_dollars
 
 
-def append_sales_as_deposits(paypal, iif_path):
+def append_sales_as_deposits(paypal, iif, workers=1, classifier=None,
+                             exclude=()):
     """
     Take a paypal csv file (already sucked into PETL) and spit out
-    the deposits
+    the deposits to iif, an IIFWriter
+
+    classifier, an AccountClassifier, decides the class and account of each
+    item sold (by default, with the rules in accounts.csv).
+
+    exclude: the Transaction IDs of carts to leave unprocessed (e.g. those
+             that failed validate_carts)
+
+    With workers > 1 the carts are split into chunks, each converted in a 
+    separate process; the chunks are written back in their original order
+    so the output is identical to a serial run.
+
+    Return the paypal table, with the cart payments processed (and their
+    cart items) claimed.
+    
+    """
+    # PREPARE CART PAYMENTS AND CART ITEMS
+    # Sales receipts are organized in the CSV file as a row to summarize,
+    # (cart payment), plus one or more rows for each of the items purchased.
+    # Group the payment and item rows of each cart by Transaction ID in
+    # a single pass, rather than re-scanning the whole table for every cart
+    carts = get_carts(paypal, DepositConverter.payment_source_fields, 
+                      DepositConverter.item_source_fields)
+    if exclude:
+        carts = [cart for cart in carts if cart[0] not in exclude]
+
+    # Abort if no sales occurred
+    if len(carts) == 0:
+        return paypal
+
+    # WRITE THE IIF FILE
+    converter = DepositConverter(classifier)
+    iif.write_header(converter.header_rows())
+
+    if workers > 1:
+        # A cart is never split across two chunks.  Several chunks per 
+        # worker keep the workers evenly loaded.
+        chunk_size = max(1, len(carts) // (workers * 4))
+        chunks = [carts[i:i + chunk_size] 
+                  for i in range(0, len(carts), chunk_size)]
+        with ProcessPoolExecutor(workers) as executor:
+            # map returns the results in the order of the chunks
+            for iif_text in executor.map(format_deposits, chunks, 
+                                         [converter.classifier.rules] * 
+                                         len(chunks)):
+                iif.write_text(iif_text)
+    else:
+        # Write each transaction to the IIF file
+        for tranID, payment_rows, item_rows in carts:
+            iif.write_block(converter.block(payment_rows, item_rows))
+
+    # Claim the cart payments we just processed, along with their cart items
+    paypal.claim_transactions([tranID for tranID, _, _ in carts], 
+                              'append_sales_as_deposits')
+    return paypal
+
+
+class DepositConverter(object):
+    """
+    Convert TicketLeap sales (a cart payment plus its cart items) into 
+    QuickBooks DEPOSIT transactions.
+
+    The source/dest mappings are compiled once, when the converter is 
+    created, and reused for every cart.
+
+    classifier, an AccountClassifier, decides the class and account of each
+    item sold (by default, with the rules in accounts.csv).
     
     """
     # SPECIFY SOURCE/DEST FIELD NAMES
@@ -43,93 +129,112 @@ def append_sales_as_deposits(paypal, iif_path):
     spl_fields  = ['!SPL', 'SPLID', 'TRNSTYPE', 'DATE', 'ACCNT', 'NAME', 
                    'CLASS', 'AMOUNT', 'DOCNUM', 'MEMO', 'CLEAR', 'PAYMETH']
 
-    #fee_acct = 'Operational Expenses:Association Administration:Bank Fees:PayPal Fees'
-    fee_acct = 'Competition Expenses:Sales:Ticketing:PayPal Fees'
-    discount_acct = 'Competition Expenses:Advertising & Sponsorship:Promotions:Early Bird'
-
-    # SPECIFY SOURCE/DEST MAPPINGS
-    # Here's how the QuickBooks file really maps to PayPal
-    trns_map = {}
-    trns_map['!TRNS'] = lambda r: 'TRNS'
-    trns_map['TRNSID'] = lambda r: ' '    
-    trns_map['TRNSTYPE'] = lambda r: 'DEPOSIT'
-    trns_map['NAME'] = lambda r: r['Name']
-    trns_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y') #'{dt.month}/{dt.day}/{dt.year}'.format(dt=r['Date'])
-    trns_map['ACCNT'] = lambda r: 'PayPal Account'
-    trns_map['CLASS'] = lambda r: ''  # The real class is in the split items
-    trns_map['AMOUNT'] = lambda r: round(r['Gross']-abs(r['Fee']), 2)
-    trns_map['MEMO'] = lambda r: 'TicketLeap ticket sale'
-    trns_map['CLEAR'] = lambda r: 'N'
-    
-    spl_map = {}
-    spl_map['!SPL'] = lambda r: 'SPL'
-    spl_map['TRNSTYPE'] = lambda r: 'DEPOSIT'
-    spl_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y') #'{dt.month}/{dt.day}/{dt.year}'.format(dt=r['Date'])
-    spl_map['CLEAR'] = lambda r: 'N'
-    spl_map['PAYMETH'] = lambda r: 'Paypal'
-
-    # The ticket sale
-    spl_map_sale = spl_map.copy()
-    spl_map_sale['NAME'] = lambda r: r['Name']
-    spl_map_sale['MEMO'] = lambda r: r['Item Title'] + ' ' + r['Item ID']
-    # For some reason QuickBooks wants the sale amount to be negative and the 
-    # FEE (see spl_map_fee below) to be positive!  Ah, QuickBooks...
-    spl_map_sale['AMOUNT'] = lambda r: round(-abs(r['Gross']), 2)
-
-    # The fee (associated with the payment)
-    spl_map_fee = spl_map.copy()
-    spl_map_fee['ACCNT'] = lambda r: fee_acct
-    spl_map_fee['MEMO'] = lambda r: 'Standard PayPal $0.30 + 2.9% for TicketLeap ticket sale fulfillment'
-    spl_map_fee['AMOUNT'] = lambda r: round(abs(r['Fee']), 2)
-
-    # The discount (associated with the payment)
-    spl_map_discount = spl_map.copy()
-    spl_map_discount['NAME'] = lambda r: r['Name']    
-    spl_map_discount['ACCNT'] = lambda r: discount_acct
-    spl_map_discount['MEMO'] = lambda r: 'Discount for buying early'
-    
-
-    # PREPARE CART PAYMENTS TABLE
-    # Sales receipts are organized in the CSV file as a row to summarize,
-    # (cart payment), plus one or more rows for each of the items purchased.
-    cart_payments = paypal.selecteq('Type', 'Shopping Cart Payment Received')
-    # Ignore refunds
-    cart_payments = cart_payments.selecteq('Status', 'Completed')
-
-    # Abort if no sales occurred
-    if cart_payments.nrows() == 0:
-        return paypal
-
-    cart_payments_cut = cart_payments.cut(*payment_source_fields)
-
-    # PREPARE CART ITEMS TABLE
-    cart_items = paypal.selecteq('Type', 'Shopping Cart Item')
-    cart_items_cut = cart_items.cut(*item_source_fields)
-
-    # WRITE THE IIF FILE
-    iif_file = open(iif_path, 'a')
-    writer = csv.writer(iif_file, delimiter='\t', lineterminator='\n')
-    # Write the .IIF header
-    writer.writerow(trns_fields + ['']*22)
-    writer.writerow(spl_fields + ['']*22)
-    writer.writerow(['!ENDTRNS'] + ['']*32)
-
-    # Write each transaction to the IIF file
-    for tranID in cart_payments.columns()['Transaction ID']:
-        cur_cart_payment = cart_payments_cut.selecteq('Transaction ID', tranID)
-        cur_cart_items = cart_items_cut.selecteq('Transaction ID', tranID)
+    def __init__(self, classifier=None):
+        if classifier is None:
+            classifier = AccountClassifier(load_account_rules())
+        self.classifier = classifier
+
+        payment_source_fields = self.payment_source_fields
+        item_source_fields = self.item_source_fields
+        trns_fields = self.trns_fields
+        spl_fields = self.spl_fields
+
+        #fee_acct = 'Operational Expenses:Association Administration:Bank Fees:PayPal Fees'
+        fee_acct = 'Competition Expenses:Sales:Ticketing:PayPal Fees'
+        discount_acct = 'Competition Expenses:Advertising & Sponsorship:Promotions:Early Bird'
+
+        # SPECIFY SOURCE/DEST MAPPINGS
+        # Here's how the QuickBooks file really maps to PayPal
+        # (a function of the source record, or just a constant value)
+        trns_map = {}
+        trns_map['!TRNS'] = 'TRNS'
+        trns_map['TRNSID'] = ' '
+        trns_map['TRNSTYPE'] = 'DEPOSIT'
+        trns_map['NAME'] = lambda r: r['Name']
+        trns_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y') #'{dt.month}/{dt.day}/{dt.year}'.format(dt=r['Date'])
+        trns_map['ACCNT'] = 'PayPal Account'
+        trns_map['CLASS'] = ''  # The real class is in the split items
+        trns_map['AMOUNT'] = lambda r: cents_to_dollars(r['Gross'] - 
+                                                        abs(r['Fee']))
+        trns_map['MEMO'] = 'TicketLeap ticket sale'
+        trns_map['CLEAR'] = 'N'
+
+        spl_map = {}
+        spl_map['!SPL'] = 'SPL'
+        spl_map['TRNSTYPE'] = 'DEPOSIT'
+        spl_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y') #'{dt.month}/{dt.day}/{dt.year}'.format(dt=r['Date'])
+        spl_map['CLEAR'] = 'N'
+        spl_map['PAYMETH'] = 'Paypal'
+
+        # The ticket sale
+        spl_map_sale = spl_map.copy()
+        spl_map_sale['NAME'] = lambda r: r['Name']
+        spl_map_sale['MEMO'] = lambda r: r['Item Title'] + ' ' + r['Item ID']
+        # For some reason QuickBooks wants the sale amount to be negative and the 
+        # FEE (see spl_map_fee below) to be positive!  Ah, QuickBooks...
+        spl_map_sale['AMOUNT'] = lambda r: -cents_to_dollars(abs(r['Gross']))
+
+        # The fee (associated with the payment)
+        spl_map_fee = spl_map.copy()
+        spl_map_fee['ACCNT'] = fee_acct
+        spl_map_fee['MEMO'] = 'Standard PayPal $0.30 + 2.9% for TicketLeap ticket sale fulfillment'
+        spl_map_fee['AMOUNT'] = lambda r: cents_to_dollars(abs(r['Fee']))
+
+        # The discount (associated with the payment)
+        spl_map_discount = spl_map.copy()
+        spl_map_discount['NAME'] = lambda r: r['Name']    
+        spl_map_discount['ACCNT'] = discount_acct
+        spl_map_discount['MEMO'] = 'Discount for buying early'
+
+
+        # COMPILE THE MAPPINGS
+        # Each is turned into a single function mapping a plain source row
+        # to a padded destination row; the constant fields are filled in 
+        # up front
+        self.map_trns = compile_mapping(payment_source_fields, trns_fields, 
+                                        trns_map, padding=22)
+        self.map_spl_fee = compile_mapping(payment_source_fields, spl_fields, 
+                                           spl_map_fee, padding=22)
+        self.map_spl_sale = compile_mapping(item_source_fields, spl_fields,
+                                            spl_map_sale, padding=22)
+        self.map_spl_discount = compile_mapping(payment_source_fields, 
+                                                spl_fields, spl_map_discount, 
+                                                padding=22)
+
+        self.item_title_idx = item_source_fields.index('Item Title')
+        self.payment_gross_idx = payment_source_fields.index('Gross')
+        self.item_gross_idx = item_source_fields.index('Gross')
+        self.class_idx = spl_fields.index('CLASS')
+        self.accnt_idx = spl_fields.index('ACCNT')
+        self.amount_idx = spl_fields.index('AMOUNT')
+
+        self.endtrns_row = ['ENDTRNS'] + ['']*32
+
+    def header_rows(self):
+        """
+        The .IIF header rows for a section of deposits
+
+        """
+        return [self.trns_fields + ['']*22,
+                self.spl_fields + ['']*22,
+                ['!ENDTRNS'] + ['']*32]
+
+    def block(self, payment_rows, item_rows):
+        """
+        Convert one cart into its TRNS ... ENDTRNS block of IIF rows
+
+        """
+        class_idx = self.class_idx
+        amount_idx = self.amount_idx
 
         #---------------
         # I think there should just be one payment line per transaction ID
-        assert(cur_cart_payment.nrows() == 1)
-
-        trns_table = get_tables_from_mapping(cur_cart_payment, 
-                                             trns_fields, trns_map)
-        trns_total = trns_table.values('AMOUNT')[0]
+        assert(len(payment_rows) == 1)
+        cart_payment = payment_rows[0]
 
         # Write the master payment line for the transaction
-        # We assume there's one row (see assert above)
-        writer.writerow(list(trns_table.data()[0]) + ['']*22)
+        # The whole TRNS ... ENDTRNS block is written out in one go
+        block = [self.map_trns(cart_payment)]
 
         #---------------
         # Handle the split lines: (1) the fee, and (2) the cart items,
@@ -139,60 +244,148 @@ def append_sales_as_deposits(paypal, iif_path):
         # one competition.  If not the only problem will be the fee will be 
         # partly misallocated.  That's not a big deal!)
 
-        item_class, item_account = qb_account(
-            cur_cart_items.values('Item Title')[0])
+        classify = self.classifier.classify
+        item_title_idx = self.item_title_idx
+        item_class, item_account = classify(item_rows[0][item_title_idx])
 
-        spl_map_fee['CLASS'] = lambda r: item_class
         # (1) The fee associated with the whole transaction.
-        spl_fee_table = get_tables_from_mapping(cur_cart_payment, 
-                                                spl_fields, spl_map_fee)
-        # Again we can assume there's one row (see assert above)
-        writer.writerow(list(spl_fee_table.data()[0]) + ['']*22) 
+        spl_fee_row = self.map_spl_fee(cart_payment)
+        spl_fee_row[class_idx] = item_class
+        block.append(spl_fee_row)
 
         # (2) Handle the split lines for the cart items
-        spl_sale_table = get_tables_from_mapping(cur_cart_items, 
-                                                 spl_fields, spl_map_sale)
-                             
-        spl_total = spl_fee_table.values('AMOUNT')[0]
-        spl_sale_data = spl_sale_table.records()
-        for item in spl_sale_data:
-            item_as_list = list(item)
+        # All the arithmetic is done in integer cents, so it is exact
+        items_total = 0
+        for item_row in item_rows:
+            spl_sale_row = self.map_spl_sale(item_row)
             # Figure out the account and class for this item
-            item_class, item_account = qb_account(item['MEMO'])
-            item_as_list[item.flds.index('CLASS')] = item_class
-            item_as_list[item.flds.index('ACCNT')] = item_account
+            item_class, item_account = classify(item_row[item_title_idx])
+            spl_sale_row[class_idx] = item_class
+            spl_sale_row[self.accnt_idx] = item_account
             # Record the sale lines itemizing what was in the cart
-            writer.writerow(item_as_list + ['']*22)
-            spl_total += item_as_list[item.flds.index('AMOUNT')]
+            block.append(spl_sale_row)
+            items_total += abs(item_row[self.item_gross_idx])
 
 
         # (3) The discount associated with the whole transaction. (if any)
         #     since paypal does not actually provide this as a separate field
-        #     we must infer it from the difference between the transaction
-        #     payment total and the split total
-        if(abs(trns_total + spl_total) >= 0.01):
-            spl_map_discount['CLASS'] = lambda r: item_class            
-            spl_map_discount['AMOUNT'] = \
-                lambda r: -round(trns_total + spl_total, 2)
-            spl_discount_table = get_tables_from_mapping(cur_cart_payment, 
-                                                         spl_fields, 
-                                                         spl_map_discount)
-            # Again we can assume there's one row (see assert above)
-            writer.writerow(list(spl_discount_table.data()[0]) + ['']*22) 
+        #     we must infer it from the difference between the payment 
+        #     gross and the total of the cart items (the fee is on both sides)
+        discount = items_total - cart_payment[self.payment_gross_idx]
+        if discount != 0:
+            spl_discount_row = self.map_spl_discount(cart_payment)
+            spl_discount_row[class_idx] = item_class
+            spl_discount_row[amount_idx] = cents_to_dollars(discount)
+            block.append(spl_discount_row)
 
         #---------------
         # Write each transactions' closing statement in the IIF
-        writer.writerow(['ENDTRNS'] + ['']*32)
+        block.append(self.endtrns_row)
+        return block
+
+
+def format_deposits(carts, rules=None):
+    """
+    Convert a chunk of carts, as returned by get_carts, into the text of 
+    their IIF deposit blocks.  This runs in a worker process, so it builds 
+    its own DepositConverter, classifying the items with rules (as returned
+    by load_account_rules).
+
+    """
+    converter = DepositConverter(AccountClassifier(rules) 
+                                 if rules is not None else None)
+    return format_iif_rows(row for tranID, payment_rows, item_rows in carts
+                           for row in converter.block(payment_rows, 
+                                                      item_rows))
+
+
+def get_carts(paypal, payment_source_fields, item_source_fields):
+    """
+    Group the completed cart payments and the cart items of a paypal table
+    (already sucked into PETL) by Transaction ID, in one pass over the table.
+
+    Returns a list with one (tranID, payment_rows, item_rows) triple per 
+    cart payment.  The rows are cut down to payment_source_fields and 
+    item_source_fields respectively.
 
-    iif_file.close()
+    The carts, and the items of each, are in the order the rows sort in 
+    (see cart_order), as they always have been, since a cart's fee and 
+    discount are classified like its first and last items.
+    
+    """
+    it = iter(paypal)
+    header = list(next(it))
+    type_idx = header.index('Type')
+    status_idx = header.index('Status')
+    tranID_idx = header.index('Transaction ID')
+    payment_getter = operator.itemgetter(*[header.index(f) for f in
+                                           payment_source_fields])
+    item_getter = operator.itemgetter(*[header.index(f) for f in
+                                        item_source_fields])
+
+    payments = []
+    items = {}
+    for row in it:
+        if row[type_idx] == 'Shopping Cart Payment Received':
+            # Ignore refunds
+            if row[status_idx] == 'Completed':
+                payments.append(row)
+        elif row[type_idx] == 'Shopping Cart Item':
+            items.setdefault(row[tranID_idx], []).append(row)
+    payments.sort(key=cart_order)
+
+    # Rows of a cart that shows up more than once are repeated, so the one
+    # payment per Transaction ID check in append_sales_as_deposits still fires
+    payments_by_tranID = {}
+    for row in payments:
+        payments_by_tranID.setdefault(row[tranID_idx], []).append(
+            payment_getter(row))
+
+    return [(row[tranID_idx], payments_by_tranID[row[tranID_idx]], 
+             [item_getter(item_row) for item_row in 
+              sorted(items.get(row[tranID_idx], []), key=cart_order)])
+            for row in payments]
+
+
+def cart_order(row):
+    """
+    The sort key putting cart payments, and the items of a cart, in the 
+    order they are converted in: that of the whole cleaned-up rows, as 
+    etl.complement used to sort the table before the deposits were made.
+
+    This orders rows just as petl's Comparable does (None first, then the
+    numbers, then everything else by type name and value), but as plain 
+    tuples, which sort far faster.
+
+    """
+    ranks = type_ranks
+    return tuple([ranks[type(value)] + (value,) for value in row])
 
-    # RETURN UNUSED ROWS
-    # Return the original paypal table, minus all the entries
-    # we just processed
-    paypal_without_cart_sales = etl.complement(paypal, cart_payments)
-    paypal_without_cart_sales = etl.complement(paypal_without_cart_sales,
-                                               cart_items)
-    return paypal_without_cart_sales
+
+class TypeRanks(dict):
+    """
+    What cart_order puts before a value of each type, to sort it as petl's
+    Comparable would: (0, '') for None, (1, '') for a number and (2, the 
+    type's name) for anything else
+
+    """
+    def __missing__(self, value_type):
+        if value_type is type(None):
+            rank = (0, '')
+        elif issubclass(value_type, numeric_types):
+            rank = (1, '')
+        # (As petl compares values of different types, by their type names)
+        elif issubclass(value_type, str):
+            rank = (2, 'unicode')
+        elif issubclass(value_type, bytes):
+            rank = (2, 'str')
+        else:
+            rank = (2, value_type.__name__)
+        self[value_type] = rank
+        return rank
+
+
+type_ranks = TypeRanks()
 
 
 def qb_account(item_title):
@@ -204,47 +397,404 @@ def qb_account(item_title):
 
     Note that this is only guaranteed to work for Ticketleap sales, not 
     PayPal invoices.
+
+    The rules are those in accounts.csv; to use others, classify with an
+    AccountClassifier instead.
     
     """
-    if 'Northern' in item_title or 'NLC' in item_title:
-        item_class = 'NLC'
-    else:
-        item_class = 'CCC'
-    
-    if 'Competitor' in item_title:
-        item_account = ('Competition Income:Competitors:'
-                       'Amateur Registration Fees')
-    else:
-        item_account = 'Competition Income:Sales:Tickets:Advance Tickets'
-        
-    return item_class, item_account
+    global default_classifier
+    if default_classifier is None:
+        default_classifier = AccountClassifier(load_account_rules())
+    return default_classifier.classify(item_title)
+
+
+# The AccountClassifier qb_account uses, once it has been needed
+default_classifier = None
 
 
-def append_invoices(paypal, iif_path):
+# The Types of row that may be the payment of an invoice
+invoice_payment_types = ['Payment Received']
+
+
+def append_invoices(paypal, iif, matcher, classifier=None):
     """
-    Take a paypal csv file (already sucked into PETL) and spit out
-    the invoices and payments received for them
+    Take a paypal table and append the invoices (an Invoice Sent plus the 
+    Invoice items sharing its Transaction ID) to iif, an IIFWriter, as 
+    QuickBooks INVOICE transactions.
+
+    Apparently a limitation of IIF files is that they can't associate a 
+    payment with an invoice, so the payments received for the invoices 
+    are matched to them by matcher, an InvoiceMatcher, instead, for its 
+    report of the matched payments to record against the invoices by hand.
+
+    The invoices, their items and the payments are found in one pass over
+    the Type column, and grouped and matched with dicts, so this stays
+    linear however many invoices there are.
+
+    classifier, an AccountClassifier, decides the class and account of each
+    invoice item, by the rules for invoices (by default, those in 
+    accounts.csv).
+
+    An invoice without items, having nothing to classify it by, is left
+    unprocessed (and listed in matcher's unconverted_tranIDs), along with
+    any payments for it.
+
+    Returns the paypal table, with the invoices (and their invoice items) 
+    and the payments matched to them claimed
     
     """
-    # TODO
-    # Apparently a limitation of IIF files is that they can't associate
-    # a payment with an invoice, so we might be better off manually recording
-    # these
-    # AH - well we can at least record the invoices
-    # we'll have to manually record the payments against them.
-    pass
+    type_column = paypal.column('Type')
+    tranID_column = paypal.column('Transaction ID')
+    invoice_rows = []
+    item_rows = {}
+    payment_rows = []
+    for row_num in paypal.row_nums():
+        row_type = type_column[row_num]
+        if row_type == 'Invoice Sent':
+            invoice_rows.append(row_num)
+        elif row_type == 'Invoice item':
+            item_rows.setdefault(tranID_column[row_num], []).append(row_num)
+        elif row_type in invoice_payment_types:
+            payment_rows.append(row_num)
+
+    # An invoice without items has no titles to classify it by, so it's 
+    # left unprocessed
+    matcher.unconverted_tranIDs.extend(
+        tranID_column[row_num] for row_num in invoice_rows
+        if tranID_column[row_num] not in item_rows)
+    invoice_rows = [row_num for row_num in invoice_rows
+                    if tranID_column[row_num] in item_rows]
+    if invoice_rows:
+        converter = InvoiceConverter(classifier)
+        iif.write_header(converter.header_rows())
+        tranID_idx = InvoiceConverter.invoice_source_fields.index(
+            'Transaction ID')
+        for invoice_row in paypal.cut_rows(
+                InvoiceConverter.invoice_source_fields, invoice_rows):
+            items = list(paypal.cut_rows(
+                InvoiceConverter.item_source_fields, 
+                item_rows[invoice_row[tranID_idx]]))
+            iif.write_block(converter.block(invoice_row, items))
+            matcher.add_invoice(invoice_row)
+
+        paypal.claim_transactions([tranID_column[row_num] 
+                                   for row_num in invoice_rows],
+                                  'append_invoices')
+
+    # Now match each payment, in the order they appear in the table
+    matched_rows = [row_num for row_num, payment_row in 
+                    zip(payment_rows, paypal.cut_rows(
+                        InvoiceMatcher.payment_source_fields, payment_rows))
+                    if matcher.match(payment_row)]
+    paypal.claim_transactions([tranID_column[row_num] 
+                               for row_num in matched_rows],
+                              'append_invoices')
     return paypal
 
 
-def append_TicketLeap_fees(paypal, iif_path):
+class InvoiceConverter(object):
+    """
+    Convert PayPal invoices (an Invoice Sent plus its Invoice items) into 
+    QuickBooks INVOICE transactions, charged to Accounts Receivable.
+
+    classifier, an AccountClassifier, decides the class and account of each
+    item invoiced, by its rules for invoices (by default, those in 
+    accounts.csv), which unlike the rules for sales have no default: an 
+    item none of them matches is an error, rather than silently booked as
+    tickets.
+
+    """
+    invoice_source_fields = ['Date', 'Name', 'Gross', 'Transaction ID', 
+                             'Invoice Number']
+
+    item_source_fields = ['Date', 'Name', 'Item Title', 'Quantity', 'Gross']
+
+    trns_fields = ['!TRNS', 'TRNSID', 'TRNSTYPE', 'DATE', 'ACCNT', 'NAME', 
+                   'CLASS', 'AMOUNT', 'DOCNUM', 'MEMO', 'CLEAR', 'TOPRINT', 
+                   'QNTY', 'PRICE']
+
+    spl_fields = ['!SPL', 'SPLID', 'TRNSTYPE', 'DATE', 'ACCNT', 'NAME', 
+                  'CLASS', 'AMOUNT', 'DOCNUM', 'MEMO', 'CLEAR', 'TOPRINT',
+                  'QNTY', 'PRICE']
+
+    def __init__(self, classifier=None):
+        if classifier is None:
+            classifier = AccountClassifier(load_account_rules())
+        self.classifier = classifier
+
+        # Here's how the QuickBooks file really maps to PayPal
+        # (a function of the source record, or just a constant value)
+        trns_map = {}
+        trns_map['!TRNS'] = 'TRNS'
+        trns_map['TRNSID'] = ' '
+        trns_map['TRNSTYPE'] = 'INVOICE'
+        trns_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y')
+        trns_map['ACCNT'] = 'Accounts Receivable'
+        trns_map['NAME'] = lambda r: r['Name']
+        # The invoice total is positive, and each item negative
+        trns_map['AMOUNT'] = lambda r: cents_to_dollars(r['Gross'])
+        trns_map['DOCNUM'] = lambda r: r['Invoice Number']
+        trns_map['MEMO'] = 'PayPal invoice'
+        trns_map['CLEAR'] = 'N'
+        trns_map['TOPRINT'] = 'N'
+
+        spl_map = {}
+        spl_map['!SPL'] = 'SPL'
+        spl_map['SPLID'] = ' '
+        spl_map['TRNSTYPE'] = 'INVOICE'
+        spl_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y')
+        spl_map['NAME'] = lambda r: r['Name']
+        spl_map['CLEAR'] = 'N'
+
+        # An invoice item
+        spl_map_item = spl_map.copy()
+        spl_map_item['MEMO'] = lambda r: r['Item Title']
+        spl_map_item['AMOUNT'] = lambda r: -cents_to_dollars(r['Gross'])
+        spl_map_item['QNTY'] = lambda r: invoice_quantity(r['Quantity'])
+        spl_map_item['PRICE'] = lambda r: invoice_price(r['Gross'], 
+                                                        r['Quantity'])
+
+        # Whatever of the invoice total its items don't account for
+        spl_map_rest = spl_map.copy()
+        spl_map_rest['DOCNUM'] = lambda r: r['Invoice Number']
+        spl_map_rest['MEMO'] = 'PayPal invoice'
+
+        self.map_trns = compile_mapping(self.invoice_source_fields, 
+                                        self.trns_fields, trns_map)
+        self.map_spl_item = compile_mapping(self.item_source_fields, 
+                                            self.spl_fields, spl_map_item)
+        self.map_spl_rest = compile_mapping(self.invoice_source_fields, 
+                                            self.spl_fields, spl_map_rest)
+
+        self.item_title_idx = self.item_source_fields.index('Item Title')
+        self.item_gross_idx = self.item_source_fields.index('Gross')
+        self.invoice_gross_idx = self.invoice_source_fields.index('Gross')
+        self.docnum_idx = self.spl_fields.index('DOCNUM')
+        self.class_idx = self.spl_fields.index('CLASS')
+        self.accnt_idx = self.spl_fields.index('ACCNT')
+        self.amount_idx = self.spl_fields.index('AMOUNT')
+
+        self.endtrns_row = ['ENDTRNS'] + ['']*13
+
+    def header_rows(self):
+        """
+        The .IIF header rows for a section of invoices
+
+        """
+        return [list(self.trns_fields), list(self.spl_fields), 
+                ['!ENDTRNS'] + ['']*13]
+
+    def block(self, invoice_row, item_rows):
+        """
+        Convert one invoice (its Invoice Sent row, and its Invoice item 
+        rows, of which there must be at least one, cut to 
+        invoice_source_fields and item_source_fields) into its TRNS ... 
+        ENDTRNS block of IIF rows
+
+        """
+        classify = self.classifier.classify_invoice
+        class_idx = self.class_idx
+        accnt_idx = self.accnt_idx
+        docnum_idx = self.docnum_idx
+        item_title_idx = self.item_title_idx
+
+        # The invoice is classified like its first item
+        trns_row = self.map_trns(invoice_row)
+        invoice_class, invoice_account = classify(
+            item_rows[0][item_title_idx] or '')
+        trns_row[class_idx] = invoice_class
+        block = [trns_row]
+
+        # (The TRNS and SPL rows have the same fields, so the same indices)
+        items_total = 0
+        for item_row in item_rows:
+            spl_item_row = self.map_spl_item(item_row)
+            item_class, item_account = classify(item_row[item_title_idx] or 
+                                                '')
+            spl_item_row[class_idx] = item_class
+            spl_item_row[accnt_idx] = item_account
+            spl_item_row[docnum_idx] = trns_row[docnum_idx]
+            block.append(spl_item_row)
+            items_total += item_row[self.item_gross_idx] or 0
+
+        # So that the invoice balances, any difference between its total
+        # and its items (all in integer cents, so exact) is split out too
+        rest = (invoice_row[self.invoice_gross_idx] or 0) - items_total
+        if rest != 0:
+            spl_rest_row = self.map_spl_rest(invoice_row)
+            spl_rest_row[class_idx] = invoice_class
+            spl_rest_row[accnt_idx] = invoice_account
+            spl_rest_row[self.amount_idx] = -cents_to_dollars(rest)
+            block.append(spl_rest_row)
+
+        block.append(self.endtrns_row)
+        return block
+
+
+def invoice_quantity(quantity):
+    """
+    The QNTY of an invoice item: negative, like its amount, and without a 
+    trailing .0 if it's a whole number
+
+    """
+    if quantity is None:
+        return ''
+    if quantity == int(quantity):
+        return -int(quantity)
+    return -quantity
+
+
+def invoice_price(gross, quantity):
+    """
+    The PRICE of each of an invoice item, in dollars
+
+    """
+    if not quantity or gross is None:
+        return ''
+    return cents_to_dollars(gross) / quantity
+
+
+class InvoiceMatcher(object):
+    """
+    Match payments received to the invoices they pay, by a hash join: 
+    each invoice is indexed by its Transaction ID and by its invoice 
+    number, so each payment is matched with a dict lookup or two, by its
+    Reference Txn ID (the Transaction ID of the invoice), or failing that
+    by its Invoice Number.  (If several invoices share that number, the 
+    one sent to the payer is taken; if that doesn't settle it, the 
+    payment isn't matched.)
+
+    The matches, in the order the payments were matched, are kept as the 
+    rows of a report (with report_header).
+
+    """
+    invoice_source_fields = InvoiceConverter.invoice_source_fields
+
+    payment_source_fields = ['Date', 'Name', 'Gross', 'Fee', 
+                             'Transaction ID', 'Invoice Number', 
+                             'Reference Txn ID']
+
+    report_header = ['Invoice Number', 'Invoice Transaction ID', 
+                     'Invoice Date', 'Name', 'Invoice Amount', 
+                     'Payment Transaction ID', 'Payment Date', 
+                     'Payment Gross', 'Payment Fee', 'Outstanding']
+
+    def __init__(self):
+        # Invoice Transaction ID -> [number, tranID, date, name, amount, 
+        #                            outstanding amount] (in cents)
+        self.invoices = {}
+        # Invoice number -> the invoices with that number
+        self.invoices_by_number = {}
+        self.report_rows = []
+        # The Transaction IDs of the invoices left unconverted
+        self.unconverted_tranIDs = []
+
+    def add_invoice(self, invoice_row):
+        """
+        Index an invoice, its Invoice Sent row cut to invoice_source_fields
+
+        """
+        date, name, gross, tranID, number = invoice_row
+        invoice = [number, tranID, date, name, gross or 0, gross or 0]
+        self.invoices[tranID] = invoice
+        if number:
+            self.invoices_by_number.setdefault(number, []).append(invoice)
+
+    def match(self, payment_row):
+        """
+        Match a payment, cut to payment_source_fields, to its invoice, and
+        record it in the report.
+
+        Returns True if it was matched
+
+        """
+        date, name, gross, fee, tranID, number, reference = payment_row
+        invoice = self.invoices.get(reference) if reference else None
+        if invoice is None and number:
+            candidates = self.invoices_by_number.get(number, [])
+            if len(candidates) > 1:
+                candidates = [candidate for candidate in candidates
+                              if candidate[3] == name]
+            if len(candidates) == 1:
+                invoice = candidates[0]
+        if invoice is None:
+            return False
+
+        invoice[5] -= gross or 0
+        self.report_rows.append(
+            [invoice[0], invoice[1], invoice[2], invoice[3], 
+             cents_to_dollars(invoice[4]), tranID, date, 
+             cents_to_dollars(gross or 0), 
+             '' if fee is None else cents_to_dollars(fee), 
+             cents_to_dollars(invoice[5])])
+        return True
+
+    def write_report(self, report_path):
+        """
+        Write the report of the matched payments to report_path, as CSV
+        (to a temporary file first, which then replaces report_path)
+
+        """
+        temp_path = report_path + '.tmp'
+        with io.open(temp_path, 'w', newline='') as report_file:
+            writer = csv.writer(report_file, lineterminator='\n')
+            writer.writerow(self.report_header)
+            writer.writerows(self.report_rows)
+        os.replace(temp_path, report_path)
+
+
+def print_unconverted_invoices(matcher):
+    """
+    Print a warning about the invoices an InvoiceMatcher lists as left 
+    unconverted, if any
+
+    """
+    if matcher.unconverted_tranIDs:
+        print("WARNING: " + str(len(matcher.unconverted_tranIDs)) + 
+              " invoices have no items to classify them by, so they won't "
+              "be converted, and are left in the unprocessed rows with any "
+              "payments for them")
+
+
+def append_TicketLeap_fees(paypal, iif):
     """
     Take a paypal csv file (already sucked into PETL) and append the
     the TicketLeap payments (the fees they charge us for using TicketLeap)
-    to the .IIF file
+    to iif, an IIFWriter
     
-    Return a slimmer paypal PETL table instance, with the rows associated
-    with TicketLeap payments removed.
+    Return the paypal table, with the rows associated with TicketLeap 
+    payments (and the cart items itemizing them) claimed.
     
+    """
+    # Find the TicketLeap payments in one pass over just the Type column
+    type_column = paypal.column('Type')
+    fee_rows = [row_num for row_num in paypal.row_nums()
+                if type_column[row_num] == 'Preapproved Payment Sent']
+
+    converter = FeeConverter()
+
+    # .IIF HEADER
+    iif.write_header(converter.header_rows())
+
+    # Now write every transaction, in one go
+    block = converter.block
+    iif.write_block(iif_row for row in 
+                    paypal.cut_rows(FeeConverter.source_fields, fee_rows)
+                    for iif_row in block(row))
+
+    # The cart items itemizing each TicketLeap payment share its Transaction 
+    # ID, so they are claimed along with it
+    tranID_column = paypal.column('Transaction ID')
+    paypal.claim_transactions([tranID_column[row_num] for row_num in fee_rows],
+                              'append_TicketLeap_fees')
+    return paypal
+
+
+class FeeConverter(object):
+    """
+    Convert TicketLeap payments (the fees they charge us for using 
+    TicketLeap) into QuickBooks CHECK transactions.
+
     """
     source_fields = ['Type', 'Date', 'Gross']
 
@@ -257,92 +807,113 @@ def append_TicketLeap_fees(paypal, iif_path):
                    'CLASS', 'AMOUNT', 'DOCNUM', 'CLEAR', 'QNTY', 'PRICE', 
                    'INVITEM', 'PAYMETH', 'TAXABLE', 'VALADJ', 'REIMBEXP']
 
-    # Here's how the QuickBooks file really maps to PayPal
-    trns_map = {}
-    trns_map['!TRNS'] = lambda r: 'TRNS'
-    trns_map['TRNSID'] = lambda r: ' '
-    trns_map['DOCNUM'] = lambda r: ' '
-    trns_map['NAMEISTAXABLE'] = lambda r: ' '
-    trns_map['NAME'] = lambda r: 'TicketLeap'
-    trns_map['TRNSTYPE'] = lambda r: 'CHECK'
-    trns_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y') #'{dt.month}/{dt.day}/{dt.year}'.format(dt=r['Date'])
-    trns_map['ACCNT'] = lambda r: 'PayPal Account'
-    trns_map['CLASS'] = lambda r: 'Other'
-    # For some reason QuickBooks requires that the cheque total amount be 
-    # negative, but each item is positive.
-    trns_map['AMOUNT'] = lambda r: -abs(r['Gross'])  
-    trns_map['CLEAR'] = lambda r: 'N'
-    trns_map['TOPRINT'] = lambda r: 'N'
-
-    spl_map = {}
-    spl_map['!SPL'] = lambda r: 'SPL'
-    spl_map['SPLID'] = lambda r: ' '
-    spl_map['TRNSTYPE'] = lambda r: 'CHECK'
-    spl_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y') #'{dt.month}/{dt.day}/{dt.year}'.format(dt=r['Date'])
-    spl_map['ACCNT'] = lambda r: 'Operational Expenses:Association ' + \
-                                 'Administration:Bank Fees:PayPal Fees'
-    spl_map['CLASS'] = lambda r: 'Other'
-    spl_map['AMOUNT'] = lambda r: abs(r['Gross'])
-    spl_map['CLEAR'] = lambda r: 'N'
-    spl_map['REIMBEXP'] = lambda r: 'NOTHING'
-
-
-    fees = paypal.selecteq('Type', 'Preapproved Payment Sent')
-    fees_cut = fees.cut(*source_fields)
-
-    trns_table = get_tables_from_mapping(fees_cut, trns_fields, trns_map)
-    spl_table = get_tables_from_mapping(fees_cut, spl_fields, spl_map)
-
-    iif_file = open(iif_path, 'a')
-    writer = csv.writer(iif_file, delimiter='\t', lineterminator='\n')
-
-    # .IIF HEADER
-    writer.writerow(list(trns_table.header()) + ['']*15)
-    writer.writerow(list(spl_table.header())  + ['']*15)
-    writer.writerow(['!ENDTRNS']+['']*31)
+    def __init__(self):
+        # Here's how the QuickBooks file really maps to PayPal
+        # (a function of the source record, or just a constant value)
+        trns_map = {}
+        trns_map['!TRNS'] = 'TRNS'
+        trns_map['TRNSID'] = ' '
+        trns_map['DOCNUM'] = ' '
+        trns_map['NAMEISTAXABLE'] = ' '
+        trns_map['NAME'] = 'TicketLeap'
+        trns_map['TRNSTYPE'] = 'CHECK'
+        trns_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y') #'{dt.month}/{dt.day}/{dt.year}'.format(dt=r['Date'])
+        trns_map['ACCNT'] = 'PayPal Account'
+        trns_map['CLASS'] = 'Other'
+        # For some reason QuickBooks requires that the cheque total amount be 
+        # negative, but each item is positive.
+        trns_map['AMOUNT'] = lambda r: -cents_to_dollars(abs(r['Gross']))
+        trns_map['CLEAR'] = 'N'
+        trns_map['TOPRINT'] = 'N'
+
+        spl_map = {}
+        spl_map['!SPL'] = 'SPL'
+        spl_map['SPLID'] = ' '
+        spl_map['TRNSTYPE'] = 'CHECK'
+        spl_map['DATE'] = lambda r: r['Date'].strftime('%m/%d/%Y') #'{dt.month}/{dt.day}/{dt.year}'.format(dt=r['Date'])
+        spl_map['ACCNT'] = 'Operational Expenses:Association ' + \
+                           'Administration:Bank Fees:PayPal Fees'
+        spl_map['CLASS'] = 'Other'
+        spl_map['AMOUNT'] = lambda r: cents_to_dollars(abs(r['Gross']))
+        spl_map['CLEAR'] = 'N'
+        spl_map['REIMBEXP'] = 'NOTHING'
+
+        self.map_trns = compile_mapping(self.source_fields, self.trns_fields, 
+                                        trns_map, padding=15)
+        self.map_spl = compile_mapping(self.source_fields, self.spl_fields, 
+                                       spl_map, padding=15)
+        self.endtrns_row = ['ENDTRNS']
+
+    def header_rows(self):
+        """
+        The .IIF header rows for a section of TicketLeap fees
+
+        """
+        return [self.trns_fields + ['']*15,
+                self.spl_fields + ['']*15,
+                ['!ENDTRNS']+['']*31]
+
+    def block(self, row):
+        """
+        Convert one TicketLeap payment (a row cut to source_fields) into 
+        its TRNS ... ENDTRNS block of IIF rows
+
+        """
+        return [self.map_trns(row), self.map_spl(row), self.endtrns_row]
+
+
+class MappedRecord(object):
+    """
+    A read-only view of a plain source row, so the functions in a 
+    source/dest map can look up its fields by name, e.g. r['Gross']
 
-    trns_data = trns_table.data()
-    spl_data = spl_table.data()
+    """
+    __slots__ = ('row', 'field_index')
 
-    # Now write each transaction one at a time
-    for row_num in range(len(trns_data)):
-        writer.writerow(list(trns_data[row_num]) + ['']*15)
-        writer.writerow(list(spl_data[row_num]) + ['']*15)
-        writer.writerow(['ENDTRNS'])
+    def __init__(self, row, field_index):
+        self.row = row
+        self.field_index = field_index
 
-    iif_file.close()
-   
-    return etl.complement(paypal, fees)    
+    def __getitem__(self, field):
+        return self.row[self.field_index[field]]
 
 
-def get_tables_from_mapping(source_table, dest_fields, source_dest_map):
+def compile_mapping(source_fields, dest_fields, source_dest_map, padding=0):
     """
-    Obtain a petl tables from a source petl table and some mappings
-    source_table: petl table
+    Compile a source/dest map into a single function that takes a plain
+    source row (a tuple ordered as source_fields) and returns a new list
+    holding the dest_fields, followed by padding empty fields.
+
+    source_fields: list
     dest_fields: list
-    source_dest_map: dict
-    
+    source_dest_map: dict of dest field -> function of the source record,
+                     or a constant.  Dest fields not in the map are ''.
+    padding: int
+
     Returns
-    dest_table: petl table
+    map_row: function
     
     """
-    source_fields = list(source_table.header())
-
-    # Build up trns_table and spl_table from the source_table
-    dest_table = source_table.addrownumbers()
-
-    # Add the new fields one at a time.  There might be a better 
-    # way to do this.
-    for field in dest_fields:
-        if field in source_dest_map:
-            dest_table = dest_table.addfield(field, source_dest_map[field])
-        else:
-            dest_table = dest_table.addfield(field, '')
-
-    # Cut out the original columns from the source_table to obtain
-    # the destination tables, trns_table and spl_table
-    dest_table = dest_table.cutout(*source_fields)
-    dest_table = dest_table.cutout('row')
-
-    return dest_table
-
+    field_index = dict((field, i) for i, field in enumerate(source_fields))
+
+    # Constant fields are folded into a template row, once; only the 
+    # fields that really depend on the source row are computed per row
+    template = []
+    computed_fields = []
+    for dest_num, field in enumerate(dest_fields):
+        value = source_dest_map.get(field, '')
+        if callable(value):
+            computed_fields.append((dest_num, value))
+            value = None
+        template.append(value)
+    template.extend(['']*padding)
+    computed_fields = tuple(computed_fields)
+
+    def map_row(row):
+        record = MappedRecord(row, field_index)
+        dest_row = template[:]
+        for dest_num, get_value in computed_fields:
+            dest_row[dest_num] = get_value(record)
+        return dest_row
+
+    return map_row
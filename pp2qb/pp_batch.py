@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Converting a whole batch of PayPal exports (e.g. every organization's, at
+month end) in one go, several at a time, with the account rules loaded
+once per worker rather than once per file:
+
+convert_batch
+find_jobs
+load_manifest
+
++ some "private" helpers (also used by pp_watch):
+
+convert_job
+file_job
+is_paypal_file
+warm_classifier
+warm_up
+parse_date
+main
+
+Usage, as a script:
+
+    python -m pp2qb.pp_batch FOLDER_OR_MANIFEST [--workers 4]
+                             [--output-dir out] [--start-date 2015-01-01]
+                             [--end-date 2015-01-31] [--accounts rules.csv]
+                             [--cache-dir cache] [--summary summary.json]
+                             [--skip-invalid-carts]
+
+"""
+
+import io, os, sys, csv, json, time, argparse, datetime, contextlib
+from concurrent.futures import ProcessPoolExecutor
+from .pptl2qb import paypal_to_quickbooks
+from .pp_metrics import RunMetrics
+from .pp_classify import AccountClassifier, load_account_rules
+
+
+# The settings each job may have, besides paypal_path; a job without one
+# gets convert_batch's default for it
+job_settings = ['iif_path', 'unprocessed_path', 'start_date', 'end_date',
+                'ledger_path', 'accounts_path', 'invoice_report_path',
+                'cart_report_path']
+
+# The AccountClassifier for each rule file (None for the default rules)
+# already loaded by this process, kept warm from one file to the next
+warm_classifiers = {}
+
+
+def convert_batch(jobs, workers=1, start_date=None, end_date=None,
+                  accounts_path=None, cache_dir=None,
+                  exclude_failed_carts=False):
+    """
+    Run paypal_to_quickbooks on each of jobs, workers at a time.
+
+    jobs: a list of dicts, each with a paypal_path and, optionally, any
+          of job_settings (as returned by find_jobs or load_manifest)
+    start_date, end_date, accounts_path: the defaults for jobs that don't
+                                         give their own
+    cache_dir, exclude_failed_carts: as for paypal_to_quickbooks, shared
+                                     by every job
+
+    Every job is run, even if some fail.  Each worker process keeps the
+    account rules it has loaded, and what it has learnt classifying item
+    titles, for the next file it converts.
+
+    Returns one summary dict per job, in the order of jobs: its paths,
+    'ok', 'error' (if not ok), 'seconds', 'rows', 'unprocessed_rows',
+    'warnings' (what paypal_to_quickbooks warned about) and 'stages'
+    (as recorded by a RunMetrics)
+
+    """
+    defaults = {'start_date': start_date, 'end_date': end_date,
+                'accounts_path': accounts_path}
+    filled_jobs = []
+    for job in jobs:
+        filled_job = dict((setting, defaults.get(setting))
+                          for setting in job_settings)
+        filled_job.update((setting, value) for setting, value in job.items()
+                          if value is not None)
+        filled_jobs.append(filled_job)
+    jobs = filled_jobs
+    accounts_paths = sorted(set(job['accounts_path'] for job in jobs),
+                            key=str)
+
+    if workers > 1 and len(jobs) > 1:
+        # Forked workers inherit the classifiers warmed up here; otherwise
+        # each worker loads them as it starts
+        warm_up(accounts_paths)
+        with ProcessPoolExecutor(min(workers, len(jobs)),
+                                 initializer=warm_up,
+                                 initargs=(accounts_paths,)) as executor:
+            return list(executor.map(convert_job, jobs,
+                                     [cache_dir] * len(jobs),
+                                     [exclude_failed_carts] * len(jobs)))
+
+    return [convert_job(job, cache_dir, exclude_failed_carts) 
+            for job in jobs]
+
+
+def convert_job(job, cache_dir=None, exclude_failed_carts=False):
+    """
+    Convert a single job of convert_batch, and return its summary
+
+    """
+    summary = {'paypal_path': job['paypal_path'],
+               'iif_path': job['iif_path'],
+               'unprocessed_path': job['unprocessed_path'],
+               'invoice_report_path': job['invoice_report_path'],
+               'cart_report_path': job['cart_report_path']}
+    metrics = RunMetrics()
+    output = io.StringIO()
+    start = time.perf_counter()
+    try:
+        # Keep the progress messages of concurrent jobs from interleaving
+        with contextlib.redirect_stdout(output):
+            paypal_to_quickbooks(job['paypal_path'], job['iif_path'],
+                                 job['unprocessed_path'],
+                                 job['start_date'], job['end_date'],
+                                 ledger_path=job['ledger_path'],
+                                 metrics=metrics, cache_dir=cache_dir,
+                                 classifier=warm_classifier(
+                                     job['accounts_path']),
+                                 invoice_report_path=job[
+                                     'invoice_report_path'],
+                                 cart_report_path=job['cart_report_path'],
+                                 exclude_failed_carts=exclude_failed_carts)
+        summary['ok'] = True
+    except Exception as error:
+        summary['ok'] = False
+        summary['error'] = type(error).__name__ + ': ' + str(error)
+    summary['seconds'] = time.perf_counter() - start
+
+    summary['iif_path'] = metrics.info.get('iif_path', job['iif_path'])
+    summary['unprocessed_path'] = metrics.info.get('unprocessed_path',
+                                                   job['unprocessed_path'])
+    summary['invoice_report_path'] = metrics.info.get(
+        'invoice_report_path', job['invoice_report_path'])
+    summary['cart_report_path'] = metrics.info.get(
+        'cart_report_path', job['cart_report_path'])
+    summary['rows'] = (metrics.stages[0]['rows_in']
+                       if metrics.stages else None)
+    summary['unprocessed_rows'] = (metrics.stages[-1]['rows_out']
+                                   if summary['ok'] else None)
+    summary['warnings'] = [line for line in output.getvalue().splitlines()
+                           if line.startswith('WARNING')]
+    summary['stages'] = metrics.stages
+    return summary
+
+
+def warm_classifier(accounts_path=None):
+    """
+    The AccountClassifier for the rules in accounts_path (by default,
+    pp2qb/accounts.csv), loaded only the first time it's asked for
+
+    """
+    if accounts_path not in warm_classifiers:
+        warm_classifiers[accounts_path] = AccountClassifier(
+            load_account_rules(accounts_path))
+    return warm_classifiers[accounts_path]
+
+
+def warm_up(accounts_paths):
+    """
+    Load the classifiers for each of accounts_paths ahead of the first
+    job (run as each worker process starts)
+
+    """
+    for accounts_path in accounts_paths:
+        warm_classifier(accounts_path)
+
+
+def find_jobs(folder, output_dir=None):
+    """
+    A job for each PayPal CSV file in folder (in name order), with its
+    output written to output_dir (by default, folder itself) as
+    <name>.iif, <name>_unprocessed.csv, <name>_invoice_payments.csv and
+    <name>_cart_validation.csv
+
+    """
+    return [file_job(os.path.join(folder, file_name), output_dir)
+            for file_name in sorted(os.listdir(folder))
+            if is_paypal_file(file_name)]
+
+
+def file_job(paypal_path, output_dir=None):
+    """
+    The job for the PayPal CSV file at paypal_path, with its output 
+    written to output_dir (by default, the file's own folder) under the
+    file's name, as find_jobs does
+
+    """
+    if output_dir is None:
+        output_dir = os.path.dirname(paypal_path)
+    name = os.path.splitext(os.path.basename(paypal_path))[0]
+    return {'paypal_path': paypal_path,
+            'iif_path': os.path.join(output_dir, name + '.iif'),
+            'unprocessed_path': os.path.join(output_dir, 
+                                             name + '_unprocessed.csv'),
+            'invoice_report_path': os.path.join(
+                output_dir, name + '_invoice_payments.csv'),
+            'cart_report_path': os.path.join(
+                output_dir, name + '_cart_validation.csv')}
+
+
+def is_paypal_file(file_name):
+    """
+    Whether file_name looks like a PayPal CSV export, rather than the 
+    output of an earlier batch
+
+    """
+    name, extension = os.path.splitext(file_name)
+    return extension.lower() == '.csv' and not name.endswith(
+        ('_unprocessed', '_invoice_payments', '_cart_validation'))
+
+
+def load_manifest(manifest_path):
+    """
+    The jobs listed in a CSV manifest, one per row, with a paypal_path
+    column and, optionally, columns for any of job_settings, e.g.
+
+    paypal_path,iif_path,start_date,end_date
+    nlc/paypal.csv,nlc/output.iif,2015-01-01,2015-01-31
+    ccc/paypal.csv,ccc/output.iif,,
+
+    Empty cells take convert_batch's defaults, and relative paths are
+    relative to the manifest's folder.
+
+    """
+    manifest_folder = os.path.dirname(os.path.abspath(manifest_path))
+    with io.open(manifest_path, newline='', encoding='utf-8') \
+            as manifest_file:
+        reader = csv.DictReader(manifest_file)
+        unknown = set(reader.fieldnames) - set(['paypal_path'] +
+                                               job_settings)
+        if 'paypal_path' not in reader.fieldnames or unknown:
+            raise ValueError(manifest_path + " must have a paypal_path "
+                             "column, and otherwise only the columns " +
+                             ', '.join(job_settings))
+        jobs = []
+        for row in reader:
+            job = {}
+            for setting, value in row.items():
+                value = value.strip()
+                if not value:
+                    continue
+                if setting.endswith('_date'):
+                    value = parse_date(value)
+                else:
+                    value = os.path.join(manifest_folder, value)
+                job[setting] = value
+            jobs.append(job)
+    return jobs
+
+
+def parse_date(text):
+    """
+    A date written as YYYY-MM-DD
+
+    """
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Convert a batch of PayPal CSV exports to QuickBooks')
+    parser.add_argument('source', help='a folder of PayPal CSV files, or '
+                                       'a CSV manifest of jobs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--output-dir', help='for a folder, where to write '
+                                             'the output files')
+    parser.add_argument('--start-date', type=parse_date)
+    parser.add_argument('--end-date', type=parse_date)
+    parser.add_argument('--accounts', help='the account rules CSV file')
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--summary', help='save the summary to this JSON '
+                                          'file')
+    parser.add_argument('--skip-invalid-carts', action='store_true',
+                        help='leave the carts that fail validation '
+                             'unprocessed, instead of converting them')
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.source):
+        jobs = find_jobs(args.source, args.output_dir)
+        if args.output_dir and not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+    else:
+        jobs = load_manifest(args.source)
+
+    summaries = convert_batch(jobs, args.workers, args.start_date,
+                              args.end_date, args.accounts, args.cache_dir,
+                              args.skip_invalid_carts)
+
+    for summary in summaries:
+        if summary['ok']:
+            print('%-40s %8d rows %6d unprocessed %8.2fs' %
+                  (summary['paypal_path'], summary['rows'],
+                   summary['unprocessed_rows'], summary['seconds']))
+            for warning in summary['warnings']:
+                print('    ' + warning)
+        else:
+            print('%-40s FAILED: %s' % (summary['paypal_path'],
+                                        summary['error']))
+
+    if args.summary:
+        with open(args.summary, 'w') as summary_file:
+            json.dump(summaries, summary_file, indent=2, sort_keys=True,
+                      default=str)
+            summary_file.write('\n')
+
+    return 0 if all(summary['ok'] for summary in summaries) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+A cache of the cleaned paypal data, in a compact binary columnar file, so
+that re-running over the same PayPal export (e.g. to try other dates or
+account rules) skips reading and cleaning up the CSV file altogether:
+
+cached_cleanup_paypal
+
++ reading and writing the cache files themselves:
+
+save_table
+load_table
+
++ some "private" helpers:
+
+cache_file_path
+file_digest
+encode_column
+date_key
+
+"""
+
+import io, os, sys, json, mmap, struct, hashlib, datetime
+from array import array
+from .pp_table import ColumnarTable, RunIndex, integer_columns
+from .pp_helper import cleanup_paypal
+
+
+# Bump this whenever cleanup_paypal (or the file layout) changes, so that
+# cache files written by earlier versions are rebuilt instead of trusted
+CACHE_VERSION = 2
+
+MAGIC = b'PP2QBTBL'
+# The magic, then the length of the JSON metadata that follows it
+PREAMBLE = struct.Struct('<8sQ')
+
+
+def cached_cleanup_paypal(source, paypal_path, cache_dir):
+    """
+    cleanup_paypal(source), where source is the petl table of the CSV file
+    paypal_path, but kept in a cache file in cache_dir.
+
+    The cache file is used as long as paypal_path has the same size and
+    modification time as when it was cached, or else the same SHA-256
+    hash (e.g. after being copied); otherwise it is rebuilt.  Loading it
+    maps the file into memory: the money columns are read straight from
+    it, without copying, and the Date column comes with its RunIndex
+    already built.
+
+    Returns paypal, from_cache
+
+    """
+    cache_path = cache_file_path(cache_dir, paypal_path)
+    stat = os.stat(paypal_path)
+
+    digest = None
+    if os.path.exists(cache_path):
+        source_info, paypal = load_table(cache_path)
+        if paypal is not None:
+            if (source_info['size'] == stat.st_size and
+                source_info['mtime_ns'] == stat.st_mtime_ns):
+                return paypal, True
+            digest = file_digest(paypal_path)
+            if source_info['sha256'] == digest:
+                return paypal, True
+
+    if digest is None:
+        digest = file_digest(paypal_path)
+    paypal = cleanup_paypal(source)
+
+    source_info = {'path': os.path.abspath(paypal_path),
+                   'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                   'sha256': digest}
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        save_table(paypal, cache_path, source_info)
+    except OSError as error:
+        # The conversion itself doesn't need the cache
+        print("WARNING: could not write the cache file " + cache_path +
+              ": " + str(error))
+    return paypal, False
+
+
+def save_table(table, cache_path, source_info, index_field='Date'):
+    """
+    Write every row of a ColumnarTable to cache_path, along with
+    source_info (a dict describing where it came from) and the RunIndex 
+    of index_field, whose values must be dates (or None).
+
+    The file is the magic, the length of the JSON metadata, the metadata,
+    then each column as a flat array, 8-byte aligned: integer columns as
+    they are, the other columns as an array of codes into their list of
+    distinct values (kept in the metadata).  It is written to a temporary
+    file which only replaces cache_path once complete.
+
+    """
+    num_rows = len(table.unclaimed)
+    blobs = []
+    column_info = []
+    for column in table.cols:
+        if isinstance(column, integer_columns):
+            info, blob = {'kind': 'int64'}, array('q', column)
+        else:
+            info, blob = encode_column(column)
+        column_info.append(info)
+        blobs.append(blob)
+
+    index = RunIndex.of_column(table.column(index_field), date_key)
+    num_runs = len(index.keys)
+    blobs.append(array('i', index.keys))
+    blobs.append(array('q', index.starts))
+    blobs.append(array('q', index.ends))
+
+    # Where each blob starts, after the metadata
+    offsets = []
+    offset = 0
+    for blob in blobs:
+        offsets.append(offset)
+        offset += -(-len(blob) * blob.itemsize // 8) * 8
+    for info, offset in zip(column_info, offsets):
+        info['offset'] = offset
+
+    metadata = json.dumps({'version': CACHE_VERSION,
+                           'byteorder': sys.byteorder,
+                           'source': source_info,
+                           'num_rows': num_rows,
+                           'data_length': offset,
+                           'header': list(table.header()),
+                           'columns': column_info,
+                           'index': {'field': index_field,
+                                     'num_runs': num_runs,
+                                     'keys_offset': offsets[-3],
+                                     'starts_offset': offsets[-2],
+                                     'ends_offset': offsets[-1]}}
+                          ).encode('utf-8')
+
+    temp_path = cache_path + '.tmp'
+    with io.open(temp_path, 'wb') as cache_file:
+        cache_file.write(PREAMBLE.pack(MAGIC, len(metadata)))
+        cache_file.write(metadata)
+        cache_file.write(b'\0' * (-cache_file.tell() % 8))
+        for blob in blobs:
+            blob.tofile(cache_file)
+            cache_file.write(b'\0' * (-len(blob) * blob.itemsize % 8))
+    os.replace(temp_path, cache_path)
+
+
+def load_table(cache_path):
+    """
+    Map a file written by save_table into memory, as a ColumnarTable
+    whose integer columns and index are memoryviews onto the file.  (The
+    mapping is copy-on-write, so e.g. eliminate_cancellations can still
+    change the money columns, without touching the file.)
+
+    Returns source_info, table, or None, None if the file isn't a cache
+    file from this version of pp2qb on this kind of machine
+
+    """
+    with io.open(cache_path, 'rb') as cache_file:
+        try:
+            mapped = mmap.mmap(cache_file.fileno(), 0,
+                               access=mmap.ACCESS_COPY)
+        except ValueError:
+            # An empty file
+            return None, None
+
+    if len(mapped) < PREAMBLE.size:
+        return None, None
+    magic, metadata_length = PREAMBLE.unpack_from(mapped)
+    if magic != MAGIC:
+        return None, None
+    metadata = json.loads(mapped[PREAMBLE.size:PREAMBLE.size +
+                                 metadata_length].decode('utf-8'))
+    if (metadata['version'] != CACHE_VERSION or
+        metadata['byteorder'] != sys.byteorder):
+        return None, None
+
+    data = memoryview(mapped)[PREAMBLE.size + metadata_length +
+                              (-(PREAMBLE.size + metadata_length) % 8):]
+    if len(data) < metadata['data_length']:
+        # Cut short, somehow
+        return None, None
+    num_rows = metadata['num_rows']
+
+    def view(offset, typecode, itemsize, length=num_rows):
+        return data[offset:offset + length * itemsize].cast(typecode)
+
+    columns = []
+    for info in metadata['columns']:
+        if info['kind'] == 'int64':
+            columns.append(view(info['offset'], 'q', 8))
+        else:
+            values = info['values']
+            if info['kind'] == 'date':
+                values = [None if value is None else
+                          datetime.date.fromordinal(value)
+                          for value in values]
+            columns.append(list(map(values.__getitem__,
+                                    view(info['offset'], 'i', 4))))
+
+    table = ColumnarTable(metadata['header'], columns)
+    index = metadata['index']
+    num_runs = index['num_runs']
+    table.indexes[index['field']] = RunIndex(
+        view(index['keys_offset'], 'i', 4, num_runs),
+        view(index['starts_offset'], 'q', 8, num_runs),
+        view(index['ends_offset'], 'q', 8, num_runs), date_key)
+    return metadata['source'], table
+
+
+def cache_file_path(cache_dir, paypal_path):
+    """
+    The cache file in cache_dir for the CSV file paypal_path
+
+    """
+    path_hash = hashlib.sha1(os.path.abspath(paypal_path).encode('utf-8'))
+    return os.path.join(cache_dir, os.path.splitext(os.path.basename(
+                        paypal_path))[0] + '-' + path_hash.hexdigest()[:12] +
+                        '.ppcache')
+
+
+def file_digest(path):
+    """
+    The SHA-256 hash of the file at path, as hex
+
+    """
+    digest = hashlib.sha256()
+    with io.open(path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encode_column(column):
+    """
+    Encode a list column as codes into its distinct values, which must be
+    all dates, or all strings or numbers (with None for missing values).
+
+    Returns info, codes: info is the column's metadata, and codes an array
+
+    """
+    codes_of = {}
+    codes = array('i', [codes_of.setdefault(value, len(codes_of))
+                        for value in column])
+    values = list(codes_of)
+
+    kinds = set(type(value) for value in values if value is not None)
+    if kinds == set([datetime.date]):
+        return ({'kind': 'date',
+                 'values': [None if value is None else value.toordinal()
+                            for value in values]}, codes)
+    if kinds <= set([str, int, float, bool]):
+        return {'kind': 'plain', 'values': values}, codes
+    raise TypeError("Can't cache a column of " +
+                    ', '.join(sorted(kind.__name__ for kind in kinds)))
+
+
+def date_key(value):
+    """
+    The key of a date in the cached RunIndex of the Date column: its 
+    ordinal, or 0 (before every date) if it's missing
+
+    """
+    return 0 if value is None else value.toordinal()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Classifying sold and invoiced items into a QuickBooks class and account by their title,
+according to a table of rules kept in a CSV file, so that each
+organization can keep its own rules without editing the code:
+
+AccountClassifier
+load_account_rules
+
++ the rules we use ourselves:
+
+default_accounts_path
+
++ some "private" helpers:
+
+normalize_rule
+
+"""
+
+import csv, io, os
+
+
+# The rules used when no other rule file is given
+default_accounts_path = os.path.join(os.path.dirname(__file__),
+                                     'accounts.csv')
+
+
+def load_account_rules(accounts_path=None):
+    """
+    Load the rules from a CSV file with the columns pattern, class, account
+    and, optionally, applies_to, e.g.
+
+    pattern,class,account,applies_to
+    Northern,NLC,,
+    Competitor,,Competition Income:Competitors:Amateur Registration Fees,
+    Membership,CCC,Membership Income:Membership Dues,invoice
+    ,CCC,Competition Income:Sales:Tickets:Advance Tickets,sale
+
+    An item's class comes from the first rule (in file order) whose pattern
+    appears in the item title and which gives a class; likewise for its
+    account.  An empty pattern matches every title, so rules with an empty
+    pattern at the end give the defaults.
+
+    A rule applies_to 'sale' only classifies the items sold (in carts), 
+    one applies_to 'invoice' only the items invoiced, and one with an 
+    empty applies_to (or in a file without that column) both.
+
+    Returns a list of (pattern, class, account, applies_to) tuples
+
+    """
+    if accounts_path is None:
+        accounts_path = default_accounts_path
+
+    with io.open(accounts_path, newline='', encoding='utf-8') as rules_file:
+        reader = csv.reader(rules_file)
+        header = [field.strip().lower() for field in next(reader)]
+        if header not in (rule_fields[:3], rule_fields):
+            raise ValueError(accounts_path + " must have the columns "
+                             "pattern, class, account (and optionally "
+                             "applies_to)")
+        rules = [normalize_rule(row) for row in reader if row]
+    for pattern, item_class, item_account, applies_to in rules:
+        if applies_to not in rule_applies_to:
+            raise ValueError(accounts_path + ": the rule for '" + pattern + 
+                             "' applies_to '" + applies_to + "', which "
+                             "isn't one of '', 'sale' or 'invoice'")
+    return rules
+
+
+# The columns of the rule files, and what the rules can apply to
+rule_fields = ['pattern', 'class', 'account', 'applies_to']
+rule_applies_to = ['', 'sale', 'invoice']
+
+
+def normalize_rule(rule):
+    """
+    A rule as a (pattern, class, account, applies_to) tuple, whether or 
+    not it gives applies_to
+
+    """
+    rule = tuple(rule)
+    if len(rule) == 3:
+        return rule + ('',)
+    return rule[:3] + (rule[3].strip().lower(),)
+
+
+class AccountClassifier(object):
+    """
+    Classify items by their title, according to rules (as returned by
+    load_account_rules): the items sold with classify, and the items 
+    invoiced with classify_invoice, each by the rules that apply to them.
+
+    Item titles repeat heavily (tens of thousands of tickets are sold under
+    a handful of titles), so each distinct title is only run through the
+    rules once; from then on classifying it is a single dict lookup.
+
+    """
+    def __init__(self, rules):
+        self.rules = [normalize_rule(rule) for rule in rules]
+        self.class_rules, self.account_rules = self.rules_for('sale')
+        (self.invoice_class_rules, 
+         self.invoice_account_rules) = self.rules_for('invoice')
+        self.classified = {}
+        self.invoice_classified = {}
+
+    def rules_for(self, applies_to):
+        """
+        The (pattern, class) and the (pattern, account) rules that apply
+        to applies_to ('sale' or 'invoice')
+
+        """
+        rules = [rule for rule in self.rules if rule[3] in ('', applies_to)]
+        return ([(pattern, item_class) for 
+                 pattern, item_class, item_account, _ in rules 
+                 if item_class],
+                [(pattern, item_account) for 
+                 pattern, item_class, item_account, _ in rules 
+                 if item_account])
+
+    def classify(self, item_title):
+        """
+        Returns item_class, item_account
+
+        """
+        try:
+            return self.classified[item_title]
+        except KeyError:
+            result = (self.first_match(self.class_rules, item_title,
+                                       'class'),
+                      self.first_match(self.account_rules, item_title,
+                                       'account'))
+            self.classified[item_title] = result
+            return result
+
+    def classify_invoice(self, item_title):
+        """
+        Returns item_class, item_account, for an item invoiced
+
+        """
+        try:
+            return self.invoice_classified[item_title]
+        except KeyError:
+            result = (self.first_match(self.invoice_class_rules, item_title,
+                                       'class', 'invoice'),
+                      self.first_match(self.invoice_account_rules, 
+                                       item_title, 'account', 'invoice'))
+            self.invoice_classified[item_title] = result
+            return result
+
+    def first_match(self, rules, item_title, what, applies_to='sale'):
+        """
+        The value of the first of rules whose pattern appears in item_title
+
+        """
+        for pattern, value in rules:
+            if pattern in item_title:
+                return value
+        raise ValueError("None of the account rules for " + applies_to + 
+                         "s gives a " + what + " for the item '" + 
+                         item_title + "'; add a rule, or a default rule "
+                         "with an empty pattern")
@@ -4,22 +4,91 @@ Created on Tue Mar 31 02:25:03 2015
 
 @author: Michael
 
-Three helper functions to cleanup and do basic extraction from the paypal data:
+Four helper functions to cleanup and do basic extraction from the paypal data:
 
 cleanup_paypal
 eliminate_cancellations
 get_customer_names
+get_name_conflicts
+
++ the warning about what get_name_conflicts finds:
+
+print_name_conflicts
+
++ the exception eliminate_cancellations raises when cancellations don't net:
+
+NettingError
+
++ the pieces of eliminate_cancellations, shared with the streaming mode:
+
+cancellation_actions
+netting_totals
+check_netting
+
++ the first, lazy half of cleanup_paypal:
+
+cleanup_paypal_fields
+
++ reading the CSV file itself, in whatever encoding PayPal exported it in:
+
+fromcsv_paypal
+detect_encoding
+latin_1_fallback
+
++ the converters cleanup_paypal applies to the Phone, Date and money 
+columns, and the way back from cents to dollars:
+
+convert_ppphone
+convert_ppdate
+convert_ppamount
+convert_ppcents
+cents_to_dollars
+
++ what runs those converters once per distinct value, for a stream of rows:
+
+memoized
+
++ what get_customer_names collects the customers with, and builds each
+!CUST row with:
+
+CustomerCollector
+customer_name_row
 
 """
 
 import petl as etl
-import datetime, time, string
+from petl.comparison import Comparable
+import io, codecs, datetime, string, operator, functools
+from collections import OrderedDict
+from .pp_table import materialize, MISSING
 
 
 def cleanup_paypal(paypal):
     """
     Take a paypal csv file (already sucked into PETL) and clean it up
+
+    Returns a ColumnarTable, so the CSV file is only read once.
     
+    """
+    paypal_clean = cleanup_paypal_fields(paypal)
+
+    # Evaluate everything so far in one pass over the CSV file, and hold 
+    # the result in memory, one list per column
+    paypal_clean = materialize(paypal_clean)
+
+    for field, converter, typecode in paypal_converters:
+        paypal_clean.convert_column(field, converter, typecode)
+
+    return paypal_clean
+
+
+def cleanup_paypal_fields(paypal):
+    """
+    Take a paypal csv file (already sucked into PETL) and tidy up its 
+    fields: their names, and which of them we keep.
+
+    Returns a lazy petl table, so nothing is read yet.
+
     """
     # Remove leading and trailing whitespace in the header row
     paypal_clean = paypal.setheader(list((x.strip() for x in paypal.header())))
@@ -37,11 +106,6 @@ def cleanup_paypal(paypal):
     paypal_clean = paypal_clean.rename('Address Line 2/District/Neighborhood',
                                        'Address Line 2')
 
-    # It seems that Quickbooks requires that phone numbers be entirely 
-    # composed of digits, e.g. 4035559195 instead of 403-555-9195
-    paypal_clean = paypal_clean.convert('Phone', 
-                       lambda v: ''.join(c for c in v if c in string.digits))
-
     # Get rid of columns that are not needed
     paypal_clean = paypal_clean.cutout('Time',
         'Shipping and Handling Amount', 'Insurance Amount', 'Sales Tax', 
@@ -50,52 +114,157 @@ def cleanup_paypal(paypal):
         'Invoice Id', 'Time Zone', 'Net', 'Balance', 'Counterparty Status', 
         'Address Status')
 
-    # Convert the 'Date' column to proper Python datetime-type dates
-    def convert_ppdate(paypal_date):
-        ex_struct_time = time.strptime(paypal_date, '%m/%d/%Y')
-        ex_date = datetime.date(ex_struct_time.tm_year, 
-                                ex_struct_time.tm_mon, 
-                                ex_struct_time.tm_mday)
-        return ex_date
+    return paypal_clean
+
+
+# The most of the file detect_encoding looks at
+ENCODING_SAMPLE_SIZE = 1 << 16
+
+
+def fromcsv_paypal(paypal_path, sample_size=ENCODING_SAMPLE_SIZE):
+    """
+    The PayPal CSV file at paypal_path as a (lazy) petl table, decoded 
+    according to detect_encoding (from its first sample_size bytes) as 
+    it's read.
+
+    The file is never rewritten, and there's no converted copy: a byte 
+    that isn't valid in the detected encoding beyond the sample is 
+    decoded as ISO-8859-1 (the encoding of older exports) by 
+    latin_1_fallback, without ever having to re-read the file.
+
+    """
+    return etl.fromcsv(paypal_path, 
+                       encoding=detect_encoding(paypal_path, sample_size),
+                       errors='pp2qb-latin-1')
 
-    paypal_clean = paypal_clean.convert('Date', convert_ppdate)
+
+def detect_encoding(paypal_path, sample_size=ENCODING_SAMPLE_SIZE):
+    """
+    The encoding of the file at paypal_path, judging by its byte order
+    mark if it has one, or else by whether its first sample_size bytes are
+    valid UTF-8: 'utf-8-sig', 'utf-16', 'utf-8' or 'latin-1'
+
+    """
+    with io.open(paypal_path, 'rb') as paypal_file:
+        sample = paypal_file.read(sample_size)
+
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        # (The sample may end partway through a character, unless it's
+        # the whole file)
+        codecs.getincrementaldecoder('utf-8')().decode(
+            sample, final=len(sample) < sample_size)
+    except UnicodeDecodeError:
+        return 'latin-1'
+    return 'utf-8'
+
+
+def latin_1_fallback(error):
+    """
+    The 'pp2qb-latin-1' codec error handler: decode the bytes error is 
+    about as ISO-8859-1 instead, and carry on
+
+    """
+    if not isinstance(error, UnicodeDecodeError):
+        raise error
+    return error.object[error.start:error.end].decode('latin-1'), error.end
+
+codecs.register_error('pp2qb-latin-1', latin_1_fallback)
+
+
+def convert_ppphone(paypal_phone):
+    """
+    It seems that Quickbooks requires that phone numbers be entirely 
+    composed of digits, e.g. 4035559195 instead of 403-555-9195
+
+    """
+    return ''.join(c for c in paypal_phone if c in string.digits)
+
+
+def convert_ppdate(paypal_date):
+    """
+    Convert a PayPal date like '4/9/2015' to a Python date
+
+    """
+    month, day, year = paypal_date.split('/')
+    ex_date = datetime.date(int(year), int(month), int(day))
 
     # Workaround to avoid the strange bug described here
     # Set all days before the 13th of any given month to the 13th of 
     # that month.
     # https://github.com/MichaelCurrie/TicketLeapToQuickBooks/issues/1
-    paypal_clean = paypal_clean.convert('Date',
-        lambda v: datetime.date(v.year, v.month, 13) if v.day < 13 else v)
+    if ex_date.day < 13:
+        ex_date = ex_date.replace(day=13)
 
-    # Convert all figures like "1,000.00" to "1000.00"
-    paypal_clean = paypal_clean.convert(('Gross', 'Fee', 'Quantity'),
-                                        lambda v: v.replace(',',''))
-    # Convert the money and quantity columns from string to float
-    paypal_clean = paypal_clean.convert(('Gross', 'Fee', 'Quantity'),
-                                        float)
+    return ex_date
 
-    return paypal_clean
 
+def convert_ppamount(paypal_amount):
+    """
+    Convert a PayPal figure like '1,000.00' to a float
+
+    """
+    return float(paypal_amount.replace(',', ''))
 
 
-def eliminate_cancellations(paypal_given):
+def convert_ppcents(paypal_amount):
     """
-    Eliminate the cancellations, except for the Cancelled Fee amounts 
-    associated with refunded Shopping Cart Payments Received.
-    Those remain, in the amount of $0.30.
-    
+    Convert a PayPal amount like '1,000.00' to an integer number of cents,
+    here 100000, so sums of money are exact
+
     """
+    return int(round(float(paypal_amount.replace(',', '')) * 100))
+
+
+def cents_to_dollars(cents):
+    """
+    Convert an integer number of cents back to a dollar figure, for output
+
+    """
+    return cents / 100
+
+
+# How cleanup_paypal converts the fields that aren't just text:
+# (field, converter, typecode of the array to store it in, if any)
+paypal_converters = [
+    ('Phone', convert_ppphone, None),
+    # Convert the 'Date' column to proper Python datetime-type dates
+    ('Date', convert_ppdate, None),
+    # Convert money like "1,000.00" to exact integer cents, 100000, stored 
+    # as arrays of 64-bit integers
+    ('Gross', convert_ppcents, 'q'),
+    ('Fee', convert_ppcents, 'q'),
+    # Convert the remaining figures like "1,000" to the float 1000.0
+    ('Quantity', convert_ppamount, None)]
+
+
+def memoized(converter, maxsize=65536):
+    """
+    Wrap a converter so it only runs once per distinct value among the
+    last maxsize, like ColumnarTable.convert_column, and so that a value
+    it fails on becomes None
+
+    """
+    @functools.lru_cache(maxsize)
+    def convert(value):
+        try:
+            return converter(value)
+        except Exception:
+            return None
+    return convert
+
+
+# The rows that cancel each other out, by (Type, Status), in groups that 
+# must each net to 0
+cancellation_groups = OrderedDict([
     # Type = 'Payment Sent', Status = 'Canceled'
     # cancels with
     # Type = 'Cancelled Payment', Status = 'Complete'
-    paypal = paypal_given.select(lambda r: r['Status'] in ['Canceled'] and 
-                                           r['Type'] in ['Payment Sent'],
-                           complement=True)
-
-    paypal = paypal.select(lambda r: r['Status'] in ['Completed'] and 
-                                     r['Type'] in ['Cancelled Payment'],
-                           complement=True)
-
+    ('cancelled payments', [('Payment Sent', 'Canceled'),
+                            ('Cancelled Payment', 'Completed')]),
     # Type = 'Shopping Cart Payment Received', Status = 'Refunded'
     # PLUS
     # Type = 'Payment Sent', Status = 'Refunded'
@@ -105,145 +274,302 @@ def eliminate_cancellations(paypal_given):
     #                 Status = 'Refunded')
     # but that little difference is handled by revising the amount of 
     # the PayPal Cancelled Fee
-    paypal = paypal.select(lambda r: r['Status'] in ['Refunded'] and 
-                r['Type'] in ['Shopping Cart Payment Received', 
-                              'Payment Sent'],
-                           complement=True)
-
-    paypal = paypal.select(lambda r: r['Status'] in ['Completed'] and 
-                                     r['Type'] in ['Refund'],
-                           complement=True)
-
-    # Grab a copy of just the cancelled trades so we can verify they net to 0
-    # We have to obtain the cancelled transactions before changing the 
-    # PayPal fee so the complement operation will work correctly
-    cancelled_transactions = etl.complement(paypal_given, paypal)
-
-    paypal = paypal.convert({'Fee': lambda v: -0.3, 'Gross': lambda v: 0}, 
-                            where=lambda r: r['Type'] == 'Cancelled Fee' and 
-                                            r['Name'] == 'PayPal' and
-                                            r['Status'] == 'Completed')
-
-    num_fee_refunds = paypal.select(lambda r: r['Type'] == 'Cancelled Fee' and 
-                                           r['Name'] == 'PayPal' and
-                                           r['Status'] == 'Completed').nrows()
-
-    # DEBUG: list the cancelled trades explicitly
-    #input_folder = 'C:\\Users\\Michael\\Desktop\\TicketLeapToQuickBooks'
-    #cancel_path = os.path.join(input_folder, 'cancelled_trades.csv')    
-    #cancelled_transactions.tocsv(cancel_path, write_header=True)
-
-    # Verify that our cancelled trades all net to 0    
-    # (We simply can't assert that the sum == 0 because of machine epsilon)
-    assert(abs(sum(cancelled_transactions.values('Gross').toarray())) < 0.01)
-
-    # The fees are supposed to cancel except for -num_fee_refunds * 0.3
-    assert(abs(sum(cancelled_transactions.values('Fee').toarray())-
-           -num_fee_refunds * 0.3) < 0.01)
-
-    # Finally, let's eliminate things that don't net against anything else
-    # but should still not appear in the transaction list:
-
-    # Ignore cancelled invoices (these don't net with anything but instead
+    ('refunds', [('Shopping Cart Payment Received', 'Refunded'),
+                 ('Payment Sent', 'Refunded'),
+                 ('Refund', 'Completed')])])
+
+# The rows that don't net against anything else but should still not 
+# appear in the transaction list, by (Type, Status):
+ignored_pairs = [
+    # Cancelled invoices (these don't net with anything but instead
     # should never appear against the balance at all)
-    paypal = paypal.select(lambda r: r['Status'] == 'Canceled' and 
-                              r['Type'] in ['Invoice Sent', 'Invoice item'],
-                           complement=True)
-
-    # Ignore refunded shopping cart items  (again these don't net with 
+    ('Invoice Sent', 'Canceled'), 
+    ('Invoice item', 'Canceled'),
+    # Refunded shopping cart items  (again these don't net with 
     # anything, they just serve to double-count the amount since they 
     # double with Shopping Cart Payment Received, so we must eliminate them)
-    paypal = paypal.select(lambda r: r['Type'] in ['Shopping Cart Item'] and
-                                     r['Status'] in ['Canceled', 'Refunded'],
-                                 complement=True)
+    ('Shopping Cart Item', 'Canceled'), 
+    ('Shopping Cart Item', 'Refunded')]
+
+# The PayPal fee refunds, whose amounts are revised
+fee_refund_pair = ('Cancelled Fee', 'Completed')
+
+
+class NettingError(ValueError):
+    """
+    Raised when cancelled transactions don't net to 0 as they should
+
+    """
+    pass
+
+
+def eliminate_cancellations(paypal):
+    """
+    Eliminate the cancellations, except for the Cancelled Fee amounts 
+    associated with refunded Shopping Cart Payments Received.
+    Those remain, in the amount of $0.30.
+
+    paypal must be a ColumnarTable, with Gross and Fee in cents; the 
+    eliminated rows are claimed (paypal.claimed('eliminate_cancellations') 
+    holds them), and the Cancelled Fee amounts are revised in place.
+
+    Every row is classified by its (Type, Status) in a single pass, which
+    also totals up each cancellation group, so we can verify they net to 0.
+    Raises NettingError, listing the groups that don't.
+    
+    """
+    actions = cancellation_actions()
+
+    type_column = paypal.column('Type')
+    status_column = paypal.column('Status')
+    name_column = paypal.column('Name')
+    gross_column = paypal.column('Gross')
+    fee_column = paypal.column('Fee')
+
+    eliminated_rows = []
+    num_fee_refunds = 0
+    totals = netting_totals()
+    for row_num in paypal.row_nums():
+        pair = (type_column[row_num], status_column[row_num])
+        if pair in actions:
+            eliminated_rows.append(row_num)
+            if actions[pair] is not None:
+                # A missing amount counts as 0
+                pair_totals = totals[pair]
+                if gross_column[row_num] != MISSING:
+                    pair_totals[0] += gross_column[row_num]
+                if fee_column[row_num] != MISSING:
+                    pair_totals[1] += fee_column[row_num]
+        elif pair == fee_refund_pair and name_column[row_num] == 'PayPal':
+            fee_column[row_num] = -30
+            gross_column[row_num] = 0
+            num_fee_refunds += 1
+
+    paypal.claim(eliminated_rows, 'eliminate_cancellations')
+
+    check_netting(totals, num_fee_refunds)
 
     return paypal
 
 
+def cancellation_actions():
+    """
+    Look up what eliminate_cancellations does with a row by its 
+    (Type, Status): the name of the cancellation group it belongs to, or 
+    None to just eliminate it.  Rows of any other (Type, Status) are kept.
+
+    """
+    actions = {}
+    for group, pairs in cancellation_groups.items():
+        for pair in pairs:
+            actions[pair] = group
+    for pair in ignored_pairs:
+        actions[pair] = None
+    return actions
+
+
+def netting_totals():
+    """
+    The running Gross and Fee totals (in cents) of each (Type, Status) in a
+    cancellation group, all starting at 0
+
+    """
+    return OrderedDict((pair, [0, 0]) 
+                       for pairs in cancellation_groups.values()
+                       for pair in pairs)
+
+
+def check_netting(totals, num_fee_refunds):
+    """
+    Check the totals accumulated by eliminate_cancellations, raising 
+    NettingError for the cancellation groups that don't net to 0.
+
+    """
+    # Verify that our cancelled trades all net to 0 (exactly, since the 
+    # amounts are integer cents).  The fees are supposed to cancel too, 
+    # except for -num_fee_refunds * $0.30
+    expected_fees = {'refunds': -num_fee_refunds * 30}
+    problems = []
+    for group, pairs in cancellation_groups.items():
+        gross = sum(totals[pair][0] for pair in pairs)
+        fee = sum(totals[pair][1] for pair in pairs)
+        expected_fee = expected_fees.get(group, 0)
+        if gross != 0 or fee != expected_fee:
+            breakdown = '; '.join(
+                '%s/%s Gross %s, Fee %s' % (pair + tuple(cents_to_dollars(
+                                                         total)
+                                                   for total in totals[pair]))
+                for pair in pairs)
+            problems.append('%s net to Gross %s, Fee %s (expected Fee %s): '
+                            '%s' % (group, cents_to_dollars(gross), 
+                                    cents_to_dollars(fee), 
+                                    cents_to_dollars(expected_fee), breakdown))
+    if problems:
+        raise NettingError('Cancelled transactions do not net to 0: ' + 
+                           ' | '.join(problems))
+
+
 def get_customer_names(paypal):
     """
     Take a paypal csv file (already sucked into PETL) and spit out
     a petl table of the unique customer names
     
+    The customers are collected in a single pass over paypal, and 
+    deduplicated by hashing their name, address and contact details, so 
+    memory grows with the number of unique customers, not of rows.  The 
+    !CUST fields are then computed just once per unique customer.
+
     """    
+    it = iter(paypal)
+    customers = CustomerCollector(next(it))
+    customers.add(it)
+    return customers.names()
+
+
+class CustomerCollector(object):
+    """
+    Collect the unique customers of paypal rows as they go by, e.g. a cart
+    at a time in the streaming mode, and build their !CUST rows at the end
+
+    """
     names_source_fields = ['Name', 'Email', 'To Email', 'Address Line 1', 
                            'Address Line 2', 'Town/City', 'Province', 
                            'Postal Code', 'Country', 'Phone']
+
+    def __init__(self, header):
+        header = list(header)
+        self.type_idx = header.index('Type')
+        self.get_source = operator.itemgetter(*[header.index(field) for 
+                                                field in 
+                                                self.names_source_fields])
+        self.customers = set()
+
+    def add(self, rows):
+        """
+        Add the customers of rows (plain data rows, without a header row)
+
+        """
+        type_idx = self.type_idx
+        get_source = self.get_source
+        customers = self.customers
+        for row in rows:
+            row_type = row[type_idx]
+            # The names associated with these are already in the payment
+            if row_type == 'Invoice item' or row_type == 'Shopping Cart Item':
+                continue
+            # We need the direction of the transaction to know what email 
+            # to take, so it is part of what makes a customer unique
+            is_from_customer = \
+                1 if row_type == 'Shopping Cart Payment Received' else 0
+            customers.add(get_source(row) + (is_from_customer,))
+
+    def names(self):
+        """
+        Return a petl table of the !CUST rows of the customers collected
+
+        """
+        # Sort the customers just as petl's distinct() would have, so the 
+        # order of the names in the .IIF file doesn't depend on hashing
+        names = [names_dest_fields]
+        names_seen = set()
+        for customer in sorted(self.customers, key=Comparable):
+            # Remove some entries 
+            if customer[0] == 'Bank Account':
+                continue
+            name_row = customer_name_row(*customer)
+            # Customers whose details differ only in ways that don't show 
+            # in QuickBooks would otherwise be written out twice
+            if name_row not in names_seen:
+                names_seen.add(name_row)
+                names.append(name_row)
+
+        # TODO: ensure that 'NAME' doesn't already exist in QuickBooks? How 
+        # does or maybe just prevent that vendor/customer error by appending 
+        # '(c)' after every name
+
+        return etl.wrap(names)
+
+
+# The fields of the !CUST rows of the .IIF file
+names_dest_fields = ('!CUST', 'NAME', 'BADDR1', 'BADDR2', 'BADDR3', 
+                     'BADDR4', 'BADDR5', 'SADDR1', 'SADDR2', 'SADDR3', 
+                     'SADDR4', 'SADDR5', 'PHONE1', 'PHONE2', 'FAXNUM', 
+                     'EMAIL', 'NOTE', 'CONT1', 'CONT2', 'CTYPE', 'TERMS', 
+                     'TAXABLE', 'LIMIT', 'RESALENUM', 'REP', 'TAXITEM', 
+                     'NOTEPAD', 'SALUTATION', 'COMPANYNAME', 'FIRSTNAME', 
+                     'MIDINIT', 'LASTNAME')
+
+
+def customer_name_row(name, email, to_email, address_line_1, 
+                      address_line_2, town, province, postal_code, country,
+                      phone, is_from_customer):
     """
-    names_dest_fields = ['!CUST', 'NAME', 'BADDR1', 'BADDR2', 'BADDR3', 
-                         'BADDR4', 'BADDR5', 'SADDR1', 'SADDR2', 'SADDR3', 
-                         'SADDR4', 'SADDR5', 'PHONE1', 'PHONE2', 'FAXNUM', 
-                         'EMAIL', 'NOTE', 'CONT1', 'CONT2', 'CTYPE', 'TERMS', 
-                         'TAXABLE', 'LIMIT', 'RESALENUM', 'REP', 'TAXITEM', 
-                         'NOTEPAD', 'SALUTATION', 'COMPANYNAME', 'FIRSTNAME', 
-                         'MIDINIT', 'LASTNAME']
+    Construct the !CUST row (as a tuple ordered as names_dest_fields) of
+    one unique customer
+
+    """
+    name_parts = name.split()
+    baddr3 = town.title() + ', ' + province.title() + ' ' + \
+             postal_code.upper()
+    if baddr3 == ',  ':
+        baddr3 = ''
+
+    return ('CUST',                                     # !CUST
+            name.title() + ' (c)',                      # NAME
+            name.title(),                               # BADDR1
+            address_line_1 + ' ' + address_line_2,      # BADDR2
+            baddr3,                                     # BADDR3
+            'Country',                                  # BADDR4
+            '', '', '', '', '', '',                     # BADDR5 - SADDR5
+            phone,                                      # PHONE1
+            '', '',                                     # PHONE2, FAXNUM
+            email if is_from_customer else to_email,    # EMAIL
+            '', '', '', '', '',                         # NOTE - TERMS
+            'N',                                        # TAXABLE
+            '', '', '', '', '', '', '',                 # LIMIT - COMPANYNAME
+            name_parts[0],                              # FIRSTNAME
+            '',                                         # MIDINIT
+            name_parts[-1])                             # LASTNAME
+
+
+def get_name_conflicts(names):
     """
+    Take the table of customer names made by get_customer_names, and find
+    the QuickBooks names shared by customers at different addresses (e.g.
+    two different John Smiths, or one who moved house).  QuickBooks knows 
+    a customer by their name alone, so they'd be taken for one customer.
     
-    # The names associated with these are already in the payment
-    names = paypal.selectne('Type', 'Invoice item')
-    names =  names.selectne('Type', 'Shopping Cart Item')
-         
-    # We need the direction of the transaction to know what email to take
-    names = names.addfield('Is From Customer', lambda rec: 1 if rec['Type'] == 'Shopping Cart Payment Received' else 0)
-    names_source_fields.append('Is From Customer')
-
-    names = names.cut(*names_source_fields)
-
-    # Remove duplicates    
-    names = names.distinct()
-
-    # Remove some entries 
-    names = names.selectne('Name', 'Bank Account')
-
-    # TODO: ensure that 'NAME' doesn't already exist in QuickBooks? How does
-    # or maybe just prevent that vendor/customer error by appending '(c)' 
-    # after every name
-    # Returns rows with same Name but differing in some other field
-    #name_conflicts = names.conflicts('Name')
-    # TODO: do something with these conflicts...    
-
-
-    # Construct the destination fields, one by one
-    names = names.addfield('!CUST', 'CUST')
-    names = names.addfield('NAME', lambda rec:   rec['Name'].title() + ' (c)')
-    names = names.addfield('BADDR1', lambda rec: rec['Name'].title())
-    names = names.addfield('BADDR2', lambda rec: rec['Address Line 1'] +
-                                           ' ' + rec['Address Line 2'])
-    names = names.addfield('BADDR3', lambda rec: rec['Town/City'].title() + ', ' +
-                                                 rec['Province'].title() + ' ' + 
-                                                 rec['Postal Code'].upper())
-    names = names.convert('BADDR3', lambda v: '' if v == ',  ' else v)
-    names = names.addfield('BADDR4', 'Country')
-    names = names.addfield('BADDR5', '')
-    names = names.addfield('SADDR1', '')
-    names = names.addfield('SADDR2', '')
-    names = names.addfield('SADDR3', '')
-    names = names.addfield('SADDR4', '')
-    names = names.addfield('SADDR5', '')
-    names = names.addfield('PHONE1', lambda rec: rec['Phone'])
-    names = names.addfield('PHONE2', '')
-    names = names.addfield('FAXNUM', '')
-    names = names.addfield('EMAIL', lambda rec: rec['Email'] if rec['Is From Customer'] else rec['To Email'])
-    names = names.addfield('NOTE', '')
-    names = names.addfield('CONT1', '')
-    names = names.addfield('CONT2', '')
-    names = names.addfield('CTYPE', '')
-    names = names.addfield('TERMS', '')
-    names = names.addfield('TAXABLE', 'N')
-    names = names.addfield('LIMIT', '')
-    names = names.addfield('RESALENUM', '')
-    names = names.addfield('REP', '')
-    names = names.addfield('TAXITEM', '')
-    names = names.addfield('NOTEPAD', '')
-    names = names.addfield('SALUTATION', '')
-    names = names.addfield('COMPANYNAME', '')
-    names = names.addfield('FIRSTNAME', lambda rec: rec['Name'].split()[0])
-    names = names.addfield('MIDINIT', '')
-    names = names.addfield('LASTNAME', lambda rec: rec['Name'].split()[-1])
-
-    # We don't need the source fields anymore, so cut them out
-    # so names is left as just having the dest fields
-    names = names.cutout(*names_source_fields)
-
-    return names
+    Customers that only differ in their email or phone number are most 
+    likely the same person, so those aren't conflicts.
+
+    Returns an OrderedDict of NAME -> the !CUST rows sharing that NAME
+
+    """
+    get_address = operator.itemgetter(*[names_dest_fields.index(field) for
+                                        field in name_conflict_fields])
+    rows_by_name = OrderedDict()
+    for row in names.data():
+        rows_by_name.setdefault(row[1], []).append(row)
+
+    return OrderedDict((name, rows) for name, rows in rows_by_name.items()
+                       if len(set(map(get_address, rows))) > 1)
+
+
+# The !CUST fields that tell customers sharing a name apart
+name_conflict_fields = ('BADDR2', 'BADDR3')
 
+
+def print_name_conflicts(names):
+    """
+    Print one warning about all the name conflicts (see get_name_conflicts)
+    among names, a table made by get_customer_names, naming the first few
+
+    """
+    conflicts = get_name_conflicts(names)
+    if conflicts:
+        shown = list(conflicts)[:3]
+        print("WARNING: " + str(len(conflicts)) + " QuickBooks names are "
+              "each shared by customers at different addresses: " + 
+              ", ".join(shown) + 
+              (" and " + str(len(conflicts) - len(shown)) + " more"
+               if len(conflicts) > len(shown) else ""))
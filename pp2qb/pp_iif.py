@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Writing the QuickBooks .IIF file:
+
+IIFWriter
+
++ one function to format IIF rows as text, e.g. in a worker process:
+
+format_iif_rows
+
+"""
+
+import csv, io, os, shutil
+
+
+class IIFWriter(object):
+    """
+    Keep a single buffered handle on the .IIF file open for the whole run.
+
+    Everything is written to a temporary file next to iif_path, which only
+    replaces iif_path once the whole run has succeeded, so a run that
+    crashes part way through never leaves a half-written output.iif behind.
+
+    Use it as a context manager:
+
+    with IIFWriter(iif_path) as iif:
+        iif.write_table(names)
+        iif.write_header(header_rows)
+        iif.write_block(block_rows)
+
+    """
+    def __init__(self, iif_path, buffer_size=1024*1024):
+        self.iif_path = iif_path
+        self.temp_path = iif_path + '.tmp'
+        self.iif_file = io.open(self.temp_path, 'w', buffering=buffer_size,
+                                newline='')
+        self.writer = csv.writer(self.iif_file, delimiter='\t',
+                                 lineterminator='\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_table(self, table):
+        """
+        Write a petl table, header row included, as tab-separated values.
+        These lines end in '\r\n', as petl's own appendtsv would write them.
+
+        """
+        csv.writer(self.iif_file, delimiter='\t').writerows(table)
+
+    def write_header(self, header_rows):
+        """
+        Write the !TRNS, !SPL and !ENDTRNS header rows of a section of
+        transactions
+
+        """
+        self.writer.writerows(header_rows)
+
+    def write_block(self, rows):
+        """
+        Write complete TRNS ... ENDTRNS transaction blocks: one, or the rows
+        of many at once (e.g. from a generator)
+
+        """
+        self.writer.writerows(rows)
+
+    def write_text(self, iif_text):
+        """
+        Write IIF rows already formatted by format_iif_rows
+
+        """
+        self.iif_file.write(iif_text)
+
+    def write_spool(self, spool_file):
+        """
+        Copy in IIF rows spooled to a temporary text file (e.g. a section 
+        written while the customers were still being collected)
+
+        """
+        spool_file.seek(0)
+        shutil.copyfileobj(spool_file, self.iif_file)
+
+    def close(self):
+        """
+        Flush everything to disk, and move the finished file into place
+
+        """
+        self.iif_file.close()
+        os.replace(self.temp_path, self.iif_path)
+
+    def abort(self):
+        """
+        Throw away whatever has been written, leaving iif_path untouched
+
+        """
+        self.iif_file.close()
+        os.remove(self.temp_path)
+
+
+def format_iif_rows(rows):
+    """
+    Format rows exactly as IIFWriter.write_block would write them, but 
+    return the text instead of writing it
+
+    """
+    iif_text = io.StringIO(newline='')
+    csv.writer(iif_text, delimiter='\t', lineterminator='\n').writerows(rows)
+    return iif_text.getvalue()
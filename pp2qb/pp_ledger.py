@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent record of the PayPal transactions already exported to
+QuickBooks, so that re-running over an ever-growing PayPal export only
+converts the new transactions:
+
+Ledger
+
+"""
+
+import sqlite3, datetime
+
+
+class Ledger(object):
+    """
+    A small SQLite file holding the Transaction IDs already written to an
+    .IIF file.
+
+    """
+    def __init__(self, ledger_path):
+        self.ledger_path = ledger_path
+        self.connection = sqlite3.connect(ledger_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS exported ('
+            'transaction_id TEXT PRIMARY KEY, '
+            'stage TEXT, '
+            'iif_path TEXT, '
+            'exported_on TEXT)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def exported_tranIDs(self):
+        """
+        Return the set of all Transaction IDs already exported
+
+        """
+        return set(tranID for (tranID,) in self.connection.execute(
+            'SELECT transaction_id FROM exported'))
+
+    def skip_exported(self, paypal):
+        """
+        Take a paypal ColumnarTable and drop the rows of the transactions
+        already exported.
+
+        Rows that have been refunded since they were exported are kept,
+        since they still have to net against their refunds.  We return the
+        Transaction IDs of those, so the refund can be recorded by hand.
+
+        Returns
+        paypal: ColumnarTable
+        refunded_tranIDs: set
+
+        """
+        exported = self.exported_tranIDs()
+        if len(exported) == 0:
+            return paypal, set()
+
+        tranID_column = paypal.column('Transaction ID')
+        status_column = paypal.column('Status')
+
+        new_rows = []
+        refunded_tranIDs = set()
+        for row_num in paypal.row_nums():
+            tranID = tranID_column[row_num]
+            if tranID not in exported:
+                new_rows.append(row_num)
+            elif status_column[row_num] == 'Refunded':
+                new_rows.append(row_num)
+                refunded_tranIDs.add(tranID)
+
+        return paypal.subset(new_rows), refunded_tranIDs
+
+    def record(self, tranIDs_by_stage, iif_path):
+        """
+        Add the Transaction IDs just written to iif_path to the ledger.
+        tranIDs_by_stage: dict of stage name -> Transaction IDs
+
+        """
+        exported_on = datetime.datetime.now().isoformat()
+        with self.connection:
+            for stage, tranIDs in tranIDs_by_stage.items():
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO exported VALUES (?, ?, ?, ?)',
+                    ((tranID, stage, iif_path, exported_on)
+                     for tranID in tranIDs))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation for paypal_to_quickbooks: how long each stage took, how
+many rows went in and came out, and how much memory it needed:
+
+RunMetrics
+
++ one "private" helper:
+
+peak_rss
+
+"""
+
+import sys, json, time, os, cProfile, tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+class RunMetrics(object):
+    """
+    Pass one to paypal_to_quickbooks to record each of its stages:
+
+    metrics = RunMetrics()
+    paypal_to_quickbooks(paypal_path, metrics=metrics)
+    metrics.write_report('run_report.json')
+
+    For every stage it records the wall time, the rows in and out (as
+    counted by the pipeline itself, so no extra passes over the data) and
+    the peak RSS of the process so far.  Optionally:
+
+    profile: run each stage under cProfile; the stats are kept in
+             .profiles, and dumped to profile_dir/<stage>.prof if given
+    trace_memory: trace the memory allocated by Python during each stage
+                  with tracemalloc (which slows everything down)
+    callback: a function called with each stage's record (a dict) as soon
+              as the stage finishes, e.g. to log progress
+
+    """
+    def __init__(self, profile=False, trace_memory=False, profile_dir=None,
+                 callback=None):
+        self.profile = profile or profile_dir is not None
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.callback = callback
+        self.stages = []
+        self.profiles = {}
+        self.info = {}
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Record the stage run in the body of the with statement:
+
+        with metrics.stage('eliminate_cancellations', paypal.nrows()) as s:
+            paypal = eliminate_cancellations(paypal)
+            s['rows_out'] = paypal.nrows()
+
+        """
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+
+            if self.profile:
+                profiler.disable()
+                self.profiles[name] = profiler
+                if self.profile_dir is not None:
+                    profile_path = os.path.join(self.profile_dir,
+                                                name + '.prof')
+                    profiler.dump_stats(profile_path)
+                    record['profile_path'] = profile_path
+            if self.trace_memory:
+                record['peak_traced_bytes'] = \
+                    tracemalloc.get_traced_memory()[1]
+            record['peak_rss_bytes'] = peak_rss()
+
+            self.stages.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def report(self):
+        """
+        Return the machine-readable run report, as a dict ready for JSON
+
+        """
+        report = dict(self.info)
+        report['stages'] = self.stages
+        report['total_seconds'] = sum(record['seconds']
+                                      for record in self.stages)
+        report['peak_rss_bytes'] = peak_rss()
+        return report
+
+    def write_report(self, report_path):
+        """
+        Write the run report to report_path, as JSON
+
+        """
+        with open(report_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2, sort_keys=True,
+                      default=str)
+            report_file.write('\n')
+
+    def close(self):
+        """
+        Stop tracing memory, if we started it
+
+        """
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def peak_rss():
+    """
+    The peak resident set size of this process so far, in bytes, or None
+    where the resource module isn't available
+
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes; macOS, bytes
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024
@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+"""
+Converting a PayPal export in a single streaming pass, for exports too big
+to hold in memory:
+
+stream_paypal_to_quickbooks
+
++ some "private" helpers:
+
+StreamConverter
+SortedSpool
+RecordSpool
+read_records
+write_iif
+
+"""
+
+import csv, io, os, heapq, pickle, shutil, itertools, operator, tempfile
+from .pp_helper import cleanup_paypal_fields, paypal_converters
+from .pp_helper import fromcsv_paypal, memoized
+from .pp_helper import cancellation_actions, netting_totals, check_netting
+from .pp_helper import fee_refund_pair, cents_to_dollars
+from .pp_helper import CustomerCollector, print_name_conflicts
+from .pp_append import DepositConverter, FeeConverter, InvoiceConverter
+from .pp_append import cart_order
+from .pp_append import InvoiceMatcher, invoice_payment_types
+from .pp_append import print_unconverted_invoices
+from .pp_table import ORIGINAL_PASSES
+from .pp_validate import CartValidator, cart_types, print_cart_validation
+from .pp_iif import IIFWriter
+from .pp_ledger import Ledger
+from .pp_metrics import RunMetrics
+
+
+# The most deposits SortedSpool sorts in memory at once
+SORT_RUN_SIZE = 10000
+
+
+def stream_paypal_to_quickbooks(paypal_path, iif_path, unprocessed_path,
+                                start_date=None, end_date=None,
+                                ledger_path=None, metrics=None,
+                                classifier=None, invoice_report_path=None,
+                                cart_report_path=None, source=None,
+                                exclude_failed_carts=False):
+    """
+    Convert the paypal CSV into a QuickBooks .IIF file and unprocessed rows
+    exactly as paypal_to_quickbooks does, but reading the CSV as a stream,
+    so memory stays bounded however big the file is.
+
+    This relies on PayPal listing the rows of a transaction (e.g. a cart
+    payment and its cart items) next to each other: only the rows of the
+    current Transaction ID are held in memory, and each transaction is
+    written out as soon as the next one starts.  (Rows of a transaction
+    that turn up somewhere else in the file end up in unprocessed.csv.)
+
+    What does grow is the set of unique customers, since the names have to
+    come first in the .IIF file, and with a ledger, the Transaction IDs
+    exported.  The TicketLeap fees, the deposits (sorted on the way, see 
+    SortedSpool) and the invoices are spooled to temporary files next to
+    iif_path until the names can be written, and likewise the unprocessed
+    rows.  A payment can only be matched to its invoice (see 
+    InvoiceMatcher) once every invoice has been read, so until then the 
+    possible invoice payments are spooled separately (see RecordSpool).
+
+    metrics, a RunMetrics, records the streaming pass and the writing of
+    the .IIF file as two stages, since all the other stages are 
+    interleaved in the streaming pass.
+
+    classifier, an AccountClassifier, decides the class and account of each
+    item sold (by default, with the rules in accounts.csv).
+
+    Each cart is validated as its transaction closes, and the report of
+    those that fail written to cart_report_path; they are left unprocessed
+    as paypal_to_quickbooks leaves them (see exclude_failed_carts).
+
+    source, if given, is a table of the export's rows (such as
+    pp_api.fetch_transactions returns) to stream instead of the CSV file.
+
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    if invoice_report_path is None:
+        invoice_report_path = os.path.join(os.path.dirname(paypal_path), 
+                                           'invoice_payments.csv')
+    if cart_report_path is None:
+        cart_report_path = os.path.join(os.path.dirname(paypal_path), 
+                                        'cart_validation.csv')
+
+    if ledger_path is not None:
+        ledger = Ledger(ledger_path)
+        exported_tranIDs = ledger.exported_tranIDs()
+    else:
+        exported_tranIDs = None
+
+    iif_folder = os.path.dirname(os.path.abspath(iif_path))
+    unprocessed_temp_path = unprocessed_path + '.tmp'
+    if source is None:
+        source = fromcsv_paypal(paypal_path)
+    spools = ([tempfile.TemporaryFile('w+', newline='', dir=iif_folder)
+               for _ in range(3)] + [SortedSpool(iif_folder)] + 
+              [RecordSpool(iif_folder) for _ in range(2)])
+    try:
+        (fee_spool, invoice_spool, unprocessed_spool, deposit_spool, 
+         held_spool, unmatched) = spools
+        converter = StreamConverter(
+            cleanup_paypal_fields(source),
+            fee_spool, deposit_spool, invoice_spool, unprocessed_spool, 
+            held_spool, classifier, exclude_failed_carts)
+        with metrics.stage('stream_paypal') as stage:
+            converter.run(start_date, end_date, exported_tranIDs)
+            converter.match_invoice_payments(unmatched)
+            stage['rows_in'] = converter.num_rows
+            stage['rows_out'] = converter.num_unprocessed
+        print("Streamed PayPal input file (" + 
+              str(converter.num_rows) + " rows)")
+
+        for tranID in sorted(converter.refunded_tranIDs):
+            print("WARNING: transaction " + tranID + " was exported by "
+                  "an earlier run but has since been refunded; record "
+                  "the refund in QuickBooks manually")
+
+        converter.cart_validator.write_report(cart_report_path)
+        print_cart_validation(converter.cart_validator, cart_report_path,
+                              converter.cart_validator.excluded_tranIDs(
+                                  exclude_failed_carts))
+
+        print("Creating output IIF file")
+        with metrics.stage('write_iif') as stage:
+            write_iif(converter, fee_spool, deposit_spool, invoice_spool,
+                      iif_path)
+            with io.open(unprocessed_temp_path, 'w', newline='') \
+                    as unprocessed_file:
+                converter.write_unprocessed(unprocessed_file, unmatched)
+    except Exception:
+        # Don't leave a half-written unprocessed.csv behind
+        if os.path.exists(unprocessed_temp_path):
+            os.remove(unprocessed_temp_path)
+        raise
+    finally:
+        for spool in spools:
+            spool.close()
+
+    if ledger_path is not None:
+        # Only now that output.iif is safely in place
+        ledger.record(converter.claimed_tranIDs, iif_path)
+        ledger.close()
+
+    os.replace(unprocessed_temp_path, unprocessed_path)
+    print("Created output unprocessed rows CSV file (" +
+          str(converter.num_unprocessed) + " rows)")
+
+    converter.invoice_matcher.write_report(invoice_report_path)
+    print("Created invoice payments report (" + 
+          str(len(converter.invoice_matcher.report_rows)) + 
+          " payments matched to " + 
+          str(len(converter.invoice_matcher.invoices)) + " invoices)")
+    print_unconverted_invoices(converter.invoice_matcher)
+
+    metrics.info['passes'] = 1
+    metrics.info['original_passes'] = ORIGINAL_PASSES
+    metrics.close()
+    print("Read the PayPal input file 1 time(s), against " + 
+          str(ORIGINAL_PASSES) + " before it was materialized")
+
+
+class SortedSpool(object):
+    """
+    Spool blocks of IIF rows to temporary files in folder, and write them
+    out sorted by a key for each (e.g. the cart_order of the payment each
+    was made from, so the deposits come out in the order 
+    append_sales_as_deposits writes them).
+
+    This is an external merge sort: run_size blocks at a time (by default,
+    SORT_RUN_SIZE) are sorted in memory and spooled as a run, and the runs
+    merged as they're written out, so memory stays bounded.
+
+    """
+    def __init__(self, folder, run_size=None):
+        self.folder = folder
+        self.run_size = SORT_RUN_SIZE if run_size is None else run_size
+        self.blocks = []
+        self.runs = []
+
+    def add(self, key, block):
+        """
+        Add a block of IIF rows, to be sorted by key
+
+        """
+        self.blocks.append((key, block))
+        if len(self.blocks) >= self.run_size:
+            self.spool_run()
+
+    def spool_run(self):
+        run = tempfile.TemporaryFile(dir=self.folder)
+        self.blocks.sort(key=self.block_order)
+        for entry in self.blocks:
+            pickle.dump(entry, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.blocks = []
+
+    def read_run(self, run):
+        return read_records(run)
+
+    block_order = staticmethod(operator.itemgetter(0))
+
+    def write_to(self, iif):
+        """
+        Write every block added to iif, an IIFWriter, in order
+
+        """
+        self.blocks.sort(key=self.block_order)
+        entries = heapq.merge(*([self.read_run(run) for run in self.runs] +
+                                [self.blocks]), key=self.block_order)
+        iif.write_block(row for _, block in entries for row in block)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.blocks = []
+
+
+class RecordSpool(object):
+    """
+    Spool records (anything that pickles, e.g. a transaction's rows) to a
+    temporary file in folder, to read back in the order they were added,
+    so that holding on to them takes no memory
+
+    """
+    def __init__(self, folder):
+        self.file = tempfile.TemporaryFile(dir=folder)
+        self.num_records = 0
+
+    def add(self, record):
+        # (After the records have been read, carry on at the end)
+        self.file.seek(0, io.SEEK_END)
+        pickle.dump(record, self.file, pickle.HIGHEST_PROTOCOL)
+        self.num_records += 1
+
+    def __len__(self):
+        return self.num_records
+
+    def __iter__(self):
+        self.file.seek(0)
+        return read_records(self.file)
+
+    def close(self):
+        self.file.close()
+
+
+def read_records(spool_file):
+    """
+    The records pickled one after another to spool_file, from where it is
+    to the end
+
+    """
+    while True:
+        try:
+            yield pickle.load(spool_file)
+        except EOFError:
+            return
+
+
+def write_iif(converter, fee_spool, deposit_spool, invoice_spool, iif_path):
+    """
+    Write the .IIF file once a StreamConverter has run: the customers it
+    collected first, then the TicketLeap fees, the deposits and the 
+    invoices it spooled
+
+    """
+    with IIFWriter(iif_path) as iif:
+        names = converter.customers.names()
+        iif.write_table(names)
+        print_name_conflicts(names)
+
+        iif.write_header(converter.fee_converter.header_rows())
+        iif.write_spool(fee_spool)
+
+        # Like append_sales_as_deposits, no header if there were no sales
+        if converter.num_carts > 0:
+            iif.write_header(converter.deposit_converter.header_rows())
+            deposit_spool.write_to(iif)
+
+        # Like append_invoices, no header if there were no invoices
+        if converter.invoice_matcher.invoices:
+            iif.write_header(converter.invoice_converter.header_rows())
+            iif.write_spool(invoice_spool)
+
+
+class StreamConverter(object):
+    """
+    Run the stages of paypal_to_quickbooks over a stream of rows, one
+    transaction (the adjacent rows sharing a Transaction ID) at a time.
+
+    The fee and invoice blocks are written to fee_spool and invoice_spool,
+    the deposit blocks added to deposit_spool (a SortedSpool), and the 
+    unprocessed rows (and the header row) to unprocessed_spool, except for
+    the transactions that may be the payment of an invoice, which are 
+    added to held_spool (a RecordSpool) for match_invoice_payments.
+
+    The carts that fail validation are still converted, if they can be,
+    unless exclude_failed_carts (as in paypal_to_quickbooks).
+
+    """
+    def __init__(self, paypal, fee_spool, deposit_spool, invoice_spool,
+                 unprocessed_spool, held_spool, classifier=None, 
+                 exclude_failed_carts=False):
+        self.rows = iter(paypal)
+        self.header = tuple(next(self.rows))
+        header = list(self.header)
+
+        self.fee_converter = FeeConverter()
+        self.deposit_converter = DepositConverter(classifier)
+        self.invoice_converter = InvoiceConverter(classifier)
+        self.invoice_matcher = InvoiceMatcher()
+        self.cart_validator = CartValidator()
+        self.exclude_failed_carts = exclude_failed_carts
+        self.customers = CustomerCollector(header)
+
+        self.fee_writer = csv.writer(fee_spool, delimiter='\t',
+                                     lineterminator='\n')
+        self.deposit_spool = deposit_spool
+        self.invoice_writer = csv.writer(invoice_spool, delimiter='\t',
+                                         lineterminator='\n')
+        self.unprocessed_spool = unprocessed_spool
+        self.unprocessed_writer = csv.writer(unprocessed_spool,
+                                             lineterminator='\n')
+        self.unprocessed_writer.writerow(self.header)
+
+        self.type_idx = header.index('Type')
+        self.status_idx = header.index('Status')
+        self.name_idx = header.index('Name')
+        self.date_idx = header.index('Date')
+        self.tranID_idx = header.index('Transaction ID')
+        self.gross_idx = header.index('Gross')
+        self.fee_idx = header.index('Fee')
+
+        self.converters = [(header.index(field), memoized(converter))
+                           for field, converter, typecode in
+                           paypal_converters]
+        self.get_fee_source = self.getter(FeeConverter.source_fields)
+        self.get_payment_source = self.getter(
+            DepositConverter.payment_source_fields)
+        self.get_item_source = self.getter(
+            DepositConverter.item_source_fields)
+        self.get_invoice_source = self.getter(
+            InvoiceConverter.invoice_source_fields)
+        self.get_invoice_item_source = self.getter(
+            InvoiceConverter.item_source_fields)
+        self.get_invoice_payment_source = self.getter(
+            InvoiceMatcher.payment_source_fields)
+        self.get_cart_source = self.getter(CartValidator.source_fields)
+
+        self.num_rows = 0
+        self.num_carts = 0
+        self.num_unprocessed = 0
+        # The transactions that may pay an invoice, as (the number of 
+        # unprocessed rows written before them, Transaction ID, rows)
+        self.held_spool = held_spool
+        self.refunded_tranIDs = set()
+        # Only kept up to date for a ledger, since it grows with the file
+        self.claimed_tranIDs = None
+
+    def getter(self, fields):
+        """
+        A function cutting a row down to just fields (several), as a tuple
+
+        """
+        return operator.itemgetter(*[self.header.index(field) 
+                                     for field in fields])
+
+    def run(self, start_date=None, end_date=None, exported_tranIDs=None):
+        """
+        Read every row, writing out each transaction as it closes
+
+        """
+        type_idx = self.type_idx
+        status_idx = self.status_idx
+        date_idx = self.date_idx
+        tranID_idx = self.tranID_idx
+        gross_idx = self.gross_idx
+        fee_idx = self.fee_idx
+        converters = self.converters
+        num_fields = len(self.header)
+        padding = [None] * num_fields
+
+        actions = cancellation_actions()
+        totals = netting_totals()
+        num_fee_refunds = 0
+        if exported_tranIDs is not None:
+            self.claimed_tranIDs = {}
+
+        transaction = []
+        transaction_tranID = None
+        for row in self.rows:
+            self.num_rows += 1
+            # Clean up the row, just as cleanup_paypal would have
+            row = list(row)
+            if len(row) != num_fields:
+                row = (row + padding)[:num_fields]
+            for i, convert in converters:
+                row[i] = convert(row[i])
+
+            # Eliminate dates prior to start_date and after end_date (like
+            # ColumnarTable.select_range)
+            row_date = row[date_idx]
+            if start_date is not None and (row_date is None or
+                                           row_date < start_date):
+                continue
+            if end_date is not None and row_date is not None and \
+               row_date > end_date:
+                continue
+
+            # Skip the transactions already exported by earlier runs, like
+            # Ledger.skip_exported
+            if exported_tranIDs is not None and \
+               row[tranID_idx] in exported_tranIDs:
+                if row[status_idx] != 'Refunded':
+                    continue
+                self.refunded_tranIDs.add(row[tranID_idx])
+
+            # Eliminate the cancellations, like eliminate_cancellations
+            pair = (row[type_idx], row[status_idx])
+            if pair in actions:
+                if actions[pair] is not None:
+                    pair_totals = totals[pair]
+                    if row[gross_idx] is not None:
+                        pair_totals[0] += row[gross_idx]
+                    if row[fee_idx] is not None:
+                        pair_totals[1] += row[fee_idx]
+                continue
+            if pair == fee_refund_pair and row[self.name_idx] == 'PayPal':
+                row[fee_idx] = -30
+                row[gross_idx] = 0
+                num_fee_refunds += 1
+
+            if row[tranID_idx] != transaction_tranID:
+                self.close_transaction(transaction_tranID, transaction)
+                transaction = []
+                transaction_tranID = row[tranID_idx]
+            transaction.append(tuple(row))
+
+        self.close_transaction(transaction_tranID, transaction)
+
+        check_netting(totals, num_fee_refunds)
+
+    def close_transaction(self, tranID, rows):
+        """
+        Write out the rows of one transaction, as the TicketLeap fee, the
+        deposit or the invoices they make up, or else as unprocessed rows
+
+        """
+        if not rows:
+            return
+        type_idx = self.type_idx
+
+        self.customers.add(rows)
+
+        # Validate the cart, if this is one, like validate_carts
+        valid = True
+        if any(row[type_idx] in cart_types for row in rows):
+            validator = self.cart_validator
+            for row in rows:
+                if row[type_idx] in cart_types:
+                    validator.add(self.get_cart_source(row))
+                else:
+                    validator.add_other(row[self.tranID_idx])
+            validator.check()
+            valid = tranID not in validator.excluded_tranIDs(
+                self.exclude_failed_carts)
+
+        # TicketLeap fees come first, as in paypal_to_quickbooks, and claim
+        # every row of their transaction (i.e. the cart items itemizing them)
+        fee_rows = [row for row in rows
+                    if row[type_idx] == 'Preapproved Payment Sent']
+        if fee_rows:
+            for row in fee_rows:
+                self.fee_writer.writerows(
+                    self.fee_converter.block(self.get_fee_source(row)))
+            self.claim(tranID, 'append_TicketLeap_fees')
+            return
+
+        # Then the sales, i.e. completed cart payments and their cart items
+        status_idx = self.status_idx
+        payments = [row for row in rows
+                    if row[type_idx] == 'Shopping Cart Payment Received'
+                    and row[status_idx] == 'Completed']
+        if payments and valid:
+            # In the same order as append_sales_as_deposits (see get_carts)
+            payment_rows = [self.get_payment_source(row) for row in payments]
+            item_rows = [self.get_item_source(row) for row in 
+                         sorted((row for row in rows 
+                                 if row[type_idx] == 'Shopping Cart Item'), 
+                                key=cart_order)]
+            self.deposit_spool.add(
+                min(map(cart_order, payments)),
+                self.deposit_converter.block(payment_rows, item_rows))
+            self.num_carts += 1
+            self.claim(tranID, 'append_sales_as_deposits')
+            return
+
+        # Then the invoices, and their invoice items
+        invoice_rows = [self.get_invoice_source(row) for row in rows
+                        if row[type_idx] == 'Invoice Sent']
+        item_rows = [self.get_invoice_item_source(row) for row in rows
+                     if row[type_idx] == 'Invoice item']
+        if invoice_rows and not item_rows:
+            # Nothing to classify it by, so it's left unprocessed
+            self.invoice_matcher.unconverted_tranIDs.append(tranID)
+        elif invoice_rows:
+            for invoice_row in invoice_rows:
+                self.invoice_writer.writerows(
+                    self.invoice_converter.block(invoice_row, item_rows))
+                self.invoice_matcher.add_invoice(invoice_row)
+            self.claim(tranID, 'append_invoices')
+            return
+
+        # A payment can't be matched to its invoice until every invoice has
+        # been read, so hold it back until then
+        if any(row[type_idx] in invoice_payment_types for row in rows):
+            self.held_spool.add((self.num_unprocessed, tranID, rows))
+            return
+
+        self.unprocessed_writer.writerows(map(self.unprocessed_row, rows))
+        self.num_unprocessed += len(rows)
+
+    def unprocessed_row(self, row):
+        """
+        A row as written to unprocessed.csv
+        
+        """
+        # The money is held in cents; write it back out in dollars
+        row = list(row)
+        if row[self.gross_idx] is not None:
+            row[self.gross_idx] = cents_to_dollars(row[self.gross_idx])
+        if row[self.fee_idx] is not None:
+            row[self.fee_idx] = cents_to_dollars(row[self.fee_idx])
+        return row
+
+    def match_invoice_payments(self, unmatched):
+        """
+        Once run is done, match the payments held back to the invoices, in
+        the order they were read, like append_invoices.  
+
+        The transactions left unmatched are added to unmatched, a 
+        RecordSpool, as (the number of unprocessed rows written before 
+        them, rows)
+
+        """
+        type_idx = self.type_idx
+        get_payment_source = self.get_invoice_payment_source
+        match = self.invoice_matcher.match
+        for position, tranID, rows in self.held_spool:
+            # (Every payment in the transaction is matched, if it can be)
+            matches = [match(get_payment_source(row)) for row in rows
+                       if row[type_idx] in invoice_payment_types]
+            if any(matches):
+                self.claim(tranID, 'append_invoices')
+            else:
+                unmatched.add((position, rows))
+                self.num_unprocessed += len(rows)
+
+    def write_unprocessed(self, unprocessed_file, unmatched):
+        """
+        Copy the unprocessed rows spooled by run to unprocessed_file, with
+        the unmatched transactions spooled by match_invoice_payments put
+        back where they were read
+
+        """
+        spool = self.unprocessed_spool
+        spool.seek(0)
+        if not unmatched:
+            shutil.copyfileobj(spool, unprocessed_file)
+            return
+
+        reader = csv.reader(spool)
+        writer = csv.writer(unprocessed_file, lineterminator='\n')
+        writer.writerow(next(reader))
+        num_copied = 0
+        for position, rows in unmatched:
+            for row in itertools.islice(reader, position - num_copied):
+                writer.writerow(row)
+            num_copied = position
+            writer.writerows(map(self.unprocessed_row, rows))
+        writer.writerows(reader)
+
+    def claim(self, tranID, stage):
+        """
+        Record the Transaction ID written out by stage, for the ledger
+
+        """
+        if self.claimed_tranIDs is not None:
+            self.claimed_tranIDs.setdefault(stage, set()).add(tranID)
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory, column-oriented home for the cleaned paypal data, so that
+the lazy petl chain built by cleanup_paypal is evaluated exactly once,
+and so that each stage can claim the rows it consumes:
+
+ColumnarTable
+PassCountingTable
+RunIndex
+
++ one function to turn any petl table into a ColumnarTable:
+
+materialize
+
++ some column helpers:
+
+with_missing
+take
+missing_first
+
++ the types an integer column may be stored as:
+
+integer_columns
+
++ how many passes over the source the lazy petl chain used to make:
+
+ORIGINAL_PASSES
+
+"""
+
+import petl as etl
+from petl.util.base import Record
+from array import array
+from collections import Counter, OrderedDict
+from itertools import compress, chain, islice
+from bisect import bisect_left, bisect_right
+import operator
+
+
+# Stands in for a missing value in an integer column (e.g. the empty Fee of
+# a cart item), since an array of integers can't hold None
+MISSING = -2**63
+
+# An integer column is an array, or (when loaded from a pp_cache file) a 
+# memoryview of 64-bit integers straight onto the cache file
+integer_columns = (array, memoryview)
+
+
+class ColumnarTable(etl.Table):
+    """
+    A petl table whose data lives in memory as one Python list per column,
+    or, for integer columns like the money columns (in cents), one compact 
+    array of 64-bit integers per column.
+
+    Iterating over it (which is what every petl operation does) just zips
+    the columns back together, so unlike a lazy petl chain nothing is
+    re-read or re-computed.
+
+    Each stage of the conversion claims the rows it has dealt with, by
+    row number or by Transaction ID.  Claimed rows are hidden from then
+    on, so whatever is left at the end is exactly the unprocessed rows,
+    without any sorting or row-by-row comparison of whole tables.
+
+    """
+    def __init__(self, header, columns):
+        self.flds = tuple(header)
+        self.cols = columns
+        # One flag per row: 1 until some stage claims the row
+        num_rows = len(columns[0]) if columns else 0
+        self.unclaimed = bytearray(b'\x01') * num_rows
+        self.num_unclaimed = num_rows
+        # The number of rows claimed by each stage, and which rows they were
+        self.claims = Counter()
+        self.claimed_rows = {}
+        # The Transaction IDs claimed by each stage, via claim_transactions
+        self.claimed_tranIDs = {}
+        # The RunIndex of each field select_range has been used on
+        self.indexes = {}
+
+    def __iter__(self):
+        yield self.flds
+        columns = [with_missing(column) for column in self.cols]
+        for row in compress(zip(*columns), self.unclaimed):
+            yield row
+
+    def column(self, field):
+        """
+        Return the list (or array) backing the column named field, not a 
+        copy.  It holds every row, claimed or not; index it with row 
+        numbers.  Missing values in an array are MISSING, not None.
+
+        """
+        return self.cols[self.flds.index(field)]
+
+    def header(self):
+        return self.flds
+
+    def nrows(self):
+        return self.num_unclaimed
+
+    def columns(self, missing=None):
+        return OrderedDict((fld, list(compress(with_missing(col), 
+                                               self.unclaimed)))
+                           for fld, col in zip(self.flds, self.cols))
+
+    def convert_column(self, field, converter, typecode=None):
+        """
+        Convert a whole column in place.  converter is called only once 
+        per distinct value, since e.g. a year of PayPal data has only a few
+        hundred distinct dates.  As with petl's convert, a value the 
+        converter fails on (e.g. an empty Fee) becomes None.
+
+        If typecode is given (e.g. 'q'), the converted column is stored as 
+        a compact array of that type instead, with MISSING in place of None.
+
+        """
+        column_num = self.flds.index(field)
+        column = self.cols[column_num]
+        self.indexes.pop(field, None)
+        converted = {}
+        for value in set(column):
+            try:
+                converted[value] = converter(value)
+            except Exception:
+                converted[value] = None
+
+        if typecode is None:
+            column[:] = map(converted.__getitem__, column)
+        else:
+            if None in converted.values():
+                converted = dict((value, MISSING if result is None 
+                                         else result)
+                                 for value, result in converted.items())
+            self.cols[column_num] = array(typecode, 
+                                          map(converted.__getitem__, column))
+
+    def cut_rows(self, fields, row_nums):
+        """
+        Iterate over the rows with the given row numbers, cut down to 
+        fields, as tuples (with None for missing values, as when iterating)
+
+        """
+        columns = [self.column(field) for field in fields]
+        array_nums = [i for i, column in enumerate(columns) 
+                      if isinstance(column, integer_columns)]
+        for row_num in row_nums:
+            row = [column[row_num] for column in columns]
+            for i in array_nums:
+                if row[i] == MISSING:
+                    row[i] = None
+            yield tuple(row)
+
+    def subset(self, row_nums):
+        """
+        Return a new ColumnarTable holding just the rows with the given
+        row numbers (e.g. the rows within a date range)
+
+        """
+        return ColumnarTable(self.flds, [take(column, row_nums) 
+                                         for column in self.cols])
+
+    def select_range(self, field, low=None, high=None):
+        """
+        Return a new ColumnarTable holding just the rows with 
+        low <= field <= high.  Either limit may be None, for no limit.
+        (Like petl, a missing value counts as less than anything else.)
+
+        The rows are found by binary search of a RunIndex of field, built 
+        the first time it's needed, so with a sorted column (like the 
+        Date column of a PayPal export) no row outside the range is looked
+        at twice, and the index is reused by any later select_range.
+
+        """
+        index = self.indexes.get(field)
+        if index is None:
+            index = RunIndex.of_column(self.column(field))
+            self.indexes[field] = index
+        unclaimed = self.unclaimed
+        return self.subset([row_num for row_num in index.row_nums(low, high)
+                            if unclaimed[row_num]])
+
+    def row_nums(self):
+        """
+        Iterate over the row numbers of the rows not yet claimed
+
+        """
+        return compress(range(len(self.unclaimed)), self.unclaimed)
+
+    def find(self, predicate):
+        """
+        Return the row numbers of the unclaimed rows for which 
+        predicate(record) is true
+
+        """
+        flds = self.flds
+        columns = [with_missing(column) for column in self.cols]
+        return [row_num for row_num, row in 
+                zip(self.row_nums(), compress(zip(*columns), 
+                                              self.unclaimed))
+                if predicate(Record(row, flds))]
+
+    def claim(self, row_nums, stage):
+        """
+        Mark the rows with the given row numbers as dealt with by stage
+
+        """
+        unclaimed = self.unclaimed
+        claimed_rows = self.claimed_rows.setdefault(stage, [])
+        num_claimed = 0
+        for row_num in row_nums:
+            if unclaimed[row_num]:
+                unclaimed[row_num] = 0
+                claimed_rows.append(row_num)
+                num_claimed += 1
+        self.num_unclaimed -= num_claimed
+        self.claims[stage] += num_claimed
+
+    def claimed(self, stage):
+        """
+        Return a new ColumnarTable holding the rows claimed by stage, e.g.
+        the rows eliminate_cancellations netted out
+
+        """
+        return self.subset(sorted(self.claimed_rows.get(stage, [])))
+
+    def claim_transactions(self, tranIDs, stage):
+        """
+        Claim every unclaimed row whose Transaction ID is in tranIDs
+        (e.g. a cart payment together with its cart items)
+
+        """
+        tranID_column = self.column('Transaction ID')
+        tranIDs = set(tranIDs)
+        self.claimed_tranIDs.setdefault(stage, set()).update(tranIDs)
+        self.claim([row_num for row_num in self.row_nums()
+                    if tranID_column[row_num] in tranIDs], stage)
+
+
+class RunIndex(object):
+    """
+    An index of a column by its runs of equal adjacent values: run i 
+    holds rows starts[i] up to (but not including) ends[i], all with the 
+    key keys[i], and the runs are ordered by key, so a range of keys is 
+    found by binary search.
+
+    A PayPal export is in date order (newest first), so its Date column 
+    is only a few hundred runs, however many rows it has.  (Any column 
+    can be indexed; one in no order just has more runs.)
+
+    to_key turns a value into its key; the default sorts missing values 
+    before everything else, as petl does.
+
+    """
+    def __init__(self, keys, starts, ends, to_key=None):
+        self.keys = keys
+        self.starts = starts
+        self.ends = ends
+        self.to_key = to_key if to_key is not None else missing_first
+
+    @classmethod
+    def of_column(cls, column, to_key=None):
+        """
+        Build the RunIndex of column.  If the runs are already in 
+        ascending or descending order of key, as with a sorted column, 
+        they don't need sorting.
+
+        """
+        if to_key is None:
+            to_key = missing_first
+        if isinstance(column, integer_columns):
+            column = list(with_missing(column))
+        # Where each run starts (only the runs are Python objects, not 
+        # the rows, so this is quick even for a big column)
+        num_rows = len(column)
+        starts = [0] + list(compress(range(1, num_rows), 
+                                     map(operator.ne, column, 
+                                         islice(column, 1, None))))
+        runs = [(to_key(column[start]), start, end) for start, end in 
+                zip(starts, starts[1:] + [num_rows]) if start < num_rows]
+
+        run_keys = [run[0] for run in runs]
+        if all(key >= next_key for key, next_key in zip(run_keys, 
+                                                        run_keys[1:])):
+            runs.reverse()
+        elif not all(key <= next_key for key, next_key in zip(run_keys, 
+                                                              run_keys[1:])):
+            runs.sort(key=lambda run: run[0])
+
+        return cls([run[0] for run in runs], [run[1] for run in runs], 
+                   [run[2] for run in runs], to_key)
+
+    def row_nums(self, low=None, high=None):
+        """
+        Return the row numbers, in order, of the rows with 
+        low <= value <= high.  Either limit may be None, for no limit.
+
+        """
+        keys = self.keys
+        first = 0 if low is None else bisect_left(keys, self.to_key(low))
+        last = (len(keys) if high is None else 
+                bisect_right(keys, self.to_key(high)))
+        runs = sorted(zip(self.starts[first:last], self.ends[first:last]))
+        return chain.from_iterable(range(start, end) 
+                                   for start, end in runs)
+
+
+class PassCountingTable(etl.Table):
+    """
+    Wrap a petl table and count how many times it is read all the way
+    through, so we can report how many passes were made over the source
+
+    """
+    def __init__(self, source):
+        self.source = source
+        self.passes = 0
+
+    def __iter__(self):
+        for row in self.source:
+            yield row
+        self.passes += 1
+
+
+# The full passes over the input file made when every stage replayed the
+# lazy petl chain built by cleanup_paypal (plus one partial pass for each
+# TicketLeap fee row), as counted by PassCountingTable before the cleaned
+# table was materialized
+ORIGINAL_PASSES = 8
+
+
+def missing_first(value):
+    """
+    The default RunIndex key: values in their own order, but with None 
+    before everything else
+
+    """
+    return (value is not None, value)
+
+
+def with_missing(column):
+    """
+    Iterate over a column, turning the MISSING values of an array back 
+    into None
+
+    """
+    if isinstance(column, integer_columns):
+        return (None if value == MISSING else value for value in column)
+    return column
+
+
+def take(column, row_nums):
+    """
+    Return a new column holding just the given rows of column
+
+    """
+    if isinstance(column, array):
+        return array(column.typecode, (column[row_num] 
+                                       for row_num in row_nums))
+    if isinstance(column, memoryview):
+        return array(column.format, (column[row_num] 
+                                     for row_num in row_nums))
+    return [column[row_num] for row_num in row_nums]
+
+
+def materialize(table):
+    """
+    Evaluate a (possibly lazy) petl table once, and store the result as a
+    ColumnarTable.
+
+    """
+    it = iter(table)
+    header = tuple(next(it))
+    num_fields = len(header)
+
+    columns = [[] for _ in header]
+    appenders = [column.append for column in columns]
+    padding = (None,) * num_fields
+    for row in it:
+        if len(row) != num_fields:
+            # Short rows (e.g. trailing empty CSV fields) are padded with
+            # None, as petl itself does for missing values
+            row = (tuple(row) + padding)[:num_fields]
+        for append, value in zip(appenders, row):
+            append(value)
+
+    return ColumnarTable(header, columns)
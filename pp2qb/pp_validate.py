@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Checking that every TicketLeap sale (a completed cart payment and its cart
+items) hangs together before it's turned into a QuickBooks deposit:
+
+validate_carts
+validate_paypal
+
++ what they check the carts with, one Transaction ID at a time:
+
+CartValidator
+
++ some "private" helpers:
+
+print_cart_validation
+format_quantity
+
+"""
+
+import io, os, csv, operator
+from .pp_helper import fromcsv_paypal, paypal_converters
+from .pp_helper import cancellation_actions, cents_to_dollars, memoized
+
+
+payment_type = 'Shopping Cart Payment Received'
+item_type = 'Shopping Cart Item'
+cart_types = (payment_type, item_type)
+
+
+def validate_carts(paypal):
+    """
+    Check every cart in a paypal table (a ColumnarTable, after
+    eliminate_cancellations), in one pass grouping its cart payments and
+    cart items by Transaction ID.
+
+    Returns the CartValidator, with the carts that fail in its report and
+    their Transaction IDs in failed_tranIDs
+
+    """
+    type_column = paypal.column('Type')
+    tranID_column = paypal.column('Transaction ID')
+    validator = CartValidator()
+    cart_rows = []
+    for row_num in paypal.row_nums():
+        if type_column[row_num] in cart_types:
+            cart_rows.append(row_num)
+        else:
+            validator.add_other(tranID_column[row_num])
+    for row in paypal.cut_rows(CartValidator.source_fields, cart_rows):
+        validator.add(row)
+    validator.check()
+    return validator
+
+
+def validate_paypal(paypal_path, report_path=None, start_date=None,
+                    end_date=None, source=None):
+    """
+    Check the carts of the PayPal CSV file at paypal_path just as
+    paypal_to_quickbooks would, without converting anything: a dry run,
+    e.g. before importing a big export into QuickBooks.
+
+    To be fast, this reads the file once and keeps only the few fields
+    the checks need.  The carts that fail are written to report_path (by
+    default, cart_validation.csv next to paypal_path).  source, if given,
+    is a table of the export's rows to check instead of the file.
+
+    Returns the CartValidator
+
+    """
+    if report_path is None:
+        report_path = os.path.join(os.path.dirname(paypal_path),
+                                   'cart_validation.csv')
+
+    if source is None:
+        source = fromcsv_paypal(paypal_path)
+    rows = iter(source)
+    header = [field.strip() for field in next(rows)]
+    fields = CartValidator.source_fields
+    num_fields = len(header)
+    padding = [''] * num_fields
+    get_fields = operator.itemgetter(*[header.index(field) 
+                                       for field in fields])
+    date_idx = fields.index('Date')
+    type_idx = fields.index('Type')
+    status_idx = fields.index('Status')
+    tranID_idx = fields.index('Transaction ID')
+    # The converters of cleanup_paypal, run once per distinct value
+    converters = [(fields.index(field), memoized(converter))
+                  for field, converter, typecode in paypal_converters
+                  if field in fields and field != 'Date']
+    convert_date = memoized(dict((field, converter) for field, converter, 
+                                 typecode in paypal_converters)['Date'])
+    actions = cancellation_actions()
+
+    validator = CartValidator()
+    for row in rows:
+        validator.num_rows += 1
+        if len(row) < num_fields:
+            row = tuple(row) + tuple(padding)
+        row = list(get_fields(row))
+
+        # Only the rows paypal_to_quickbooks would see (see
+        # ColumnarTable.select_range and eliminate_cancellations)
+        row_date = row[date_idx] = convert_date(row[date_idx])
+        if start_date is not None and (row_date is None or
+                                       row_date < start_date):
+            continue
+        if end_date is not None and row_date is not None and \
+           row_date > end_date:
+            continue
+        if (row[type_idx], row[status_idx]) in actions:
+            continue
+
+        if row[type_idx] in cart_types:
+            for i, convert in converters:
+                row[i] = convert(row[i])
+            validator.add(row)
+        else:
+            validator.add_other(row[tranID_idx])
+
+    validator.check()
+    validator.write_report(report_path)
+    print_cart_validation(validator, report_path)
+    return validator
+
+
+def print_cart_validation(validator, report_path, excluded=None):
+    """
+    Print how the carts a CartValidator checked fared, and how many of 
+    those that failed (excluded, a set of their Transaction IDs) won't be
+    converted to deposits
+
+    """
+    num_failed = len(validator.failed_tranIDs)
+    print("Validated " + str(validator.num_carts) + " carts: " + 
+          str(num_failed) + " failed")
+    if num_failed > 0:
+        print("WARNING: " + str(num_failed) + " carts failed validation; "
+              "see " + report_path)
+    if excluded:
+        print("WARNING: " + str(len(excluded)) + " of them won't be "
+              "converted to deposits, and are left in the unprocessed rows")
+
+
+class CartValidator(object):
+    """
+    Check carts grouped by Transaction ID: each completed cart payment
+    must be the only one of its transaction, its Quantity must be the 
+    number of its cart items, the items must add up to at least the
+    payment (any more is a discount) and its fee must be a charge that's
+    less than the payment, with none on the items.  Cart items without
+    any other row in their transaction are reported too.
+
+    Rows are added with add (a cart payment or cart item, cut to
+    source_fields) and add_other (just the Transaction ID of any other
+    row); check then checks the carts added since it was last called.
+
+    The carts that fail are kept as the rows of a report (with
+    report_header), in the order they were added.  Those that can't be 
+    turned into a deposit at all (with more than one payment, no items or 
+    no fee) are also kept in unconvertible_tranIDs.
+
+    """
+    source_fields = ['Date', 'Name', 'Type', 'Status', 'Transaction ID',
+                     'Gross', 'Fee', 'Quantity']
+
+    report_header = ['Transaction ID', 'Date', 'Name', 'Problems',
+                     'Payments', 'Payment Quantity', 'Items',
+                     'Item Quantity', 'Payment Gross', 'Item Gross', 'Fee']
+
+    def __init__(self):
+        # Transaction ID -> [date, name, payments, payment quantity,
+        #                    payment gross, fee, items, item quantity,
+        #                    item gross, item fee] (money in cents)
+        self.carts = {}
+        self.other_tranIDs = set()
+        # The rows read (by validate_paypal) and the carts checked
+        self.num_rows = 0
+        self.num_carts = 0
+        self.failed_tranIDs = set()
+        self.unconvertible_tranIDs = set()
+        self.report_rows = []
+
+    def add(self, row):
+        """
+        Add a cart payment or cart item, cut to source_fields
+
+        """
+        date, name, row_type, status, tranID, gross, fee, quantity = row
+        cart = self.carts.get(tranID)
+        if cart is None:
+            cart = self.carts[tranID] = [date, name, 0, None, 0, 0, 0, 0,
+                                         0, 0]
+        if row_type == payment_type:
+            if status != 'Completed':
+                # A refund's, say; this isn't a sale
+                self.other_tranIDs.add(tranID)
+                return
+            cart[0], cart[1] = date, name
+            cart[2] += 1
+            if quantity is not None:
+                cart[3] = (cart[3] or 0) + quantity
+            cart[4] += gross or 0
+            if fee is None:
+                cart[5] = None
+            elif cart[5] is not None:
+                cart[5] += fee
+        else:
+            cart[6] += 1
+            cart[7] += 1 if quantity is None else quantity
+            cart[8] += gross or 0
+            cart[9] += fee or 0
+
+    def add_other(self, tranID):
+        """
+        Note that the transaction tranID has some other row than a cart
+        payment or cart item, such as a TicketLeap fee
+
+        """
+        self.other_tranIDs.add(tranID)
+
+    def check(self):
+        """
+        Check the carts added since the last check, reporting those that
+        fail
+
+        Returns the Transaction IDs of the carts that failed
+
+        """
+        failed = []
+        for tranID, cart in self.carts.items():
+            (date, name, payments, payment_quantity, payment_gross, fee,
+             items, item_quantity, item_gross, item_fee) = cart
+            problems = []
+            if payments == 0:
+                if tranID in self.other_tranIDs:
+                    # Not a sale, e.g. a TicketLeap fee and its items
+                    continue
+                problems.append('cart items without a payment')
+            else:
+                self.num_carts += 1
+                if payments > 1:
+                    problems.append(str(payments) + ' cart payments')
+                if items == 0:
+                    problems.append('no cart items')
+                else:
+                    if payment_quantity is not None and \
+                       payment_quantity != items:
+                        problems.append('Quantity is not the number of '
+                                        'items')
+                    if payment_gross > item_gross:
+                        problems.append('payment is more than its items')
+                if fee is None or fee > 0 or -fee >= payment_gross:
+                    problems.append('fee is missing or out of range')
+                if item_fee != 0:
+                    problems.append('fee on cart items')
+                if payments > 1 or items == 0 or fee is None:
+                    self.unconvertible_tranIDs.add(tranID)
+            if problems:
+                failed.append(tranID)
+                self.report_rows.append(
+                    [tranID, date, name, '; '.join(problems), payments,
+                     format_quantity(payment_quantity), items,
+                     format_quantity(item_quantity),
+                     cents_to_dollars(payment_gross),
+                     cents_to_dollars(item_gross),
+                     '' if fee is None or payments == 0 else 
+                     cents_to_dollars(fee)])
+        self.carts = {}
+        self.other_tranIDs = set()
+        self.failed_tranIDs.update(failed)
+        return failed
+
+    def excluded_tranIDs(self, exclude_failed_carts=False):
+        """
+        The Transaction IDs of the carts not to convert to deposits: those
+        that can't be, or with exclude_failed_carts, every cart that failed
+
+        """
+        if exclude_failed_carts:
+            return self.failed_tranIDs
+        return self.unconvertible_tranIDs
+
+    def write_report(self, report_path):
+        """
+        Write the report of the carts that failed to report_path, as CSV
+        (to a temporary file first, which then replaces report_path)
+
+        """
+        temp_path = report_path + '.tmp'
+        with io.open(temp_path, 'w', newline='') as report_file:
+            writer = csv.writer(report_file, lineterminator='\n')
+            writer.writerow(self.report_header)
+            writer.writerows(self.report_rows)
+        os.replace(temp_path, report_path)
+
+
+def format_quantity(quantity):
+    """
+    A quantity for the report, without a trailing .0 if it's whole
+
+    """
+    if quantity is None:
+        return ''
+    if quantity == int(quantity):
+        return int(quantity)
+    return quantity
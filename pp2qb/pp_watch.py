@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Watching a folder for PayPal exports, e.g. one the bookkeeper drops them
+into, and converting each as soon as it has finished arriving:
+
+watch_folder
+watch
+
++ what decides which files are ready to convert:
+
+FolderWatcher
+
++ some "private" helpers:
+
+failed_summary
+print_summary
+main
+
+Usage, as a script:
+
+    python -m pp2qb.pp_watch FOLDER [--workers 2] [--output-dir out]
+                             [--poll-interval 2] [--settle-time 5]
+                             [--start-date 2015-01-01] [--end-date ...]
+                             [--accounts rules.csv] [--cache-dir cache]
+                             [--skip-invalid-carts] [--once]
+
+Each file's output is written as pp_batch.find_jobs does, next to it (or
+in output_dir), as <name>.iif, <name>_unprocessed.csv,
+<name>_invoice_payments.csv and <name>_cart_validation.csv.  Stop it with
+Ctrl-C (or SIGTERM); the files being converted are finished first.
+
+"""
+
+import os, sys, time, signal, asyncio, argparse, traceback
+from concurrent.futures import ProcessPoolExecutor
+from .pp_batch import convert_job, file_job, is_paypal_file, warm_up
+from .pp_batch import job_settings, parse_date
+
+
+def watch_folder(folder, workers=1, output_dir=None, poll_interval=2.0,
+                 settle_time=5.0, start_date=None, end_date=None,
+                 accounts_path=None, cache_dir=None, once=False,
+                 on_converted=None, exclude_failed_carts=False):
+    """
+    Watch folder, converting each PayPal CSV file that lands in it (or is
+    there already, and hasn't been converted since it last changed) with
+    paypal_to_quickbooks, until interrupted.
+
+    The conversions run in workers processes, started once and kept warm
+    (with petl and the rest of pp2qb imported, and the account rules
+    loaded) from one file to the next, so a burst of files just queues up.
+
+    poll_interval: how often to look at the folder, in seconds
+    settle_time: how long a file's size and modification time must stay
+                 the same before it's taken to have finished arriving
+    once: stop as soon as every file in the folder has been converted,
+          instead of watching for more
+    on_converted: called with the summary of each file converted (as
+                  returned by pp_batch.convert_batch), by default
+                  print_summary
+    exclude_failed_carts: as for paypal_to_quickbooks
+
+    Returns the summaries of the files converted, in the order they were
+    finished
+
+    """
+    return asyncio.run(watch(folder, workers, output_dir, poll_interval,
+                             settle_time, start_date, end_date,
+                             accounts_path, cache_dir, once, on_converted,
+                             exclude_failed_carts=exclude_failed_carts))
+
+
+async def watch(folder, workers=1, output_dir=None, poll_interval=2.0,
+                settle_time=5.0, start_date=None, end_date=None,
+                accounts_path=None, cache_dir=None, once=False,
+                on_converted=None, stop=None, exclude_failed_carts=False):
+    """
+    The coroutine behind watch_folder (which see), for running in an
+    event loop of one's own; setting stop, an asyncio.Event, stops it
+
+    """
+    if on_converted is None:
+        on_converted = print_summary
+    if stop is None:
+        stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    handled_signals = []
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop.set)
+            handled_signals.append(signal_number)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # (Not on Windows, nor outside the main thread)
+            pass
+
+    watcher = FolderWatcher(folder, output_dir, settle_time)
+    queue = asyncio.Queue()
+    summaries = []
+    defaults = {'start_date': start_date, 'end_date': end_date,
+                'accounts_path': accounts_path}
+
+    async def convert_files(executor):
+        # One of these per worker, so at most workers files are converted
+        # at a time, however many are queued.  Whatever goes wrong with one
+        # file, it carries on with the next, and the file is marked done
+        # in the queue, or queue.join() would wait for it forever.
+        while True:
+            job = await queue.get()
+            try:
+                try:
+                    summary = await loop.run_in_executor(
+                        executor, convert_job, job, cache_dir,
+                        exclude_failed_carts)
+                except Exception as error:
+                    # (convert_job catches the errors converting the file,
+                    # so this is e.g. its worker process dying)
+                    summary = failed_summary(job, error)
+                watcher.converted(job['paypal_path'], summary['ok'])
+                summaries.append(summary)
+                on_converted(summary)
+            except Exception:
+                print('Error handling ' + job['paypal_path'] + ':', 
+                      file=sys.stderr)
+                traceback.print_exc()
+            finally:
+                queue.task_done()
+
+    with ProcessPoolExecutor(workers, initializer=warm_up,
+                             initargs=([accounts_path],)) as executor:
+        tasks = [loop.create_task(convert_files(executor))
+                 for _ in range(workers)]
+        try:
+            while not stop.is_set():
+                for paypal_path in watcher.poll(time.monotonic()):
+                    job = dict.fromkeys(job_settings)
+                    job.update(file_job(paypal_path, output_dir))
+                    job.update(defaults)
+                    queue.put_nowait(job)
+                if once and watcher.idle():
+                    await queue.join()
+                    if watcher.idle():
+                        break
+                try:
+                    await asyncio.wait_for(stop.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            # Let the files already being converted finish
+            await queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for signal_number in handled_signals:
+                loop.remove_signal_handler(signal_number)
+    return summaries
+
+
+class FolderWatcher(object):
+    """
+    Poll a folder for PayPal CSV files that have finished arriving, i.e.
+    whose size and modification time have stayed the same for settle_time
+    seconds, and that haven't been converted since they last changed.
+
+    A file is taken to have been converted already (e.g. by an earlier
+    watch) if its .IIF file is newer than it.  A file that failed to 
+    convert is tried again once it changes (or by a later watch).
+
+    """
+    def __init__(self, folder, output_dir=None, settle_time=5.0):
+        self.folder = folder
+        self.output_dir = output_dir
+        self.settle_time = settle_time
+        # path -> (size, mtime_ns), and when it was first seen like that
+        self.settling = {}
+        # The paths handed out by poll and not yet converted -> their 
+        # (size, mtime_ns) when they were
+        self.pending = {}
+        # path -> (size, mtime_ns) when it was converted
+        self.done = {}
+        # path -> (size, mtime_ns) when it failed to be converted
+        self.failed = {}
+
+    def poll(self, now):
+        """
+        Look at the folder at time now (in seconds, e.g. time.monotonic())
+
+        Returns the paths of the files that have become ready to convert
+
+        """
+        ready = []
+        seen = set()
+        for entry in sorted(os.scandir(self.folder),
+                            key=lambda entry: entry.name):
+            if not is_paypal_file(entry.name) or not entry.is_file():
+                continue
+            path = entry.path
+            seen.add(path)
+            if path in self.pending:
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if (self.done.get(path) == signature or 
+                    self.failed.get(path) == signature):
+                continue
+            if path not in self.done and self.output_is_newer(path, stat):
+                self.done[path] = signature
+                continue
+
+            settling = self.settling.get(path)
+            if settling is None or settling[0] != signature:
+                # New, or still changing: start the clock (again)
+                self.settling[path] = (signature, now)
+            elif now - settling[1] >= self.settle_time:
+                del self.settling[path]
+                self.pending[path] = signature
+                ready.append(path)
+
+        # Forget the files that have gone
+        for path in set(self.settling) - seen:
+            del self.settling[path]
+        return ready
+
+    def output_is_newer(self, path, stat):
+        """
+        Whether path (whose os.stat is stat) has an .IIF file newer than it
+
+        """
+        iif_path = file_job(path, self.output_dir)['iif_path']
+        try:
+            return os.stat(iif_path).st_mtime_ns >= stat.st_mtime_ns
+        except OSError:
+            return False
+
+    def converted(self, path, ok=True):
+        """
+        Record that the file at path, as handed out by poll, has been
+        converted, or has failed to be if not ok.  Either way it's not 
+        handed out again until it changes (including while it was being 
+        converted), but only a file converted ok counts as done.
+
+        """
+        signature = self.pending.pop(path)
+        if ok:
+            self.done[path] = signature
+            self.failed.pop(path, None)
+        else:
+            self.failed[path] = signature
+            self.done.pop(path, None)
+
+    def idle(self):
+        """
+        Whether no file is settling or waiting to be converted
+
+        """
+        return not self.settling and not self.pending
+
+
+def failed_summary(job, error):
+    """
+    The summary of a job that failed before convert_job could even return
+    one (e.g. because its worker process died), like those it returns
+
+    """
+    summary = dict((key, job[key]) for key in 
+                   ['paypal_path', 'iif_path', 'unprocessed_path', 
+                    'invoice_report_path', 'cart_report_path'])
+    summary.update(ok=False, error=type(error).__name__ + ': ' + str(error),
+                   seconds=None, rows=None, unprocessed_rows=None, 
+                   warnings=[], stages=[])
+    return summary
+
+
+def print_summary(summary):
+    """
+    Print a line about a file watch_folder converted, as pp_batch does
+
+    """
+    if summary['ok']:
+        print('%-40s %8d rows %6d unprocessed %8.2fs' %
+              (summary['paypal_path'], summary['rows'],
+               summary['unprocessed_rows'], summary['seconds']))
+        for warning in summary['warnings']:
+            print('    ' + warning)
+    else:
+        print('%-40s FAILED: %s' % (summary['paypal_path'],
+                                    summary['error']))
+    sys.stdout.flush()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Convert PayPal CSV exports to QuickBooks as they land '
+                    'in a folder')
+    parser.add_argument('folder')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output-dir', help='where to write the output '
+                                             'files')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='seconds between looks at the folder')
+    parser.add_argument('--settle-time', type=float, default=5.0,
+                        help='seconds a file must stay unchanged before '
+                             'it is converted')
+    parser.add_argument('--start-date', type=parse_date)
+    parser.add_argument('--end-date', type=parse_date)
+    parser.add_argument('--accounts', help='the account rules CSV file')
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--skip-invalid-carts', action='store_true',
+                        help='leave the carts that fail validation '
+                             'unprocessed, instead of converting them')
+    parser.add_argument('--once', action='store_true',
+                        help='convert the files there now, then stop')
+    args = parser.parse_args(argv)
+
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    print('Watching ' + args.folder + ' for PayPal exports')
+    sys.stdout.flush()
+    summaries = watch_folder(args.folder, args.workers, args.output_dir,
+                             args.poll_interval, args.settle_time,
+                             args.start_date, args.end_date, args.accounts,
+                             args.cache_dir, args.once,
+                             exclude_failed_carts=args.skip_invalid_carts)
+    return 0 if all(summary['ok'] for summary in summaries) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,7 +4,9 @@
 
 PayPal API reference:
 https://developer.paypal.com/docs/api/
-(not used; instead we require that the transactions be exported to CSV and then this program just deals with that CSV file)
+(this program deals with the transactions as exported to CSV; pp_api can 
+also fetch them from the Transaction Search API, as rows laid out just like
+that CSV file)
 
 TicketLeap API reference:
 http://dev.TicketLeap.com/
@@ -15,85 +17,259 @@ http://dev.TicketLeap.com/
 import petl as etl
 import csv, os
 from .pp_helper import cleanup_paypal, eliminate_cancellations, get_customer_names
+from .pp_helper import print_name_conflicts
+from .pp_helper import cents_to_dollars, fromcsv_paypal
 from .pp_append import append_sales_as_deposits, append_invoices, append_TicketLeap_fees
+from .pp_append import InvoiceMatcher, print_unconverted_invoices
+from .pp_table import PassCountingTable, ORIGINAL_PASSES
+from .pp_iif import IIFWriter
+from .pp_ledger import Ledger
+from .pp_stream import stream_paypal_to_quickbooks
+from .pp_metrics import RunMetrics
+from .pp_classify import AccountClassifier, load_account_rules
+from .pp_cache import cached_cleanup_paypal
+from .pp_validate import validate_carts, validate_paypal
+from .pp_validate import print_cart_validation
 
     
 def paypal_to_quickbooks(paypal_path, 
                          iif_path=None, unprocessed_path=None, 
-                         start_date=None, end_date=None):
+                         start_date=None, end_date=None, workers=1,
+                         ledger_path=None, streaming=False, metrics=None,
+                         accounts_path=None, cache_dir=None, 
+                         classifier=None, invoice_report_path=None,
+                         cart_report_path=None, validate_only=False,
+                         source=None, exclude_failed_carts=False):
     """
     Process the paypal CSV into a QuickBooks 
 
     INPUT: paypal.csv
-    OUTPUT: output.iif and unprocessed.csv
+    OUTPUT: output.iif, unprocessed.csv, invoice_payments.csv (the 
+            payments received for the invoices in output.iif, to record 
+            against them by hand) and cart_validation.csv (the carts that
+            failed validate_carts)
+
+    workers: the number of processes to convert the sales receipts with;
+             the output is the same whatever the number of workers
+    ledger_path: if given, run incrementally: transactions recorded in this
+                 ledger file by earlier runs are skipped, and the ones 
+                 written to output.iif this time are added to it
+    streaming: if True, read the CSV as a stream instead of holding it in 
+               memory, for exports too big for that.  The output is the 
+               same (see stream_paypal_to_quickbooks); workers is ignored.
+    metrics: a RunMetrics, to record the time, rows in and out, and memory 
+             of each stage (see pp_metrics)
+    accounts_path: a CSV file of the rules deciding the QuickBooks class 
+                   and account of each item sold (see load_account_rules); 
+                   by default, pp2qb/accounts.csv
+    cache_dir: if given, keep the cleaned-up PayPal data in a binary cache
+               file in this folder, so later runs over the same CSV file 
+               skip reading and cleaning it (see pp_cache); ignored when 
+               streaming
+    classifier: an AccountClassifier to use instead of loading the rules in
+                accounts_path, e.g. one already warmed up by earlier runs
+    invoice_report_path: where to write invoice_payments.csv
+    cart_report_path: where to write cart_validation.csv
+    exclude_failed_carts: if True, leave every cart that failed 
+                          validate_carts unprocessed instead of converting
+                          it to a deposit.  By default they are only 
+                          reported, and still converted, except for those
+                          that can't be (with more than one payment, no 
+                          items or no fee).
+    validate_only: if True, just check the carts, with a quick pass over
+                   the CSV, and write cart_validation.csv (see 
+                   validate_paypal), which is returned
+    source: a table of the PayPal export's rows to convert instead of
+            reading the CSV file at paypal_path, e.g. as fetched from the
+            API by pp_api; paypal_path may then be None, and the outputs 
+            default to the current folder.  cache_dir is ignored.
     
     """
     etl.config.look_style = 'minimal'
+    paypal_dir = '' if paypal_path is None else os.path.dirname(paypal_path)
 
     if iif_path is None:
         # If no iif path was specified, default to the same folder
         # as the input, and filename = 'output.iif'
-        iif_path = os.path.join(os.path.dirname(paypal_path), 'output.iif')
+        iif_path = os.path.join(paypal_dir, 'output.iif')
     
     if unprocessed_path is None:
         # If no path for unprocessed trades was specified, default to 
         # the same folder as the input, and filename = 'unprocessed.csv'
-        unprocessed_path = os.path.join(os.path.dirname(paypal_path), 
-                                        'unprocessed.csv')
+        unprocessed_path = os.path.join(paypal_dir, 'unprocessed.csv')
+
+    if invoice_report_path is None:
+        # Likewise for the report of the payments received for invoices
+        invoice_report_path = os.path.join(paypal_dir, 
+                                           'invoice_payments.csv')
+
+    if cart_report_path is None:
+        # And for the report of the carts that failed validation
+        cart_report_path = os.path.join(paypal_dir, 'cart_validation.csv')
         
-    # TODO: Validate that the cart_payment is associated with exactly 
-    #       cart_payment.Quantity cart_items.
-    
+    if metrics is None:
+        metrics = RunMetrics()
+    metrics.info.update(paypal_path=paypal_path, iif_path=iif_path, 
+                        unprocessed_path=unprocessed_path, 
+                        invoice_report_path=invoice_report_path,
+                        cart_report_path=cart_report_path,
+                        start_date=start_date, end_date=end_date, 
+                        workers=workers, streaming=streaming,
+                        cache_dir=cache_dir, validate_only=validate_only,
+                        exclude_failed_carts=exclude_failed_carts)
+
+    if validate_only:
+        with metrics.stage('validate_paypal') as stage:
+            validator = validate_paypal(paypal_path, cart_report_path, 
+                                        start_date, end_date, source)
+            stage['rows_in'] = validator.num_rows
+            stage['rows_out'] = len(validator.report_rows)
+        metrics.close()
+        return validator
+
+    if classifier is None:
+        classifier = AccountClassifier(load_account_rules(accounts_path))
+
+    if streaming:
+        if workers != 1:
+            print("WARNING: streaming converts in a single process; "
+                  "workers=" + str(workers) + " is ignored")
+        return stream_paypal_to_quickbooks(paypal_path, iif_path, 
+                                           unprocessed_path, start_date, 
+                                           end_date, ledger_path, metrics,
+                                           classifier, invoice_report_path,
+                                           cart_report_path, source,
+                                           exclude_failed_carts)
+
     # --------------------
     # 1. LOAD PAYPAL CSV FILE
-    paypal = etl.fromcsv(paypal_path)
-    print("Loaded PayPal input file (" + str(paypal.nrows()) + " rows)")
+    if source is None:
+        source = fromcsv_paypal(paypal_path)
+    else:
+        # (Only a file can be cached, keyed on its path and contents)
+        cache_dir = None
+    source = PassCountingTable(source)
+
+    # The cleaned table is held in memory, so the later stages don't keep
+    # re-reading and re-parsing the CSV file.  From here on each stage 
+    # claims the rows it deals with, and whatever rows are left unclaimed 
+    # at the end are the unprocessed ones.
+    # (So the row counts recorded in metrics are all free.)
+    with metrics.stage('cleanup_paypal') as stage:
+        if cache_dir is not None:
+            paypal, from_cache = cached_cleanup_paypal(source, paypal_path,
+                                                       cache_dir)
+            metrics.info['from_cache'] = from_cache
+        else:
+            paypal = cleanup_paypal(source)
+            from_cache = False
+        stage['rows_in'] = paypal.nrows()
+        print("Loaded PayPal input file " + 
+              ("from the cache " if from_cache else "") + 
+              "(" + str(paypal.nrows()) + " rows)")
 
-    paypal = cleanup_paypal(paypal)
+        if start_date is not None or end_date is not None:
+            # Eliminiate dates prior to start_date and after end_date
+            paypal = paypal.select_range('Date', start_date, end_date)
 
-    if start_date is not None:
-        # Eliminiate dates prior to start_date
-        paypal = paypal.selectge('Date', start_date)
+        if ledger_path is not None:
+            # Skip the transactions already exported by earlier runs, 
+            # before netting and converting them
+            ledger = Ledger(ledger_path)
+            paypal, refunded_tranIDs = ledger.skip_exported(paypal)
+        stage['rows_out'] = paypal.nrows()
 
-    if end_date is not None:
-        # Eliminiate dates after end_date
-        paypal = paypal.selectle('Date', end_date)
+    if ledger_path is not None:
+        for tranID in sorted(refunded_tranIDs):
+            print("WARNING: transaction " + tranID + " was exported by an "
+                  "earlier run but has since been refunded; record the "
+                  "refund in QuickBooks manually")
 
     # Any cancelled trades basically cancel, so we can eliminate most of them
     # right off the bat.
-    paypal = eliminate_cancellations(paypal)
+    with metrics.stage('eliminate_cancellations', paypal.nrows()) as stage:
+        paypal = eliminate_cancellations(paypal)
+        stage['rows_out'] = paypal.nrows()
+
+    # Check that each cart payment has exactly Quantity cart items, adding
+    # up to at least the payment, etc.; the carts that don't are listed in 
+    # cart_validation.csv (and left unprocessed, if exclude_failed_carts)
+    with metrics.stage('validate_carts', paypal.nrows()) as stage:
+        cart_validator = validate_carts(paypal)
+        cart_validator.write_report(cart_report_path)
+        excluded_tranIDs = cart_validator.excluded_tranIDs(
+            exclude_failed_carts)
+        stage['rows_out'] = paypal.nrows()
+    print_cart_validation(cart_validator, cart_report_path, excluded_tranIDs)
    
     # --------------------
     # 2. CREATE QUICKBOOKS IIF FILE
     print("Creating output IIF file")
-    # We always delete the file and start fresh
-    try:
-        os.remove(iif_path)
-    except FileNotFoundError:
-        # If the file wasn't there in the first place, no problem.
-        pass
+    # We always start afresh; the file is written to a temporary file and 
+    # only replaces any existing iif_path once everything has succeeded
+    with IIFWriter(iif_path) as iif:
+        # Start with the names data, add that to the .IIF file.
+        with metrics.stage('get_customer_names', paypal.nrows()) as stage:
+            names = get_customer_names(paypal)
+            iif.write_table(names)
+            # (The names are a small in-memory table, one row per customer)
+            stage['rows_out'] = names.nrows()
+
+        print_name_conflicts(names)
 
-    # Start with the names data, add that to the .IIF file.
-    get_customer_names(paypal).appendtsv(iif_path, write_header=True)
+        # TicketLeap fees have a header for both the transaction and the 
+        # split so I have to write to the IIF file within the function
+        with metrics.stage('append_TicketLeap_fees', paypal.nrows()) as stage:
+            paypal = append_TicketLeap_fees(paypal, iif)
+            stage['rows_out'] = paypal.nrows()
 
-    # TicketLeap fees have a header for both the transaction and the split
-    # so I have to write to the IIF file within the function
-    paypal = append_TicketLeap_fees(paypal, iif_path)
+        # TicketLeap sales receipts make up the bulk of the transactions
+        with metrics.stage('append_sales_as_deposits', 
+                           paypal.nrows()) as stage:
+            paypal = append_sales_as_deposits(
+                paypal, iif, workers, classifier, 
+                exclude=excluded_tranIDs)
+            stage['rows_out'] = paypal.nrows()
 
-    # TicketLeap sales receipts make up the bulk of the transactions
-    paypal = append_sales_as_deposits(paypal, iif_path)
+        # Invoices are for tickets or for membership sales; the payments
+        # for them are matched to them by invoice_matcher
+        invoice_matcher = InvoiceMatcher()
+        with metrics.stage('append_invoices', paypal.nrows()) as stage:
+            paypal = append_invoices(paypal, iif, invoice_matcher, 
+                                     classifier)
+            stage['rows_out'] = paypal.nrows()
 
-    # Invoices are for tickets or for membership sales
-    paypal = append_invoices(paypal, iif_path)
+    # The payments for the invoices, which have to be recorded by hand
+    invoice_matcher.write_report(invoice_report_path)
+    print("Created invoice payments report (" + 
+          str(len(invoice_matcher.report_rows)) + " payments matched to " +
+          str(len(invoice_matcher.invoices)) + " invoices)")
+    print_unconverted_invoices(invoice_matcher)
 
+    if ledger_path is not None:
+        # Only now that output.iif is safely in place
+        ledger.record(paypal.claimed_tranIDs, iif_path)
+        ledger.close()
 
     # --------------------
     # 3. CREATE UNPROCESSED ROWS FILE
     print("Creating output unprocessed rows CSV file (" + 
           str(paypal.nrows()) + " rows)")
 
-    unprocessed_file = open(unprocessed_path, 'w')
-    writer = csv.writer(unprocessed_file, lineterminator='\n')
-    writer.writerows(paypal)
-    unprocessed_file.close()
+    with metrics.stage('write_unprocessed', paypal.nrows()) as stage:
+        # Like output.iif, written in full before it replaces the old one
+        unprocessed_temp_path = unprocessed_path + '.tmp'
+        with open(unprocessed_temp_path, 'w') as unprocessed_file:
+            writer = csv.writer(unprocessed_file, lineterminator='\n')
+            # The money is held in cents; write it back out in dollars
+            writer.writerows(paypal.convert(('Gross', 'Fee'), 
+                                            cents_to_dollars))
+        os.replace(unprocessed_temp_path, unprocessed_path)
+        stage['rows_out'] = paypal.nrows()
 
+    metrics.info['passes'] = source.passes
+    metrics.info['original_passes'] = ORIGINAL_PASSES
+    metrics.close()
+    print("Read the PayPal input file " + str(source.passes) + 
+          " time(s), against " + str(ORIGINAL_PASSES) + 
+          " before it was materialized")
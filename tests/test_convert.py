@@ -5,70 +5,1029 @@ Created on Wed May  6 12:09:46 2015
 @author: mcurrie
 """
 
-import sys, os, datetime
-import codecs
+import sys, os, io, datetime, shutil, tempfile, json, subprocess, threading
+import contextlib
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 # We must add .. to the path so that we can perform the 
 # import of the package while running this as 
 # a top-level script (i.e. with __name__ = '__main__')
 sys.path.append('..') 
+import petl as etl
 import pp2qb
+import pp2qb.__main__
+import pp2qb.pp_watch
+import pp2qb.pp_api
+import pp2qb.pp_stream
 
 
 def test_conversion():
     """
     INPUT: paypal.csv
-    OUTPUT: output.iif and unprocessed.csv
+    OUTPUT: output.iif, unprocessed.csv, invoice_payments.csv and 
+            cart_validation.csv, written next to a copy of the example in a
+            temporary folder, so nothing is left behind in tests/
     
     """
-    paypal_path = os.path.join(os.path.normpath(os.path.dirname(__file__)),
-                               'paypal_example.csv')
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        pp2qb.paypal_to_quickbooks(paypal_path, 
+                                   start_date=datetime.date(2015, 1, 1))
+        assert(sorted(os.listdir(output_folder)) == 
+               ['cart_validation.csv', 'invoice_payments.csv', 
+                'output.iif', 'paypal.csv', 'unprocessed.csv'])
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_parallel_conversion():
+    """
+    Converting the sales receipts with several worker processes gives 
+    exactly the same output files as converting them serially
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
 
-    ensure_utf8(paypal_path)
+        outputs = []
+        for workers in [1, 2]:
+            iif_path = os.path.join(output_folder, 
+                                    'output' + str(workers) + '.iif')
+            unprocessed_path = os.path.join(output_folder, 
+                                    'unprocessed' + str(workers) + '.csv')
+            pp2qb.paypal_to_quickbooks(paypal_path, iif_path, 
+                                       unprocessed_path,
+                                       start_date=datetime.date(2015, 1, 1),
+                                       workers=workers)
+            outputs.append((read_file(iif_path), read_file(unprocessed_path)))
 
-    pp2qb.paypal_to_quickbooks(paypal_path, 
-                               start_date=datetime.date(2015, 1, 1))
+        assert(outputs[0] == outputs[1])
+    finally:
+        shutil.rmtree(output_folder)
 
 
-def ensure_utf8(file_path):
+def test_streaming_conversion():
     """
-    Convert a file in-place to utf-8, if it isn't already in utf-8.
+    Streaming the PayPal file gives exactly the same output files as 
+    converting it in memory, with or without a ledger
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+
+        outputs = []
+        for streaming in [False, True]:
+            for ledger_name in [None, 'ledger' + str(streaming) + '.sqlite']:
+                iif_path = os.path.join(output_folder, 'output.iif')
+                unprocessed_path = os.path.join(output_folder, 
+                                                'unprocessed.csv')
+                ledger_path = None
+                if ledger_name is not None:
+                    ledger_path = os.path.join(output_folder, ledger_name)
+                pp2qb.paypal_to_quickbooks(paypal_path, iif_path, 
+                                       unprocessed_path,
+                                       start_date=datetime.date(2015, 1, 1),
+                                       ledger_path=ledger_path,
+                                       streaming=streaming)
+                outputs.append((read_file(iif_path), 
+                                read_file(unprocessed_path)))
+
+        assert(outputs[:2] == outputs[2:])
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_incremental_conversion():
+    """
+    A second run against the same ledger has no transactions left to export
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        iif_path = os.path.join(output_folder, 'output.iif')
+        ledger_path = os.path.join(output_folder, 'ledger.sqlite')
+
+        num_transactions = []
+        for run in range(2):
+            pp2qb.paypal_to_quickbooks(paypal_path, 
+                                       start_date=datetime.date(2015, 1, 1),
+                                       ledger_path=ledger_path)
+            num_transactions.append(read_file(iif_path).count(b'\nTRNS\t'))
+
+        assert(num_transactions == [3, 0])
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_cached_conversion():
+    """
+    A second run over the same PayPal file loads it from the cache, and
+    gives exactly the same output files, whatever the dates chosen
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        iif_path = os.path.join(output_folder, 'output.iif')
+        unprocessed_path = os.path.join(output_folder, 'unprocessed.csv')
+        cache_dir = os.path.join(output_folder, 'cache')
+
+        for start_date in [datetime.date(2015, 1, 1),
+                           datetime.date(2015, 4, 1)]:
+            outputs = []
+            from_cache = []
+            for run_cache_dir in [None, cache_dir, cache_dir]:
+                metrics = pp2qb.RunMetrics()
+                pp2qb.paypal_to_quickbooks(paypal_path, iif_path,
+                                           unprocessed_path,
+                                           start_date=start_date,
+                                           metrics=metrics,
+                                           cache_dir=run_cache_dir)
+                outputs.append((read_file(iif_path),
+                                read_file(unprocessed_path)))
+                from_cache.append(metrics.info.get('from_cache'))
+
+            assert(outputs[0] == outputs[1] == outputs[2])
+            assert(from_cache[1:] == [start_date.month > 1, True])
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_batch_conversion():
+    """
+    A batch converts each file just as paypal_to_quickbooks would on its
+    own, with or without worker processes, and a file that fails doesn't
+    stop the others
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        pp2qb.paypal_to_quickbooks(paypal_path,
+                                   start_date=datetime.date(2015, 1, 1))
+        expected = read_file(os.path.join(output_folder, 'output.iif'))
+
+        batch_folder = os.path.join(output_folder, 'batch')
+        os.mkdir(batch_folder)
+        for name in ['a.csv', 'b.csv']:
+            shutil.copy(paypal_path, os.path.join(batch_folder, name))
+        with open(os.path.join(batch_folder, 'c.csv'), 'w') as bad_file:
+            bad_file.write('Not,a,PayPal,export\n')
+
+        for workers in [1, 2]:
+            summaries = pp2qb.pp_batch.convert_batch(
+                pp2qb.pp_batch.find_jobs(batch_folder), workers,
+                start_date=datetime.date(2015, 1, 1))
+
+            assert([summary['ok'] for summary in summaries] ==
+                   [True, True, False])
+            assert(summaries[0]['rows'] == 15)
+            for summary in summaries[:2]:
+                assert(read_file(summary['iif_path']) == expected)
+
+        manifest_path = os.path.join(output_folder, 'manifest.csv')
+        with open(manifest_path, 'w') as manifest_file:
+            manifest_file.write('paypal_path,iif_path,start_date\n'
+                                'batch/a.csv,a.iif,2015-01-01\n')
+        jobs = pp2qb.pp_batch.load_manifest(manifest_path)
+        assert(jobs == [{'paypal_path': os.path.join(batch_folder, 'a.csv'),
+                         'iif_path': os.path.join(output_folder, 'a.iif'),
+                         'start_date': datetime.date(2015, 1, 1)}])
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_watch_folder():
+    """
+    A file is only converted once its size and modification time have 
+    settled, and then just once until it changes again; watching converts
+    every file just as paypal_to_quickbooks would
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        pp2qb.paypal_to_quickbooks(paypal_path,
+                                   start_date=datetime.date(2015, 1, 1))
+        expected = read_file(os.path.join(output_folder, 'output.iif'))
+
+        watch_folder = os.path.join(output_folder, 'watch')
+        os.mkdir(watch_folder)
+        a_path = os.path.join(watch_folder, 'a.csv')
+        shutil.copy(paypal_path, a_path)
+
+        watcher = pp2qb.pp_watch.FolderWatcher(watch_folder, settle_time=5)
+        assert(watcher.poll(0) == [])
+        assert(watcher.poll(4) == [])
+        with open(a_path, 'a') as a_file:
+            a_file.write('\n')
+        assert(watcher.poll(6) == [])
+        assert(watcher.poll(11) == [a_path])
+        assert(watcher.poll(20) == [])
+        watcher.converted(a_path)
+        assert(watcher.poll(30) == [] and watcher.idle())
+
+        shutil.copy(paypal_path, a_path)
+        shutil.copy(paypal_path, os.path.join(watch_folder, 'b.csv'))
+        for run in range(2):
+            summaries = pp2qb.pp_watch.watch_folder(
+                watch_folder, workers=2, poll_interval=0.01, settle_time=0,
+                start_date=datetime.date(2015, 1, 1), once=True,
+                on_converted=lambda summary: None)
+            # (Both were converted the first time round)
+            assert(sorted(os.path.basename(summary['paypal_path']) 
+                          for summary in summaries) == 
+                   [['a.csv', 'b.csv'], []][run])
+        for name in ['a.iif', 'b.iif']:
+            assert(read_file(os.path.join(watch_folder, name)) == expected)
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_watch_failures():
+    """
+    A file that fails to convert, or whose summary can't be handled, 
+    doesn't stop the watch from converting the files after it; a failed 
+    file is tried again once it changes
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        pp2qb.paypal_to_quickbooks(paypal_path,
+                                   start_date=datetime.date(2015, 1, 1))
+        expected = read_file(os.path.join(output_folder, 'output.iif'))
+
+        watch_folder = os.path.join(output_folder, 'watch')
+        os.mkdir(watch_folder)
+        a_path = os.path.join(watch_folder, 'a.csv')
+        with open(a_path, 'w') as a_file:
+            a_file.write('not,a,PayPal,export\n')
+        for name in ['b.csv', 'c.csv']:
+            shutil.copy(paypal_path, os.path.join(watch_folder, name))
+
+        def on_converted(summary):
+            if summary['paypal_path'].endswith('b.csv'):
+                raise RuntimeError('b.csv')
+
+        summaries = pp2qb.pp_watch.watch_folder(
+            watch_folder, workers=1, poll_interval=0.01, settle_time=0,
+            start_date=datetime.date(2015, 1, 1), once=True, 
+            on_converted=on_converted)
+        assert([(os.path.basename(summary['paypal_path']), summary['ok'])
+                for summary in summaries] == 
+               [('a.csv', False), ('b.csv', True), ('c.csv', True)])
+        assert(read_file(os.path.join(watch_folder, 'c.iif')) == expected)
+
+        watcher = pp2qb.pp_watch.FolderWatcher(watch_folder, settle_time=0)
+        assert(watcher.poll(0) == [] and watcher.poll(1) == [a_path])
+        watcher.converted(a_path, False)
+        assert(watcher.poll(2) == [] and a_path not in watcher.done)
+        shutil.copy(paypal_path, a_path)
+        assert(watcher.poll(3) == [] and watcher.poll(4) == [a_path])
+        watcher.converted(a_path, True)
+        assert(watcher.poll(5) == [] and watcher.idle())
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_command_line():
+    """
+    python -m pp2qb convert gives the same output as paypal_to_quickbooks,
+    and importing pp2qb (or its command line) leaves petl to be imported 
+    when it's needed
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        pp2qb.paypal_to_quickbooks(paypal_path,
+                                   start_date=datetime.date(2015, 1, 1))
+        expected = read_file(os.path.join(output_folder, 'output.iif'))
+
+        iif_path = os.path.join(output_folder, 'cli.iif')
+        report_path = os.path.join(output_folder, 'run_report.json')
+        assert(pp2qb.__main__.main(['convert', paypal_path,
+                                    '--iif', iif_path,
+                                    '--start-date', '2015-01-01',
+                                    '--report', report_path]) == 0)
+        assert(read_file(iif_path) == expected)
+        assert(os.path.exists(report_path))
+
+        package_folder = os.path.dirname(os.path.dirname(
+                                         os.path.abspath(pp2qb.__file__)))
+        imported = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, pp2qb, pp2qb.__main__; '
+             'print("petl" in sys.modules)'],
+            cwd=package_folder)
+        assert(imported.strip() == b'False')
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_encodings():
+    """
+    The PayPal file is read in whatever encoding it's in, and left as it 
+    is, even when the sample its encoding is detected from doesn't reach
+    its first non-ASCII character
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        with open(paypal_path, 'rb') as paypal_file:
+            original = paypal_file.read()
+        text = original.decode('latin-1')
+
+        outputs = []
+        for encoding in ['latin-1', 'utf-8', 'utf-8-sig']:
+            with open(paypal_path, 'wb') as paypal_file:
+                paypal_file.write(text.encode(encoding))
+            pp2qb.paypal_to_quickbooks(paypal_path, 
+                                       start_date=datetime.date(2015, 1, 1))
+            outputs.append(read_file(os.path.join(output_folder, 
+                                                  'output.iif')))
+            assert(read_file(paypal_path) == text.encode(encoding))
+        assert(outputs[0] == outputs[1] == outputs[2])
+
+        helper = pp2qb.pp_helper
+        with open(paypal_path, 'wb') as paypal_file:
+            paypal_file.write(original)
+        first_non_ascii = min(i for i, byte in enumerate(original) 
+                              if byte > 127)
+        assert(helper.detect_encoding(paypal_path) == 'latin-1')
+        assert(helper.detect_encoding(paypal_path, first_non_ascii) == 
+               'utf-8')
+        assert(list(helper.fromcsv_paypal(paypal_path, first_non_ascii)) ==
+               list(etl.fromcsv(paypal_path, encoding='latin-1')))
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_select_range():
+    """
+    Selecting a date range by binary search of the runs of dates finds the
+    same rows as testing every row would, whatever order the dates are in
+
+    """
+    day = lambda d: datetime.date(2015, 3, d)
+    dates = [day(9), day(9), day(7), None, day(5), day(5), day(2), None]
+    for order in [dates, dates[::-1], dates[1::2] + dates[::2]]:
+        paypal = pp2qb.pp_table.ColumnarTable(('Date', 'Row'),
+                                              [list(order),
+                                               list(range(len(order)))])
+        paypal.claim([2], 'earlier stage')
+        for low, high in [(day(5), day(7)), (None, day(5)),
+                          (day(6), None), (None, None)]:
+            expected = [row for row, date in enumerate(order) if row != 2
+                        and (low is None or (date is not None and
+                                             date >= low))
+                        and (high is None or date is None or date <= high)]
+            assert(list(paypal.select_range('Date', low, high).values(
+                        'Row')) == expected)
+
+        runs = paypal.indexes['Date'].keys
+        assert(runs == sorted(runs))
+
+
+def test_metrics():
+    """
+    A RunMetrics records every stage, with the rows going in and out, and
+    writes them to a JSON run report
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        paypal_path = copy_example(output_folder)
+        finished = []
+        metrics = pp2qb.RunMetrics(trace_memory=True, profile_dir=output_folder,
+                                   callback=finished.append)
+        pp2qb.paypal_to_quickbooks(paypal_path, 
+                                   start_date=datetime.date(2015, 1, 1),
+                                   metrics=metrics)
+
+        stages = [record['stage'] for record in metrics.stages]
+        assert(stages == ['cleanup_paypal', 'eliminate_cancellations',
+                          'validate_carts', 'get_customer_names', 
+                          'append_TicketLeap_fees', 
+                          'append_sales_as_deposits', 'append_invoices', 
+                          'write_unprocessed'])
+        assert(finished == metrics.stages)
+        assert(metrics.stages[0]['rows_in'] == 15)
+        # Each stage starts with the rows the one before left
+        for before, after in zip(metrics.stages[4:], metrics.stages[5:]):
+            assert(before['rows_out'] == after['rows_in'])
+        assert(os.path.exists(metrics.stages[0]['profile_path']))
+
+        report_path = os.path.join(output_folder, 'run_report.json')
+        metrics.write_report(report_path)
+        with open(report_path) as report_file:
+            report = json.load(report_file)
+        assert(report['passes'] == 1)
+        assert(report['original_passes'] == 8)
+        assert(len(report['stages']) == 8)
+        assert(report['stages'][1]['peak_traced_bytes'] > 0)
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_customer_names():
+    """
+    Each customer gets one !CUST row, however many rows they appear in,
+    and customers at different addresses sharing a QuickBooks name are 
+    reported as conflicts, in one warning
 
-    Credit:
-    http://stackoverflow.com/questions/6539881/
-    
     """
-    BLOCKSIZE = 1048576 # Arbitary file size limit
-
-    # Find out if the file at file_path is encoded with utf-8:
-    try:
-        with codecs.open(file_path, 
-                         encoding='utf-8', 
-                         errors='strict') as source_file:
-            for line in source_file:
-                pass
-            is_utf8 = True
-    except UnicodeDecodeError:
-        is_utf8 = False
-
-    if not is_utf8:
-        # Perform a conversion
-        with codecs.open(file_path, 'r', 
-                         encoding='iso-8859-1', 
-                         errors='strict') as source_file:
-            with codecs.open(file_path+'2', 'w', 
-                             encoding='utf-8') as target_file:
-                while True:
-                    contents = source_file.read(BLOCKSIZE)
-                    if not contents:
-                        break
-                    target_file.write(contents)
-        
-        # Delete the original file        
-        os.remove(file_path)
-        # Replace the original file with our newly encoded version
-        os.rename(file_path+'2', file_path)
-
-
-if __name__ == "__main__":
-    test_conversion()
\ No newline at end of file
+    header = ['Type', 'Name', 'Email', 'To Email', 'Address Line 1', 
+              'Address Line 2', 'Town/City', 'Province', 'Postal Code', 
+              'Country', 'Phone']
+    sale = 'Shopping Cart Payment Received'
+    paypal = etl.wrap([header,
+        [sale, 'john smith', 'js@a.com', 'us@b.org', '1 Main St', '', 
+         'calgary', 'alberta', 't2t6j9', 'Canada', '4035551234'],
+        ['Shopping Cart Item', 'john smith', 'js@a.com', 'us@b.org', 
+         '1 Main St', '', 'calgary', 'alberta', 't2t6j9', 'Canada', ''],
+        [sale, 'john smith', 'js@a.com', 'us@b.org', '1 Main St', '', 
+         'calgary', 'alberta', 't2t6j9', 'Canada', '4035551234'],
+        [sale, 'John Smith', 'john@c.com', 'us@b.org', '9 Elm St', '', 
+         'edmonton', 'AB', 't5k2j1', 'Canada', '7805550000'],
+        [sale, 'Ann Lee', 'ann@d.com', 'us@b.org', '', '', 
+         '', '', '', '', ''],
+        [sale, 'Ann Lee', 'ann@e.com', 'us@b.org', '', '', 
+         '', '', '', '', '4035550000']])
+
+    names = pp2qb.pp_helper.get_customer_names(paypal)
+
+    assert(names.nrows() == 4)
+    assert(set(names.values('NAME')) == set(['John Smith (c)', 
+                                             'Ann Lee (c)']))
+    assert(list(names.selecteq('BADDR1', 'Ann Lee').values('BADDR3')) 
+           == ['', ''])
+
+    # Only the John Smiths at different addresses conflict, not Ann Lee
+    # with another email and phone number
+    conflicts = pp2qb.pp_helper.get_name_conflicts(names)
+    assert(list(conflicts.keys()) == ['John Smith (c)'])
+    assert(len(conflicts['John Smith (c)']) == 2)
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        pp2qb.pp_helper.print_name_conflicts(names)
+    assert(output.getvalue() == "WARNING: 1 QuickBooks names are each "
+           "shared by customers at different addresses: John Smith (c)\n")
+
+
+def test_cancellations_must_net():
+    """
+    Cancelled transactions are set aside, and if they don't net to 0 the
+    error says which ones don't
+
+    """
+    header = ['Type', 'Status', 'Name', 'Gross', 'Fee', 'Transaction ID']
+    rows = [['Payment Sent', 'Canceled', 'Bob', '-10.00', '0', '1'],
+            ['Cancelled Payment', 'Completed', 'Bob', '10.00', '0', '2'],
+            ['Shopping Cart Item', 'Refunded', 'Ann', '5.00', '', '3'],
+            ['Donation Received', 'Completed', 'Ann', '25.00', '-1.03', '4']]
+
+    def paypal_of(rows):
+        paypal = pp2qb.pp_table.materialize(etl.wrap([header] + rows))
+        for field in ['Gross', 'Fee']:
+            paypal.convert_column(field, pp2qb.pp_helper.convert_ppcents, 
+                                  typecode='q')
+        return paypal
+
+    paypal = pp2qb.pp_helper.eliminate_cancellations(paypal_of(rows))
+    assert(list(paypal.values('Transaction ID')) == ['4'])
+    assert(list(paypal.claimed('eliminate_cancellations').values(
+                'Transaction ID')) == ['1', '2', '3'])
+
+    rows[1][3] = '9.99'
+    try:
+        pp2qb.pp_helper.eliminate_cancellations(paypal_of(rows))
+        assert(False)
+    except pp2qb.pp_helper.NettingError as error:
+        assert('cancelled payments' in str(error))
+        assert('refunds' not in str(error))
+
+
+def test_account_rules():
+    """
+    Items are classified by the first matching rule, from a rule file
+    anyone can edit
+
+    """
+    qb_account = pp2qb.pp_append.qb_account
+    assert(qb_account('Northern Lights Classic - Competitor Entry Fees') == 
+           ('NLC', 'Competition Income:Competitors:Amateur Registration Fees'))
+    assert(qb_account('59th CCC - Friday Evening - Vendredi Soir') == 
+           ('CCC', 'Competition Income:Sales:Tickets:Advance Tickets'))
+
+    output_folder = tempfile.mkdtemp()
+    try:
+        accounts_path = os.path.join(output_folder, 'accounts.csv')
+        with open(accounts_path, 'w') as accounts_file:
+            accounts_file.write('pattern,class,account\n'
+                                'Gala,GALA,Gala Income\n'
+                                'Ticket,,Ticket Income\n')
+        classifier = pp2qb.pp_classify.AccountClassifier(
+            pp2qb.pp_classify.load_account_rules(accounts_path))
+
+        assert(classifier.classify('Gala Ticket') == ('GALA', 'Gala Income'))
+        assert(classifier.classify('Gala Ticket') == ('GALA', 'Gala Income'))
+        assert(list(classifier.classified.keys()) == ['Gala Ticket'])
+        # (Without an applies_to column, the rules are for invoices too)
+        assert(classifier.classify_invoice('Gala Ticket') == 
+               ('GALA', 'Gala Income'))
+        try:
+            classifier.classify('Raffle Ticket')
+            assert(False)
+        except ValueError as error:
+            assert('Raffle Ticket' in str(error))
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_deposit_order():
+    """
+    The deposits, and the items of each, are in the order their rows sort
+    in, not the order PayPal lists them in, so a cart's fee is classified 
+    like its first item and its discount like its last, whether streaming
+    (even with the deposits sorted in several runs, and whatever workers 
+    it's given) or not
+
+    """
+    output_folder = tempfile.mkdtemp()
+    sort_run_size = pp2qb.pp_stream.SORT_RUN_SIZE
+    try:
+        row = paypal_row
+        rows = [
+            row('3/20/2015', 'Zed Zee', 'Shopping Cart Payment Received', 
+                '30.00', '-1.17', 'D1', Quantity='1'),
+            row('3/20/2015', 'Zed Zee', 'Shopping Cart Item', '30.00', '', 
+                'D1', Item_Title='59th CCC - Friday Evening', Quantity='1'),
+            row('2/20/2015', 'Ann Lee', 'Shopping Cart Payment Received', 
+                '75.00', '-2.48', 'D2', Quantity='3'),
+            row('2/20/2015', 'Ann Lee', 'Shopping Cart Item', '51.50', '', 
+                'D2', Item_Title='NLC - Afternoon and Evening', 
+                Quantity='1'),
+            row('2/20/2015', 'Ann Lee', 'Shopping Cart Item', '20.00', '', 
+                'D2', Item_Title='59th CCC - Friday Evening', Quantity='1'),
+            row('2/20/2015', 'Ann Lee', 'Shopping Cart Item', '10.00', '', 
+                'D2', Item_Title='59th CCC - Saturday Evening', 
+                Quantity='1')]
+        paypal_path = os.path.join(output_folder, 'paypal.csv')
+        write_paypal_csv(paypal_path, rows)
+        iif_path = os.path.join(output_folder, 'output.iif')
+
+        outputs = []
+        pp2qb.pp_stream.SORT_RUN_SIZE = 1
+        for kwargs in [{}, {'workers': 2}, {'streaming': True, 'workers': 2}]:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                pp2qb.paypal_to_quickbooks(paypal_path, **kwargs)
+            outputs.append(read_file(iif_path))
+        assert(outputs[0] == outputs[1] == outputs[2])
+        # (Streaming says it ignores workers)
+        assert('workers=2 is ignored' in output.getvalue())
+
+        iif = [row for row in etl.fromcsv(iif_path, delimiter='\t')
+               if row[2] == 'DEPOSIT']
+        assert([row[5] for row in iif if row[0] == 'TRNS'] == 
+               ['Ann Lee', 'Zed Zee'])
+        # The fee, the items and the discount of Ann Lee's cart
+        assert([(row[6], row[7]) for row in iif[1:6]] == 
+               [('CCC', '2.48'), ('CCC', '-10.0'), ('CCC', '-20.0'), 
+                ('NLC', '-51.5'), ('NLC', '6.5')])
+    finally:
+        pp2qb.pp_stream.SORT_RUN_SIZE = sort_run_size
+        shutil.rmtree(output_folder)
+
+
+def test_invoices():
+    """
+    Invoices become INVOICE transactions, and the payments for them are
+    matched to them (by Reference Txn ID, or else by Invoice Number) for 
+    the report, whether or not they come first; a payment matching no
+    invoice, or an invoice without items, is left unprocessed.  Streaming
+    gives the same output.
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        row = paypal_row
+        rows = [
+            row('3/1/2015', 'Bob Roe', 'Payment Received', '20.00', 
+                '-0.88', 'P2', Invoice_Number='200'),
+            row('2/1/2015', 'Ann Lee', 'Invoice Sent', '100.00', '0', 'I1',
+                Invoice_Number='100'),
+            row('2/1/2015', 'Ann Lee', 'Invoice item', '60.00', '', 'I1',
+                Item_Title='59th CCC - Friday Evening - Vendredi Soir',
+                Quantity='2'),
+            row('2/1/2015', 'Ann Lee', 'Invoice item', '40.00', '', 'I1',
+                Item_Title='Northern Lights Classic - Competitor Entry '
+                           'Fees', Quantity='1'),
+            row('2/2/2015', 'Bob Roe', 'Invoice Sent', '50.00', '0', 'I2',
+                Invoice_Number='200'),
+            row('2/2/2015', 'Bob Roe', 'Invoice item', '30.00', '', 'I2',
+                Item_Title='Membership 2015', Quantity='1'),
+            row('1/31/2015', 'Ann Lee', 'Payment Received', '60.00', 
+                '-2.04', 'P1', Reference_Txn_ID='I1'),
+            # Without items, there's nothing to classify an invoice by
+            row('2/3/2015', 'Cy Poe', 'Invoice Sent', '25.00', '0', 'I3',
+                Invoice_Number='300'),
+            row('1/30/2015', 'Cy Poe', 'Payment Received', '10.00', 
+                '-0.59', 'P3', Invoice_Number='999')]
+        paypal_path = os.path.join(output_folder, 'paypal.csv')
+        write_paypal_csv(paypal_path, rows)
+
+        outputs = []
+        for streaming in [False, True]:
+            pp2qb.paypal_to_quickbooks(paypal_path, streaming=streaming)
+            outputs.append([read_file(os.path.join(output_folder, name))
+                            for name in ['output.iif', 'unprocessed.csv',
+                                         'invoice_payments.csv']])
+        assert(outputs[0] == outputs[1])
+
+        iif = etl.fromcsv(os.path.join(output_folder, 'output.iif'), 
+                          delimiter='\t')
+        invoices = [row for row in iif if row[2] == 'INVOICE']
+        assert([row[0] for row in invoices] == 
+               ['TRNS', 'SPL', 'SPL', 'TRNS', 'SPL', 'SPL'])
+        assert([row[7] for row in invoices] == 
+               ['100.0', '-60.0', '-40.0', '50.0', '-30.0', '-20.0'])
+        assert([row[12] for row in invoices[:3]] == ['', '-2', '-1'])
+        # Invoices are classified by the rules for invoices, so a 
+        # membership isn't booked as tickets, nor is the rest of its invoice
+        tickets = 'Competition Income:Sales:Tickets:Advance Tickets'
+        membership = 'Membership Income:Membership Dues'
+        assert([(row[4], row[6]) for row in invoices] == 
+               [('Accounts Receivable', 'CCC'), (tickets, 'CCC'),
+                ('Competition Income:Competitors:Amateur Registration '
+                 'Fees', 'NLC'), 
+                ('Accounts Receivable', 'CCC'), (membership, 'CCC'),
+                (membership, 'CCC')])
+
+        report = etl.fromcsv(os.path.join(output_folder, 
+                                          'invoice_payments.csv'))
+        assert(list(report.values('Payment Transaction ID')) == 
+               ['P2', 'P1'])
+        assert(list(report.values('Outstanding')) == ['30.0', '40.0'])
+
+        unprocessed = etl.fromcsv(os.path.join(output_folder, 
+                                               'unprocessed.csv'))
+        assert(list(unprocessed.values('Transaction ID')) == ['I3', 'P3'])
+
+        # There's no default rule for invoices, as for sales
+        rows[5]['Item Title'] = 'Raffle Ticket'
+        write_paypal_csv(paypal_path, rows)
+        try:
+            pp2qb.paypal_to_quickbooks(paypal_path)
+            assert(False)
+        except ValueError as error:
+            assert('Raffle Ticket' in str(error))
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_validate_carts():
+    """
+    The carts that don't hang together are reported, and still converted
+    unless they can't be, or exclude_failed_carts says to leave them 
+    unprocessed, streaming or not; --validate-only reports the same without
+    converting anything
+
+    """
+    output_folder = tempfile.mkdtemp()
+    try:
+        title = '59th CCC - Friday Evening - Vendredi Soir'
+
+        def cart(tranID, gross, fee, quantity, item_grosses):
+            rows = [paypal_row('2/1/2015', 'Ann Lee', 
+                               'Shopping Cart Payment Received', gross, fee,
+                               tranID, Quantity=quantity)]
+            for item_gross in item_grosses:
+                rows.append(paypal_row('2/1/2015', 'Ann Lee', 
+                                       'Shopping Cart Item', item_gross, '',
+                                       tranID, Item_Title=title, 
+                                       Quantity='1'))
+            return rows
+
+        rows = (cart('C1', '30.00', '-1.17', '2', ['20.00', '10.00']) +
+                # A discount is fine, but not the wrong number of items
+                cart('C2', '25.00', '-1.03', '2', ['20.00', '10.00']) +
+                cart('C3', '30.00', '-1.17', '3', ['20.00', '10.00']) +
+                cart('C4', '40.00', '-1.46', '2', ['20.00', '10.00']) +
+                cart('C5', '30.00', '', '2', ['20.00', '10.00']) +
+                cart('C6', '30.00', '-1.17', '1', ['30.00'])[:1] * 2 +
+                cart('C7', '30.00', '-1.17', '1', ['30.00'])[1:])
+        paypal_path = os.path.join(output_folder, 'paypal.csv')
+        write_paypal_csv(paypal_path, rows)
+        report_path = os.path.join(output_folder, 'cart_validation.csv')
+        unprocessed_path = os.path.join(output_folder, 'unprocessed.csv')
+
+        for exclude_failed_carts, unprocessed_tranIDs in [
+                (False, ['C5', 'C6', 'C7']),
+                (True, ['C3', 'C4', 'C5', 'C6', 'C7'])]:
+            outputs = []
+            for streaming in [False, True]:
+                pp2qb.paypal_to_quickbooks(
+                    paypal_path, streaming=streaming, 
+                    exclude_failed_carts=exclude_failed_carts)
+                outputs.append([read_file(os.path.join(output_folder, name))
+                                for name in ['output.iif', 'unprocessed.csv',
+                                             'cart_validation.csv']])
+            assert(outputs[0] == outputs[1])
+
+            report = etl.fromcsv(report_path)
+            assert(list(report.values('Transaction ID')) == 
+                   ['C3', 'C4', 'C5', 'C6', 'C7'])
+            assert(list(report.values('Problems')) == 
+                   ['Quantity is not the number of items',
+                    'payment is more than its items',
+                    'fee is missing or out of range',
+                    '2 cart payments; no cart items',
+                    'cart items without a payment'])
+            unprocessed = etl.fromcsv(unprocessed_path)
+            assert(sorted(set(unprocessed.values('Transaction ID'))) == 
+                   unprocessed_tranIDs)
+            iif = etl.fromcsv(os.path.join(output_folder, 'output.iif'), 
+                              delimiter='\t')
+            assert(len([row for row in iif if row[0] == 'TRNS']) == 
+                   7 - len(unprocessed_tranIDs))
+
+        # A batch passes exclude_failed_carts on to each of its files, as
+        # does watching a folder
+        summaries = pp2qb.pp_batch.convert_batch(
+            [pp2qb.pp_batch.file_job(paypal_path)],
+            exclude_failed_carts=True)
+        assert(read_file(summaries[0]['unprocessed_path']) ==
+               outputs[0][1])
+        watch_folder = os.path.join(output_folder, 'watch')
+        os.mkdir(watch_folder)
+        shutil.copy(paypal_path, watch_folder)
+        summaries = pp2qb.pp_watch.watch_folder(
+            watch_folder, poll_interval=0.01, settle_time=0, once=True,
+            on_converted=lambda summary: None, exclude_failed_carts=True)
+        assert(read_file(summaries[0]['unprocessed_path']) ==
+               outputs[0][1])
+
+        os.remove(report_path)
+        validator = pp2qb.paypal_to_quickbooks(paypal_path, 
+                                               validate_only=True)
+        assert(validator.num_carts == 6)
+        assert(read_file(report_path) == outputs[0][2])
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def test_api_ingestion():
+    """
+    The transactions fetched page by page from the API, over a few pooled
+    connections and through a 429, convert just as the same transactions
+    exported to CSV do, refunds included; a fetch that fails part way is
+    resumed from the pages saved, fetching only the rest.
+
+    """
+    output_folder = tempfile.mkdtemp()
+    title = '59th CCC - Friday Evening - Vendredi Soir'
+    details = []
+    rows = []
+
+    def cart(tranID, name, initiated, date, status='Completed'):
+        details.append({
+            'transaction_info': {
+                'transaction_id': tranID, 'transaction_event_code': 'T0007',
+                'transaction_initiation_date': initiated,
+                'transaction_amount': {'currency_code': 'CAD',
+                                       'value': '30.00'},
+                'fee_amount': {'currency_code': 'CAD', 'value': '-1.17'},
+                'transaction_status': 'S' if status == 'Completed' else 'V'},
+            'payer_info': {'email_address': 'ann@example.com',
+                           'payer_name': {'alternate_full_name': name}},
+            'cart_info': {'item_details': [
+                {'item_name': title, 'item_quantity': '1',
+                 'total_item_amount': {'currency_code': 'CAD',
+                                       'value': value}}
+                for value in ['20.00', '10.00']]}})
+        if date is None:
+            return
+        rows.append(paypal_row(date, name, 'Shopping Cart Payment Received',
+                               '30.00', '-1.17', tranID, Quantity='2',
+                               Status=status,
+                               From_Email_Address='ann@example.com'))
+        for value in ['20.00', '10.00']:
+            rows.append(paypal_row(date, name, 'Shopping Cart Item', value, 
+                                   '', tranID, Item_Title=title, 
+                                   Quantity='1', Status=status,
+                                   From_Email_Address='ann@example.com'))
+
+    def refund(tranID, name, initiated, date, payment_tranID):
+        # Exported with a Cancelled Fee for the $0.30 PayPal keeps
+        details.append({
+            'transaction_info': {
+                'transaction_id': tranID, 'transaction_event_code': 'T1107',
+                'paypal_reference_id': payment_tranID,
+                'transaction_initiation_date': initiated,
+                'transaction_amount': {'currency_code': 'CAD',
+                                       'value': '-30.00'},
+                'fee_amount': {'currency_code': 'CAD', 'value': '0.87'},
+                'transaction_status': 'S'},
+            'payer_info': {'email_address': 'ann@example.com',
+                           'payer_name': {'alternate_full_name': name}}})
+        rows.append(paypal_row(date, name, 'Refund', '-30.00', '0.87', 
+                               tranID, Reference_Txn_ID=payment_tranID,
+                               From_Email_Address='ann@example.com'))
+        rows.append(paypal_row(date, 'PayPal', 'Cancelled Fee', '0.00', 
+                               '0.30', tranID, 
+                               Reference_Txn_ID=payment_tranID))
+
+    # 12 carts, newest first, one of them refunded a minute later
+    for i in range(12):
+        when = (datetime.datetime(2015, 2, 28, 12, 0, 0) - 
+                datetime.timedelta(4 * i))
+        date = '%d/%d/%d' % (when.month, when.day, when.year)
+        if i == 3:
+            refund('R%02d' % i, 'Ann Lee %d' % i, 
+                   (when + datetime.timedelta(0, 60)).strftime(
+                       '%Y-%m-%dT%H:%M:%S+0000'), date, 'C%02d' % i)
+        cart('C%02d' % i, 'Ann Lee %d' % i, 
+             when.strftime('%Y-%m-%dT%H:%M:%S+0000'), date,
+             'Refunded' if i == 3 else 'Completed')
+    # And two dated in UTC on a different day than where they were made: 
+    # one on the first day, though on the day before in UTC, and one after
+    # the last day, though on the last day in UTC
+    cart('E1', 'Bo Ng', '2015-01-01T00:30:00+0100', '1/1/2015')
+    cart('E2', 'Cy Ng', '2015-03-01T00:30:00+0100', None)
+
+    server_state = {'connections': 0, 'requests': [], 'throttled': False,
+                    'fail_page': None}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            server_state['connections'] += 1
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, data, headers={}):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.reply(200, {'access_token': 'token', 'expires_in': 3600})
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = dict((name, values[0]) for name, values in 
+                         parse_qs(url.query).items())
+            if self.headers['Authorization'] != 'Bearer token':
+                return self.reply(401, {'error': 'invalid_token'})
+            if not server_state['throttled']:
+                server_state['throttled'] = True
+                return self.reply(429, {'name': 'RATE_LIMIT_REACHED'},
+                                  {'Retry-After': '0'})
+            window = (query['start_date'][:10], query['end_date'][:10],
+                      int(query['page']))
+            if window == server_state['fail_page']:
+                return self.reply(400, {'name': 'INVALID_REQUEST'})
+            server_state['requests'].append(window)
+            # (The API searches by UTC dates)
+            found = [detail for detail in details if window[0] <= 
+                     pp2qb.pp_api.initiation_time(detail).astimezone(
+                         datetime.timezone.utc).strftime('%Y-%m-%d') <= 
+                     window[1]]
+            page_size = int(query['page_size'])
+            start = (window[2] - 1) * page_size
+            self.reply(200, {
+                'transaction_details': found[start:start + page_size],
+                'total_pages': max(1, -(-len(found) // page_size)),
+                'page': window[2]})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    start_date = datetime.date(2015, 1, 1)
+    end_date = datetime.date(2015, 2, 28)
+    try:
+        def fetch(state_dir=None):
+            client = pp2qb.pp_api.TransactionSearchClient(
+                base_url, 'id', 'secret', max_connections=2, rate=1000.0)
+            with client:
+                return pp2qb.pp_api.fetch_transactions(
+                    client, start_date, end_date, workers=2, 
+                    state_dir=state_dir, page_size=2)
+
+        transactions = fetch()
+        # A day more is searched on either side, so 5 transactions in the 
+        # first 31-day window and 10 in the second, 2 to a page
+        assert(len(server_state['requests']) == 3 + 5)
+        assert(server_state['connections'] <= 2)
+        assert(list(transactions.values('Transaction ID')) == 
+               [row['Transaction ID'] for row in rows])
+
+        # A fetch that fails on one page, then resumes
+        state_dir = os.path.join(output_folder, 'pages')
+        server_state['fail_page'] = ('2015-01-31', '2015-03-01', 3)
+        try:
+            fetch(state_dir)
+            assert(False)
+        except pp2qb.pp_api.APIError as error:
+            assert(error.status == 400)
+        server_state['fail_page'] = None
+        del server_state['requests'][:]
+        num_saved = len(os.listdir(state_dir))
+        assert(list(fetch(state_dir)) == list(transactions))
+        assert(('2015-01-31', '2015-03-01', 3) in server_state['requests'])
+        assert(len(server_state['requests']) == 8 - num_saved)
+        assert(len(os.listdir(state_dir)) == 8)
+
+        # The same transactions from a CSV file convert the same
+        paypal_path = os.path.join(output_folder, 'paypal.csv')
+        write_paypal_csv(paypal_path, rows)
+        pp2qb.paypal_to_quickbooks(paypal_path)
+        api_folder = os.path.join(output_folder, 'api')
+        os.mkdir(api_folder)
+        client = pp2qb.pp_api.TransactionSearchClient(
+            base_url, access_token='token')
+        with client:
+            pp2qb.pp_api.api_to_quickbooks(client, start_date, end_date,
+                                           api_folder, workers=2,
+                                           state_dir=state_dir, page_size=2)
+        for name in ['output.iif', 'cart_validation.csv']:
+            assert(read_file(os.path.join(api_folder, name)) == 
+                   read_file(os.path.join(output_folder, name)))
+        iif = read_file(os.path.join(api_folder, 'output.iif'))
+        # (Less the cart refunded)
+        assert(iif.count(b'\nTRNS\t') == 12)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(output_folder)
+
+
+def copy_example(output_folder):
+    """
+    Copy paypal_example.csv into output_folder, so a test can write its 
+    output files next to it, and return the path of the copy.
+
+    """
+    example_path = os.path.join(os.path.normpath(os.path.dirname(__file__)),
+                                'paypal_example.csv')
+    paypal_path = os.path.join(output_folder, 'paypal.csv')
+    shutil.copy(example_path, paypal_path)
+
+    return paypal_path
+
+
+def paypal_row(date, name, row_type, gross, fee, tranID, **fields):
+    """
+    A row for write_paypal_csv, Completed unless fields (with underscores
+    for the spaces in the field names) say otherwise
+
+    """
+    row = {'Date': date, 'Name': name, 'Type': row_type, 
+           'Status': 'Completed', 'Currency': 'CAD', 'Gross': gross, 
+           'Fee': fee, 'Transaction ID': tranID}
+    row.update((field.replace('_', ' '), value) 
+               for field, value in fields.items())
+    return row
+
+
+def write_paypal_csv(paypal_path, rows):
+    """
+    Write rows made by paypal_row as a PayPal CSV file, with the header of
+    paypal_example.csv
+
+    """
+    example_path = os.path.join(os.path.normpath(os.path.dirname(__file__)),
+                                'paypal_example.csv')
+    # (Just the header, which is plain ASCII whatever the encoding)
+    with open(example_path, encoding='latin-1') as example_file:
+        header_line = example_file.readline()
+    header = [field.strip() for field in header_line.split(',')]
+    with open(paypal_path, 'w') as paypal_file:
+        paypal_file.write(header_line)
+        for row in rows:
+            paypal_file.write(','.join(row.get(field, '') for field in header)
+                              + '\n')
+
+
+def read_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()